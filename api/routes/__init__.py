@@ -1,8 +1,9 @@
 from api.context import APIContext
-from api.routes import target, backup, seq_upload, misc
+from api.routes import target, backup, seq_upload, jobs, misc
 
 def add_routes(context: APIContext):
     target.add_routes(context)
     backup.add_routes(context)
     seq_upload.add_routes(context)
+    jobs.add_routes(context)
     misc.add_routes(context)
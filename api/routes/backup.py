@@ -1,8 +1,11 @@
+import dataclasses
 import logging
 import uuid
 import os
 import delayed_jobs
 import download
+import file_manager
+import manifest
 import api.utility as apiutil
 from backupchan_server import utility
 from api.context import APIContext
@@ -58,7 +61,69 @@ def add_routes(context: APIContext):
         if target is None:
             return jsonify(success=False), 404
 
-        return send_file(download.get_download_path(backup, target, context.fm.recycle_bin_path, context.config.get("temp_save_path"), context.fm), as_attachment=True)
+        return download.send_backup(backup, target, context.fm, context.config)
+
+    @context.blueprint.route("/backup/<id>/files", methods=["GET"])
+    @context.auth.requires_auth
+    def list_backup_files(id):
+        backup = context.db.get_backup(id)
+        if backup is None:
+            return jsonify(success=False), 404
+
+        page = int(request.args.get("page", 1))
+        page_size = context.config.get("page_size")
+        offset = (page - 1) * page_size
+
+        try:
+            files = context.fm.list_backup_files(id, request.args.get("path", ""))
+        except file_manager.BackupFileNotFoundError as exc:
+            return apiutil.failure_response(str(exc)), 404
+        except file_manager.FileManagerError as exc:
+            return apiutil.failure_response(str(exc)), 400
+
+        return jsonify(success=True, files=[dataclasses.asdict(file) for file in files[offset:offset + page_size]], has_more=len(files) > offset + page_size), 200
+
+    @context.blueprint.route("/backup/<id>/files/download", methods=["GET"])
+    @context.auth.requires_auth
+    def download_backup_file(id):
+        backup = context.db.get_backup(id)
+        if backup is None:
+            return jsonify(success=False), 404
+
+        try:
+            return download.send_backup_file(backup, context.fm, request.args.get("path", ""))
+        except file_manager.BackupFileNotFoundError as exc:
+            return apiutil.failure_response(str(exc)), 404
+        except file_manager.FileManagerError as exc:
+            return apiutil.failure_response(str(exc)), 400
+
+    @context.blueprint.route("/backup/<id>/diff/<other_id>", methods=["GET"])
+    @context.auth.requires_auth
+    def diff_backups(id, other_id):
+        backup = context.db.get_backup(id)
+        other_backup = context.db.get_backup(other_id)
+        if backup is None or other_backup is None:
+            return jsonify(success=False), 404
+
+        old_manifest = context.db.get_backup_manifest(backup.id)
+        new_manifest = context.db.get_backup_manifest(other_backup.id)
+        for backup_id, backup_manifest in ((backup.id, old_manifest), (other_backup.id, new_manifest)):
+            if backup_manifest is None:
+                return apiutil.failure_response(f"No manifest recorded for backup {backup_id}"), 409
+
+        return jsonify(success=True, **manifest.diff(old_manifest, new_manifest)), 200
+
+    @context.blueprint.route("/backup/<id>/integrity", methods=["GET"])
+    @context.auth.requires_auth
+    def backup_integrity(id):
+        backup = context.db.get_backup(id)
+        if backup is None:
+            return jsonify(success=False), 404
+
+        last_verified = context.db.get_backup_last_verified(backup.id)
+        last_full_verified = context.db.get_backup_last_full_verified(backup.id)
+        return jsonify(success=True, hash=backup.hash, hash_mismatch=backup.hash_mismatch, corrupted_files=context.db.get_backup_file_mismatches(backup.id), corrupted_chunks=context.db.get_backup_chunk_mismatches(backup.id),
+                       last_verified_at=None if last_verified is None else last_verified.isoformat(), last_full_verified_at=None if last_full_verified is None else last_full_verified.isoformat()), 200
 
     @context.blueprint.route("/backup/<id>", methods=["DELETE"])
     @context.auth.requires_auth
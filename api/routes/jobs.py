@@ -11,18 +11,23 @@ def add_routes(context: APIContext):
         for job in context.job_scheduler.jobs:
             scheduled_json.append({
                 "name": job.name,
+                "display_name": job.display_name,
                 "interval": job.interval,
-                "next_run": job.next_run
+                "next_run": job.next_run,
+                "group": job.group,
+                "status": job.state.name,
+                "last_run": job.last_run,
+                "last_duration": job.last_duration
             })
 
         for id, job in context.job_manager.jobs.items():
             delayed_json.append({
                 "id": id,
                 "name": job.name,
-                "display_name": job.display_name,
                 "status": job.state.name,
                 "start_time": job.start_time,
-                "end_time": job.end_time
+                "end_time": job.end_time,
+                "details": job.details()
             })
 
         return jsonify(success=True, scheduled=scheduled_json, delayed=delayed_json), 200
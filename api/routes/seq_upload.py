@@ -1,6 +1,8 @@
 import dataclasses
 import logging
 import os
+import file_manager
+import manifest
 import seq_upload
 import api.utility as apiutil
 from backupchan_server import models, utility
@@ -16,6 +18,52 @@ def check_seq_upload(seq_upload_manager: seq_upload.SequentialUploadManager, tar
 
     return None
 
+def get_seq_file_location(temp_save_path: str, target_id: str, sequential_file: seq_upload.SequentialFile) -> str:
+    rel_path = sequential_file.full_path()
+    if os.path.isabs(rel_path):
+        rel_path = rel_path.lstrip("/")
+    return utility.join_path(temp_save_path, f"seq_{target_id}", rel_path)
+
+def prefill_known_files(context: APIContext, target: models.BackupTarget, upload: seq_upload.SequentialUpload) -> int:
+    """
+    Marks files the client sent digests of as uploaded if backups of the target have them, so they don't have to be uploaded.
+    They're only copied once the upload is finished, see copy_known_files. Returns how many files were filled in.
+    """
+    with_digest = [file for file in upload.file_list if manifest.is_digest(file.digest)]
+    if not with_digest:
+        return 0
+
+    known = context.db.find_files_by_digest(target.id, [file.digest for file in with_digest])
+    prefilled = 0
+    for file in with_digest:
+        if file.digest in known:
+            upload.known_files[file.full_path()] = known[file.digest]
+            upload.set_uploaded_state(file, True)
+            prefilled += 1
+    return prefilled
+
+def copy_known_files(context: APIContext, target: models.BackupTarget, upload: seq_upload.SequentialUpload) -> int:
+    """
+    Copies the files filled in by prefill_known_files out of the backups they're in.
+    Ones that can't be copied are marked as not uploaded again, returns how many of them there are.
+    """
+    missing = 0
+    for file in upload.file_list:
+        source = upload.known_files.pop(file.full_path(), None)
+        if source is None:
+            continue
+        backup_id, path = source
+        try:
+            copied = context.fm.copy_backup_file(backup_id, path, get_seq_file_location(context.config.get("temp_save_path"), target.id, file), file.digest)
+        except (file_manager.FileManagerError, OSError) as exc:
+            logging.getLogger("apisequpload").warning("Unable to copy %s of backup {%s}, it has to be uploaded", path, backup_id, exc_info=exc)
+            copied = False
+        # If the copy doesn't match after all, the client uploads it like any other missing file.
+        if not copied:
+            upload.set_uploaded_state(file, False)
+            missing += 1
+    return missing
+
 def add_routes(context: APIContext):
     logger = logging.getLogger("apisequpload")
 
@@ -42,8 +90,12 @@ def add_routes(context: APIContext):
             return jsonify(success=False, message="File list validation failed"), 400
         if create_upload_status == seq_upload.SequentialUploadCreateStatus.TARGET_BUSY:
             return jsonify(success=False, message="Target busy"), 400
-        
-        return jsonify(success=True), 200
+
+        prefilled = prefill_known_files(context, target, context.seq_upload_manager[target.id])
+        if prefilled:
+            logger.info("Filled in %d files of sequential upload on target {%s} from existing backups", prefilled, target.id)
+
+        return jsonify(success=True, prefilled=prefilled), 200
 
     @context.blueprint.route("/seq/<target_id>", methods=["GET"])
     @context.auth.requires_auth
@@ -87,12 +139,8 @@ def add_routes(context: APIContext):
             return jsonify(success=False, message="No file given"), 400
 
         try:
-            rel_path = sequential_file.full_path()
-            if os.path.isabs(rel_path):
-                rel_path = rel_path.lstrip("/")
-
             file = request.files["file"]
-            filename = utility.join_path(context.config.get("temp_save_path"), f"seq_{target.id}", rel_path)
+            filename = get_seq_file_location(context.config.get("temp_save_path"), target.id, sequential_file)
             os.makedirs(os.path.dirname(filename), exist_ok=True)
 
             file.save(filename)
@@ -115,19 +163,20 @@ def add_routes(context: APIContext):
         if not context.seq_upload_manager[target.id].all_uploaded():
             return jsonify(success=False), 409
 
+        missing = copy_known_files(context, target, context.seq_upload_manager[target.id])
+        if missing:
+            return jsonify(success=False, message=f"{missing} files could not be copied from existing backups and have to be uploaded"), 409
+
         source_path = utility.join_path(context.config.get("temp_save_path"), f"seq_{target.id}")
-        backup_id = context.db.add_backup(target.id, context.seq_upload_manager[target.id].manual)
         try:
-            context.fm.add_backup(backup_id, [source_path])
+            result = context.server_api.upload_backup(target.id, context.seq_upload_manager[target.id].manual, [source_path])
         except Exception as exc:
-            context.db.delete_backup(backup_id)
             logger.error("Error when adding sequential backup files on target {%s}", target.id, exc_info=exc)
             return jsonify(success=False, message=str(exc)), 500
 
-        context.db.set_backup_filesize(backup_id, context.fm.get_backup_size(backup_id))
         context.seq_upload_manager.finish(target.id)
 
-        return jsonify(success=True), 200
+        return jsonify(success=True, backup_id=result.backup_id, duplicate_of=result.duplicate_of), 200
 
     @context.blueprint.route("/seq/<target_id>/terminate", methods=["POST"])
     @context.auth.requires_auth
@@ -1,5 +1,8 @@
 import dataclasses
 import logging
+import delayed_jobs
+import database
+import manifest
 import api.utility as apiutil
 from api.context import APIContext
 from flask import request, jsonify
@@ -27,12 +30,15 @@ def add_routes(context: APIContext):
             return verify_result
 
         try:
+            # Checked before the target is added, so it's not left behind when the storage format is rejected.
+            if "storage_format" in data:
+                database.validate_storage_format(data["storage_format"], data["backup_type"])
             target_id = context.db.add_target(data["name"], data["backup_type"], data["recycle_criteria"], data["recycle_value"], data["recycle_action"], data["location"], data["name_template"], data["deduplicate"], data["alias"], data["min_backups"], data["tags"])
+            if "storage_format" in data:
+                context.db.set_target_storage_format(target_id, data["storage_format"])
+        except database.DatabaseError as exc:
+            return apiutil.failure_response(str(exc)), 400
         except Exception as exc:
-            # TODO to recognize between invalid requests and internal errors,
-            #      run validation in this function.
-            #      Though this would run validation twice.
-            #      A solution is to manually run validate_target first, not in add_target.
             logger.error("Failed to add target", exc_info=exc)
             return apiutil.failure_response(str(exc)), 500
         return jsonify(success=True, id=target_id), 201
@@ -44,7 +50,7 @@ def add_routes(context: APIContext):
         if target is None:
             return jsonify(success=False), 404
         backups = context.db.list_backups_target(id)
-        return jsonify(success=True, target=dataclasses.asdict(target), backups=[backup.asdict() for backup in backups]), 200
+        return jsonify(success=True, target=dataclasses.asdict(target), storage_format=context.db.get_target_storage_format(target.id), backups=[backup.asdict() for backup in backups]), 200
 
     @context.blueprint.route("/target/<id>", methods=["PATCH"])
     @context.auth.requires_auth
@@ -58,8 +64,46 @@ def add_routes(context: APIContext):
         if verify_result is not None:
             return verify_result
 
-        context.server_api.edit_target(id, data["name"], data["recycle_criteria"], data["recycle_value"], data["recycle_action"], data["location"], data["name_template"], data["deduplicate"], data["alias"], data["min_backups"], data["tags"])
-        return jsonify(success=True), 200
+        # Everything is checked before anything is changed, so a rejected edit leaves the target as it was.
+        try:
+            if "storage_format" in data:
+                database.validate_storage_format(data["storage_format"], target.target_type)
+            context.db.validate_target(data["name"], data["name_template"], data["location"], target.id, data["alias"])
+        except database.DatabaseError as exc:
+            return apiutil.failure_response(str(exc)), 400
+
+        job_id = None
+        try:
+            needs_relocation = context.server_api.edit_target(id, data["name"], data["recycle_criteria"], data["recycle_value"], data["recycle_action"], data["location"], data["name_template"], data["deduplicate"], data["alias"], data["min_backups"], data["tags"])
+            if "storage_format" in data:
+                context.db.set_target_storage_format(target.id, data["storage_format"])
+        except database.TargetNotFoundError:
+            # Deleted in the meantime.
+            return jsonify(success=False), 404
+        except database.DatabaseError as exc:
+            return apiutil.failure_response(str(exc)), 400
+        if needs_relocation:
+            job_id = context.job_manager.run_job(delayed_jobs.RelocateJob(target.id, context.fm, context.config.get("relocate_workers"), target.location))
+        return jsonify(success=True, job_id=job_id), 200
+
+    @context.blueprint.route("/target/<id>/negotiate", methods=["POST"])
+    @context.auth.requires_auth
+    def negotiate_upload(id):
+        target = context.db.get_target(id)
+        if target is None:
+            return jsonify(success=False), 404
+
+        data = request.get_json()
+        if not isinstance(data, dict):
+            return apiutil.failure_response("Expected a JSON object"), 400
+        backup_hash = data.get("hash")
+        digests = data.get("digests", [])
+        if (backup_hash is not None and not manifest.is_digest(backup_hash)) or not isinstance(digests, list) or not all(manifest.is_digest(digest) for digest in digests):
+            return apiutil.failure_response("Hashes must be SHA-256 hex digests"), 400
+
+        backup_id = context.db.find_backup_by_hash(target.id, backup_hash) if backup_hash is not None else None
+        known_digests = context.db.find_files_by_digest(target.id, digests) if digests else {}
+        return jsonify(success=True, backup_id=backup_id, known_digests=sorted(known_digests)), 200
 
     @context.blueprint.route("/target/<id>", methods=["DELETE"])
     @context.auth.requires_auth
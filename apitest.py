@@ -2,14 +2,30 @@ import mock_modules
 import serverapi
 import serverconfig
 import stats
+import database
 import delayed_jobs
+import scheduled_jobs
+import manifest
+import seq_upload
+import download_cache
+import download
+import storage_watcher
+import throttle
 import pytest
 import logging
 import io
+import os
+import errno
+import shutil
+import hashlib
 import datetime
 import random
 import string
+import time
+import threading
+import tarfile
 from api import api
+from file_manager import FileManager, FileManagerError, move_backup_files, RELOCATING_SUFFIX, RELOCATED_SUFFIX, PACK_FILE_NAME
 from backupchan_server import models
 from flask import Flask
 
@@ -23,7 +39,9 @@ file_manager = mock_modules.MockFileManager(db)
 server_api = serverapi.ServerAPI(db, file_manager)
 stats = stats.Stats(db, file_manager)
 job_manager = delayed_jobs.JobManager()
-api = api.API(db, server_api, config, file_manager, stats, job_manager, None, None)
+job_scheduler = scheduled_jobs.JobScheduler()
+seq_upload_manager = seq_upload.SequentialUploadManager()
+api = api.API(db, server_api, config, file_manager, stats, job_manager, job_scheduler, seq_upload_manager)
 api.auth.key = None
 
 app.register_blueprint(api.blueprint, url_prefix="/api")
@@ -61,6 +79,36 @@ def test_new_target(client):
     target = db.get_target(data["id"])
     assert target is not None
 
+def test_target_storage_format(client):
+    db.reset()
+
+    response = client.post("/api/target", json={"name": "archived", "backup_type": "multi", "recycle_criteria": "none", "recycle_value": 0, "recycle_action": "recycle", "location": "/var/backups/archived", "name_template": "$I", "deduplicate": False, "alias": None, "min_backups": 0, "tags": [], "storage_format": "archive"})
+    assert response.status_code == 201
+    target_id = response.get_json()["id"]
+
+    response = client.get(f"/api/target/{target_id}")
+    assert response.get_json()["storage_format"] == "archive"
+
+    response = client.patch(f"/api/target/{target_id}", json={"name": "archived", "recycle_criteria": "none", "recycle_value": 0, "recycle_action": "recycle", "location": "/var/backups/archived", "name_template": "$I", "deduplicate": False, "alias": None, "min_backups": 0, "tags": [], "storage_format": "bogus"})
+    assert response.status_code == 400
+    assert db.get_target_storage_format(target_id) == "archive"
+
+    response = client.patch(f"/api/target/{target_id}", json={"name": "archived", "recycle_criteria": "none", "recycle_value": 0, "recycle_action": "recycle", "location": "/var/backups/archived", "name_template": "$I", "deduplicate": False, "alias": None, "min_backups": 0, "tags": [], "storage_format": "pack"})
+    assert response.status_code == 200
+    assert db.get_target_storage_format(target_id) == "pack"
+
+    # The rest of the edit is rejected, so the storage format stays as it was
+    response = client.patch(f"/api/target/{target_id}", json={"name": "", "recycle_criteria": "none", "recycle_value": 0, "recycle_action": "recycle", "location": "/var/backups/archived", "name_template": "$I", "deduplicate": False, "alias": None, "min_backups": 0, "tags": [], "storage_format": "files"})
+    assert response.status_code == 400
+    assert db.get_target_storage_format(target_id) == "pack"
+    assert db.get_target(target_id).name == "archived"
+
+    # Rejected storage formats don't leave a target behind
+    for backup_type, storage_format in (("multi", "bogus"), ("single", "archive")):
+        response = client.post("/api/target", json={"name": "rejected", "backup_type": backup_type, "recycle_criteria": "none", "recycle_value": 0, "recycle_action": "recycle", "location": "/var/backups/rejected", "name_template": "rejected$I", "deduplicate": False, "alias": None, "min_backups": 0, "tags": [], "storage_format": storage_format})
+        assert response.status_code == 400
+    assert len(db.list_targets_all()) == 1
+
 def test_new_target_bad(client):
     response = client.post("/api/target", json={})
     assert response.status_code == 400
@@ -83,6 +131,147 @@ def test_edit_target(client):
     assert target.alias == "test"
     assert target.min_backups == 4
     assert target.tags == ["cool", "beans"]
+    assert response.get_json()["job_id"] is None # no backups to move
+
+def test_edit_target_relocate(client):
+    db.reset()
+
+    target_id = create_test_target()
+    backup_id = create_test_backup(target_id)
+    target = db.get_target(target_id)
+
+    response = client.patch(f"/api/target/{target_id}", json={"name": target.name, "recycle_criteria": "none", "recycle_value": 0, "recycle_action": "recycle", "location": "/var/backups/moved", "name_template": target.name_template, "deduplicate": False, "alias": None, "min_backups": 0, "tags": []})
+    assert response.status_code == 200
+
+    job_id = response.get_json()["job_id"]
+    assert job_id is not None
+
+    job = job_manager.jobs[job_id]
+    for _ in range(50):
+        if job.state not in (delayed_jobs.DelayedJobState.IDLE, delayed_jobs.DelayedJobState.RUNNING):
+            break
+        time.sleep(0.1)
+    assert job.state == delayed_jobs.DelayedJobState.FINISHED
+    assert db.get_backup_relocation(backup_id) is None
+
+def test_relocate_resume(tmp_path, monkeypatch):
+    db.reset()
+    real_file_manager = FileManager(db, str(tmp_path / "recycle"))
+
+    target_id = db.add_target("resume", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "new"), "$I", False, None, 0, [])
+    backup_id = add_files_backup(target_id, tmp_path / "old", {"a.txt": b"0123456789"})
+    db.set_backup_path(backup_id, backup_id)
+    db.add_backup_relocations(target_id, [(backup_id, str(tmp_path / "old" / backup_id), str(tmp_path / "new" / backup_id))])
+
+    # The server goes down after moving the files but before recording it
+    complete = db.complete_backup_relocation
+    def crash(*args):
+        raise RuntimeError("crashed")
+    monkeypatch.setattr(db, "complete_backup_relocation", crash)
+    with pytest.raises(RuntimeError):
+        real_file_manager.relocate_backup(backup_id)
+    monkeypatch.setattr(db, "complete_backup_relocation", complete)
+    assert not (tmp_path / "old" / backup_id).exists()
+    assert db.get_backup_relocation(backup_id) is not None
+
+    real_file_manager.relocate_backup(backup_id)
+    assert db.get_backup_relocation(backup_id) is None
+    assert real_file_manager.get_backup_path(backup_id) == str(tmp_path / "new" / backup_id)
+    assert (tmp_path / "new" / backup_id / "a.txt").read_bytes() == b"0123456789"
+
+def test_relocate_resume_across_devices(tmp_path, monkeypatch):
+    old_path = tmp_path / "old" / "backup"
+    new_path = tmp_path / "new" / "backup"
+    copy_path = tmp_path / "new" / ("backup" + RELOCATING_SUFFIX)
+    moved_path = tmp_path / "old" / ("backup" + RELOCATED_SUFFIX)
+
+    def make_backup(path):
+        (path / "sub").mkdir(parents=True)
+        (path / "a.txt").write_bytes(b"0123456789")
+        (path / "sub" / "b.txt").write_bytes(b"01234")
+
+    def check_moved():
+        assert (new_path / "a.txt").read_bytes() == b"0123456789"
+        assert (new_path / "sub" / "b.txt").read_bytes() == b"01234"
+        assert os.listdir(tmp_path / "old") == []
+        assert os.listdir(tmp_path / "new") == ["backup"]
+
+    rename = os.rename
+    def rename_across_devices(source, dest):
+        if str(source) == str(old_path) and str(dest) == str(new_path):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        rename(source, dest)
+    monkeypatch.setattr(os, "rename", rename_across_devices)
+
+    # Interrupted while copying, the old path is still whole
+    make_backup(old_path)
+    (copy_path / "sub").mkdir(parents=True)
+    (copy_path / "a.txt").write_bytes(b"01234")
+    move_backup_files(str(old_path), str(new_path))
+    check_moved()
+
+    # Left at the new path by an interrupted move that copied straight into it
+    shutil.rmtree(tmp_path / "new")
+    make_backup(old_path)
+    new_path.mkdir(parents=True)
+    (new_path / "a.txt").write_bytes(b"01234")
+    move_backup_files(str(old_path), str(new_path))
+    check_moved()
+
+    # Interrupted after the copy was done and the old path was set aside
+    shutil.rmtree(tmp_path / "new")
+    make_backup(moved_path)
+    make_backup(copy_path)
+    move_backup_files(str(old_path), str(new_path))
+    check_moved()
+
+    # Nothing to pick up from
+    shutil.rmtree(tmp_path / "new")
+    with pytest.raises(FileManagerError):
+        move_backup_files(str(old_path), str(new_path))
+
+def test_relocate_job_old_location_trash(tmp_path):
+    db.reset()
+    real_file_manager = FileManager(db, str(tmp_path / "recycle"))
+
+    target_id = db.add_target("relocate", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "old"), "$I", False, None, 0, [])
+    deleted_id = add_files_backup(target_id, tmp_path / "old", {"a.txt": b"0123456789"})
+    backup_id = add_files_backup(target_id, tmp_path / "old", {"b.txt": b"0123456789"})
+    # Deleted, but not reaped yet
+    real_file_manager.delete_backup(deleted_id)
+    db.delete_backup(deleted_id)
+
+    target = db.get_target(target_id)
+    db.edit_target(target_id, target.name, "none", 0, "recycle", str(tmp_path / "new"), "$I", False, None, 0, [])
+    assert real_file_manager.schedule_backup_relocations(target, "$I", str(tmp_path / "new"), "$I", str(tmp_path / "old")) == 1
+
+    job = delayed_jobs.RelocateJob(target_id, real_file_manager, 1, str(tmp_path / "old"))
+    assert job.run() == delayed_jobs.DelayedJobState.FINISHED
+    assert (tmp_path / "new" / backup_id / "b.txt").read_bytes() == b"0123456789"
+    assert not (tmp_path / "old").exists()
+    assert db.list_trash() == []
+
+def test_backup_extension(tmp_path):
+    db.reset()
+
+    target_id = db.add_target("extension", models.BackupType.SINGLE, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path), "$I", False, None, 0, [])
+    backup_id = create_test_backup(target_id)
+    backup = db.get_backup(backup_id)
+    target = db.get_target(target_id)
+
+    # Named with a template other than the one given, so the extension has to come from the file name alone
+    db.set_backup_path(backup_id, "renamed.tar.xz")
+    (tmp_path / "renamed.tar.xz").write_bytes(b"")
+    assert file_manager.get_backup_extension(backup, target, "$I") == ".tar.xz"
+
+    db.set_backup_path(backup_id, f"{backup_id}.tar.gz")
+    assert file_manager.get_backup_extension(backup, target, "$I") == ".tar.gz"
+
+def test_edit_target_missing():
+    db.reset()
+
+    with pytest.raises(database.TargetNotFoundError):
+        server_api.edit_target("nope", "test", "none", 0, "recycle", "/var/backups/test", "$I", False, None, 0, [])
 
 def test_delete_target(client):
     db.reset()
@@ -106,6 +295,468 @@ def test_upload_backup(client):
     backups = db.list_backups_target(target_id)
     assert len(backups) == 1
 
+def test_upload_backup_duplicate(client):
+    db.reset()
+
+    target_id = create_test_target()
+    backup_id = create_test_backup(target_id)
+    entries = file_manager.get_backup_manifest(backup_id)
+    db.set_backup_hash(backup_id, file_manager.get_manifest_hash(backup_id, entries))
+
+    result = server_api.upload_backup(target_id, False, ["test.txt"])
+    assert result.backup_id == backup_id
+    assert result.duplicate_of == backup_id
+    assert len(db.list_backups_target(target_id)) == 1
+
+    # Recycled backups don't count.
+    db.recycle_backup(backup_id, True)
+    result = server_api.upload_backup(target_id, False, ["test.txt"])
+    assert result.duplicate_of is None
+    assert len(db.list_backups_target(target_id)) == 2
+
+def test_upload_duplicate_trash_size(tmp_path):
+    db.reset()
+    real_file_manager = FileManager(db, str(tmp_path / "recycle"))
+    real_server_api = serverapi.ServerAPI(db, real_file_manager)
+    files = {"a.txt": b"0123456789", "sub/b.txt": b"01234"}
+
+    target_id = db.add_target("dedup", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "target"), "$I", True, None, 0, [])
+    backup_id = real_server_api.upload_backup(target_id, False, [make_upload_dir(tmp_path / "upload1" / "data", files)]).backup_id
+    result = real_server_api.upload_backup(target_id, False, [make_upload_dir(tmp_path / "upload2" / "data", files)])
+    assert result.duplicate_of == backup_id
+
+    # The duplicate is in the trash with the size of what was uploaded
+    assert db.get_trash_size() == 15
+
+def test_upload_archive_link_escape(tmp_path):
+    db.reset()
+
+    target_id = db.add_target("links", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "target"), "$I", False, None, 0, [])
+    backup_id = create_test_backup(target_id)
+
+    # Each link looks fine when it's made, together they lead out of the backup.
+    archive_path = tmp_path / "upload.tar"
+    with tarfile.open(archive_path, "w") as tar:
+        for name, link_target in (("y", "w/.."), ("w", ".")):
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = link_target
+            tar.addfile(info)
+        info = tarfile.TarInfo("y/pwned")
+        info.size = 5
+        tar.addfile(info, io.BytesIO(b"pwned"))
+
+    real_file_manager = FileManager(db, str(tmp_path / "recycle"))
+    with pytest.raises(FileManagerError):
+        real_file_manager.add_backup(backup_id, [str(archive_path)])
+    assert not (tmp_path / "pwned").exists()
+    # Nothing is left of the failed upload
+    assert not (tmp_path / "target" / backup_id).exists()
+
+def test_deduplicate_recycled_twin():
+    db.reset()
+
+    target_id = create_test_target()
+    now = datetime.datetime.now()
+    recycled_id = db.add_backup(target_id, False, now - datetime.timedelta(days=2))
+    kept_id = db.add_backup(target_id, False, now - datetime.timedelta(days=1))
+    duplicate_id = db.add_backup(target_id, False, now)
+    for backup_id in (recycled_id, kept_id, duplicate_id):
+        db.set_backup_hash(backup_id, "a" * 64)
+    db.recycle_backup(recycled_id, True)
+
+    # Same as uploading, the recycled backup doesn't count as the one to keep
+    assert db.find_backup_by_hash(target_id, "a" * 64) == kept_id
+    scheduled_jobs.DeduplicateJob(0, db, file_manager, server_api).run()
+    assert db.get_backup(recycled_id) is not None
+    assert db.get_backup(kept_id) is not None
+    assert db.get_backup(duplicate_id) is None
+
+def test_deduplicate_size_filter(monkeypatch):
+    db.reset()
+
+    target_id = create_test_target()
+    now = datetime.datetime.now()
+    same_ids = [db.add_backup(target_id, False, now - datetime.timedelta(days=days)) for days in (3, 2)]
+    unique_id = db.add_backup(target_id, False, now - datetime.timedelta(days=1))
+    unmeasured_id = db.add_backup(target_id, False, now)
+    # Fresh uploads, neither hashed nor measured yet
+    for backup_id, filesize in zip(same_ids + [unique_id, unmeasured_id], (10, 10, 20, 0)):
+        db.get_backup(backup_id).hash = None
+        db.set_backup_filesize(backup_id, filesize)
+
+    hashed = []
+    get_backup_manifest = file_manager.get_backup_manifest
+    def record_manifest(backup_id: str, limiter=None):
+        hashed.append(backup_id)
+        return get_backup_manifest(backup_id, limiter)
+    monkeypatch.setattr(file_manager, "get_backup_manifest", record_manifest)
+
+    scheduled_jobs.DeduplicateJob(0, db, file_manager, server_api).run()
+
+    # Nothing else has the size of these, so they can't be duplicates
+    assert sorted(hashed) == sorted(same_ids)
+    assert not db.get_backup(unique_id).hash
+    assert not db.get_backup(unmeasured_id).hash
+    # Measured along the way
+    assert db.get_backup(unmeasured_id).filesize == 123456
+    # Both hashed the same, so the newer one is removed
+    assert db.get_backup(same_ids[0]) is not None
+    assert db.get_backup(same_ids[1]) is None
+
+def test_deduplicate_groups():
+    db.reset()
+
+    target_id = create_test_target()
+    now = datetime.datetime.now()
+    backup_ids = [db.add_backup(target_id, False, now - datetime.timedelta(days=days)) for days in range(6, 0, -1)]
+    # Oldest first: two groups with the same hash each, interleaved, and one backup with a hash of its own
+    for backup_id, backup_hash in zip(backup_ids, ("a", "b", "a", "c", "b", "a")):
+        db.set_backup_hash(backup_id, backup_hash * 64)
+
+    assert db.list_duplicate_backups(target_id) == [backup_ids[5], backup_ids[4], backup_ids[2]]
+    scheduled_jobs.DeduplicateJob(0, db, file_manager, server_api).run()
+    assert [backup.id for backup in db.list_backups_target(target_id)] == [backup_ids[0], backup_ids[1], backup_ids[3]]
+
+def test_backup_filesize_fingerprint(monkeypatch):
+    db.reset()
+
+    target_id = create_test_target()
+    backup_ids = [create_test_backup(target_id) for _ in range(3)]
+
+    measured = []
+    batches = []
+    get_backup_size = file_manager.get_backup_size
+    set_backup_filesizes = db.set_backup_filesizes
+    def record_size(backup_id: str) -> int:
+        measured.append(backup_id)
+        return get_backup_size(backup_id)
+    def record_batch(sizes: list[tuple[str, int, str | None]]):
+        batches.append(sizes)
+        set_backup_filesizes(sizes)
+    monkeypatch.setattr(file_manager, "get_backup_size", record_size)
+    monkeypatch.setattr(db, "set_backup_filesizes", record_batch)
+
+    job = scheduled_jobs.BackupFilesizeJob(3600, db, file_manager)
+    job.run()
+    assert sorted(measured) == sorted(backup_ids)
+    assert len(batches) == 1
+    assert sorted(batches[0]) == sorted((backup_id, 123456, file_manager.get_backup_fingerprint(backup_id)) for backup_id in backup_ids)
+
+    # Nothing moved, so nothing is walked again
+    measured.clear()
+    batches.clear()
+    job.run()
+    assert measured == []
+    assert batches == [[]]
+
+    # Moved to the recycle bin, which changes its fingerprint
+    db.recycle_backup(backup_ids[1], True)
+    batches.clear()
+    job.run()
+    assert measured == [backup_ids[1]]
+    assert batches == [[(backup_ids[1], 123456, file_manager.get_backup_fingerprint(backup_ids[1]))]]
+    assert db.list_backup_size_fingerprints(target_id)[backup_ids[1]] == f"{backup_ids[1]}:True"
+
+class FakeInotify:
+    def __init__(self):
+        self.next_wd = 0
+
+    def add_watch(self, path: str) -> int:
+        self.next_wd += 1
+        return self.next_wd
+
+def watch_descriptor(watcher: storage_watcher.StorageWatcher, path) -> int:
+    return next(wd for wd, watched in watcher.watches.items() if watched == str(path))
+
+def test_storage_watcher_changes(tmp_path, monkeypatch):
+    db.reset()
+    real_file_manager = FileManager(db, str(tmp_path / "recycle"))
+    (tmp_path / "recycle").mkdir()
+
+    target_id = db.add_target("watched", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "target"), "$I", False, None, 0, [])
+    backup_ids = [add_files_backup(target_id, tmp_path / "target", {"sub/a.txt": b"0123456789"}) for _ in range(2)]
+
+    watcher = storage_watcher.StorageWatcher(db, real_file_manager, 0)
+    watcher.inotify = FakeInotify()
+    changed = watcher.subscribe()
+    watcher.refresh_roots()
+    # Anything before watching started is unknown
+    assert changed.take() is None
+    assert changed.take() == {}
+
+    listed = []
+    list_backups_target = db.list_backups_target
+    def record_list(target_id: str):
+        listed.append(target_id)
+        return list_backups_target(target_id)
+    monkeypatch.setattr(db, "list_backups_target", record_list)
+
+    # Changed deep inside a backup
+    watcher.handle_events([(watch_descriptor(watcher, tmp_path / "target" / backup_ids[1] / "sub"), storage_watcher.IN_MODIFY, "a.txt")])
+    paths = changed.take()
+    assert list(paths) == [str(tmp_path / "target" / backup_ids[1])]
+    assert watcher.find_backups(paths) == {backup_ids[1]: paths[str(tmp_path / "target" / backup_ids[1])]}
+    # Found in the map made along with the watched locations, without going through every backup
+    assert listed == []
+    assert changed.take() == {}
+
+    # Added since, so the map is made again and the new directory watched
+    new_id = add_files_backup(target_id, tmp_path / "target", {"sub/a.txt": b"0123456789"})
+    watcher.handle_events([(watch_descriptor(watcher, tmp_path / "target"), storage_watcher.IN_CREATE | storage_watcher.IN_ISDIR, new_id)])
+    assert str(tmp_path / "target" / new_id / "sub") in watcher.watches.values()
+    assert list(watcher.find_backups(changed.take())) == [new_id]
+    assert listed == [target_id]
+
+    # Not a backup, the map is only made again once for it
+    for _ in range(2):
+        watcher.handle_events([(watch_descriptor(watcher, tmp_path / "target"), storage_watcher.IN_CREATE, "stray.txt")])
+        assert watcher.find_backups(changed.take()) == {}
+    assert listed == [target_id, target_id]
+
+def test_storage_watcher_unknown(tmp_path):
+    db.reset()
+    real_file_manager = FileManager(db, str(tmp_path / "recycle"))
+    (tmp_path / "recycle").mkdir()
+
+    target_id = db.add_target("watched", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "target"), "$I", False, None, 0, [])
+    backup_ids = [add_files_backup(target_id, tmp_path / "target", {"a.txt": b"0123456789"}) for _ in range(3)]
+
+    watcher = storage_watcher.StorageWatcher(db, real_file_manager, 0)
+    watcher.inotify = FakeInotify()
+    job = scheduled_jobs.BackupFilesizeJob(3600, db, real_file_manager, watcher)
+    watcher.refresh_roots()
+    # Nothing's known before the first run, so everything is measured
+    job.run()
+    assert all(db.get_backup(backup_id).filesize == 10 for backup_id in backup_ids)
+
+    # Only what changed is measured
+    for backup_id in backup_ids:
+        (tmp_path / "target" / backup_id / "b.txt").write_bytes(b"01234")
+    watcher.handle_events([(watch_descriptor(watcher, tmp_path / "target" / backup_ids[0]), storage_watcher.IN_CREATE, "b.txt")])
+    job.run()
+    assert [db.get_backup(backup_id).filesize for backup_id in backup_ids] == [15, 10, 10]
+
+    # Changes were missed, so everything is measured once
+    watcher.handle_events([(-1, storage_watcher.IN_Q_OVERFLOW, "")])
+    job.run()
+    assert [db.get_backup(backup_id).filesize for backup_id in backup_ids] == [15, 15, 15]
+    assert job.changed_paths.take() == {}
+
+    # A location that doesn't exist yet can't be watched, so what changed isn't known until it is
+    other_id = db.add_target("later", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "later"), "later-$I", False, None, 0, [])
+    watcher.refresh_roots()
+    assert job.changed_paths.take() is None
+    assert job.changed_paths.take() is None
+    (tmp_path / "later").mkdir()
+    watcher.refresh_roots()
+    assert str(tmp_path / "later") in watcher.roots
+    assert job.changed_paths.take() is None
+    assert job.changed_paths.take() == {}
+
+    # Same if a watched location goes away
+    watcher.handle_events([(watch_descriptor(watcher, tmp_path / "later"), storage_watcher.IN_IGNORED, "")])
+    assert job.changed_paths.take() is None
+    assert job.changed_paths.take() is None
+
+def test_integrity_check_unreadable(client, tmp_path):
+    db.reset()
+
+    target_id = db.add_target("unreadable", models.BackupType.SINGLE, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path), "$I", False, None, 0, [])
+    backup_id = create_test_backup(target_id)
+    db.set_backup_hash(backup_id, "a" * 64)
+
+    # Its files are nowhere to be found
+    job = scheduled_jobs.IntegrityCheckJob(3600, db, FileManager(db, str(tmp_path / "recycle")), 0, 0, 1, 0, 0)
+    job.verify_backup(db.get_backup(backup_id), throttle.Throttle(0))
+
+    response = client.get(f"/api/backup/{backup_id}/integrity")
+    assert response.get_json()["hash_mismatch"]
+    assert response.get_json()["last_verified_at"] is not None
+    assert response.get_json()["last_full_verified_at"] is None
+
+def test_integrity_check_devices(monkeypatch):
+    db.reset()
+
+    target_id = create_test_target()
+    devices = {}
+    for device in ("a", "a", "a", "b", "b", "b"):
+        devices[create_test_backup(target_id)] = device
+    monkeypatch.setattr(file_manager, "get_backup_device", lambda backup_id: devices[backup_id])
+
+    job = scheduled_jobs.IntegrityCheckJob(3600, db, file_manager, 1000, 0, 2, 0, 0)
+    lock = threading.Lock()
+    active = {"a": 0, "b": 0}
+    most_active = {"a": 0, "b": 0}
+    most_active_total = 0
+    limiters = {}
+    def verify_backup(backup: models.Backup, limiter: throttle.Throttle, full: bool = False):
+        nonlocal most_active_total
+        device = devices[backup.id]
+        with lock:
+            active[device] += 1
+            most_active[device] = max(most_active[device], active[device])
+            most_active_total = max(most_active_total, sum(active.values()))
+            limiters.setdefault(device, set()).add(limiter)
+        time.sleep(0.1)
+        with lock:
+            active[device] -= 1
+    monkeypatch.setattr(job, "verify_backup", verify_backup)
+
+    job.run()
+
+    # Each device is limited to its own workers, while both are checked at the same time
+    assert most_active == {"a": 2, "b": 2}
+    assert most_active_total == 4
+    # And each is throttled on its own
+    assert all(len(device_limiters) == 1 for device_limiters in limiters.values())
+    assert limiters["a"] != limiters["b"]
+    assert all(limiter.rate == 1000 for device_limiters in limiters.values() for limiter in device_limiters)
+
+def test_find_mismatches():
+    big = b"x" * (3 * manifest.CHUNK_SIZE)
+    changed = b"y" * (2 * manifest.CHUNK_SIZE)
+    on_disk = [
+        manifest.ManifestEntry("d/a", len(big), 0, manifest.hash_bytes(big).hexdigest(), chunks=manifest.hash_bytes(big).chunk_digests()),
+        manifest.ManifestEntry("d/b", len(changed), 0, manifest.hash_bytes(changed).hexdigest(), chunks=manifest.hash_bytes(changed).chunk_digests())
+    ]
+
+    # Recorded before chunk digests existed, only the changed file counts as a mismatch
+    recorded = [
+        manifest.ManifestEntry("d/a", len(big), 0, manifest.hash_bytes(big).hexdigest()),
+        manifest.ManifestEntry("d/b", len(changed), 0, "b" * 64)
+    ]
+    assert manifest.find_mismatches(recorded, on_disk) == {"d/b": None}
+
+    # With chunk digests, the changed chunks are found too
+    original = b"y" * manifest.CHUNK_SIZE + b"z" * manifest.CHUNK_SIZE
+    recorded[1] = manifest.ManifestEntry("d/b", len(original), 0, manifest.hash_bytes(original).hexdigest(), chunks=manifest.hash_bytes(original).chunk_digests())
+    assert manifest.find_mismatches(recorded, on_disk) == {"d/b": [1]}
+
+def add_backups_aged(target_id: str, ages: list[datetime.timedelta]) -> list[str]:
+    now = datetime.datetime.now()
+    return [db.add_backup(target_id, False, now - age) for age in ages]
+
+def test_recycle_job_count():
+    db.reset()
+
+    target_id = db.add_target("count", models.BackupType.SINGLE, models.BackupRecycleCriteria.COUNT, 2, models.BackupRecycleAction.RECYCLE, "/var/backups/count", "$I", False, None, 0, [])
+    other_id = db.add_target("other", models.BackupType.SINGLE, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, "/var/backups/other", "other$I", False, None, 0, [])
+    backup_ids = add_backups_aged(target_id, [datetime.timedelta(days=days) for days in (4, 3, 2, 1)])
+    other_ids = add_backups_aged(other_id, [datetime.timedelta(days=days) for days in (4, 3, 2, 1)])
+
+    scheduled_jobs.RecycleJob(3600, db, server_api).run()
+    assert [db.get_backup(backup_id).is_recycled for backup_id in backup_ids] == [True, True, False, False]
+    assert not any(db.get_backup(backup_id).is_recycled for backup_id in other_ids)
+
+    # Recycled backups don't count towards the limit anymore
+    scheduled_jobs.RecycleJob(3600, db, server_api).run()
+    assert [db.get_backup(backup_id).is_recycled for backup_id in backup_ids] == [True, True, False, False]
+
+def test_recycle_job_age():
+    db.reset()
+
+    # Older than 3 days means at least 4 whole days old
+    target_id = db.add_target("age", models.BackupType.SINGLE, models.BackupRecycleCriteria.AGE, 3, models.BackupRecycleAction.DELETE, "/var/backups/age", "$I", False, None, 2, [])
+    backup_ids = add_backups_aged(target_id, [datetime.timedelta(days=10), datetime.timedelta(days=4, minutes=1), datetime.timedelta(days=4, minutes=-1), datetime.timedelta(days=1), datetime.timedelta(0)])
+
+    scheduled_jobs.RecycleJob(3600, db, server_api).run()
+    assert [db.get_backup(backup_id) is not None for backup_id in backup_ids] == [False, False, True, True, True]
+
+    # Exactly on the boundary counts as old enough
+    now = datetime.datetime.now()
+    boundary_id = db.add_backup(target_id, False, now - datetime.timedelta(days=4))
+    assert [backup_id for backup_id, _, _ in db.list_expired_backups(now)] == [boundary_id]
+    assert db.list_expired_backups(now - datetime.timedelta(microseconds=1)) == []
+
+def test_recycle_job_age_min_backups():
+    db.reset()
+
+    # Old enough, but the newest two are always kept
+    target_id = db.add_target("age", models.BackupType.SINGLE, models.BackupRecycleCriteria.AGE, 3, models.BackupRecycleAction.RECYCLE, "/var/backups/age", "$I", False, None, 2, [])
+    backup_ids = add_backups_aged(target_id, [datetime.timedelta(days=days) for days in (10, 9, 8)])
+
+    scheduled_jobs.RecycleJob(3600, db, server_api).run()
+    assert [db.get_backup(backup_id).is_recycled for backup_id in backup_ids] == [True, False, False]
+
+def test_recycle_job_queue_target():
+    db.reset()
+
+    target_id = db.add_target("queued", models.BackupType.SINGLE, models.BackupRecycleCriteria.COUNT, 1, models.BackupRecycleAction.RECYCLE, "/var/backups/queued", "$I", False, None, 0, [])
+    other_id = db.add_target("other", models.BackupType.SINGLE, models.BackupRecycleCriteria.COUNT, 1, models.BackupRecycleAction.RECYCLE, "/var/backups/other", "other$I", False, None, 0, [])
+    backup_ids = add_backups_aged(target_id, [datetime.timedelta(days=2), datetime.timedelta(days=1)])
+    other_ids = add_backups_aged(other_id, [datetime.timedelta(days=2), datetime.timedelta(days=1)])
+
+    job = scheduled_jobs.RecycleJob(3600, db, server_api, 0.2)
+    job.queue_target(target_id)
+    job.queue_target(target_id)
+    # Waits for more uploads before doing anything
+    assert not db.get_backup(backup_ids[0]).is_recycled
+
+    for _ in range(50):
+        if db.get_backup(backup_ids[0]).is_recycled:
+            break
+        time.sleep(0.05)
+    assert [db.get_backup(backup_id).is_recycled for backup_id in backup_ids] == [True, False]
+    # Only the queued target is looked at
+    assert not any(db.get_backup(backup_id).is_recycled for backup_id in other_ids)
+
+def test_negotiate_upload(client):
+    db.reset()
+
+    target_id = create_test_target()
+    backup_id = create_test_backup(target_id)
+    db.set_backup_hash(backup_id, "a" * 64)
+    db.set_backup_manifest(backup_id, [manifest.ManifestEntry("test.txt", 8, 0, "b" * 64)])
+
+    for data in ("[]", '"hash"', "null"):
+        response = client.post(f"/api/target/{target_id}/negotiate", data=data, content_type="application/json")
+        assert response.status_code == 400
+
+    response = client.post(f"/api/target/{target_id}/negotiate", json={"hash": "a" * 64, "digests": ["b" * 64, "c" * 64]})
+    assert response.status_code == 200
+    assert response.get_json()["backup_id"] == backup_id
+    assert response.get_json()["known_digests"] == ["b" * 64]
+
+    response = client.post(f"/api/target/{target_id}/negotiate", json={"digests": ["not a digest"]})
+    assert response.status_code == 400
+
+
+def test_seq_upload_prefill(client, tmp_path):
+    db.reset()
+
+    target_id = db.add_target("prefill", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "target"), "$I", False, None, 0, [])
+    backup_id = create_test_backup(target_id)
+    (tmp_path / "target" / backup_id).mkdir(parents=True)
+    (tmp_path / "target" / backup_id / "a.txt").write_bytes(b"hello")
+    (tmp_path / "target" / backup_id / "b.txt").write_bytes(b"world")
+    db.set_backup_manifest(backup_id, [manifest.ManifestEntry("a.txt", 5, 0, hashlib.sha256(b"hello").hexdigest()), manifest.ManifestEntry("b.txt", 5, 0, hashlib.sha256(b"world").hexdigest())])
+
+    try:
+        config.config["temp_save_path"] = str(tmp_path / "temp")
+        file_list = [{"path": "", "name": "a.txt", "digest": hashlib.sha256(b"hello").hexdigest()}, {"path": "", "name": "b.txt", "digest": hashlib.sha256(b"world").hexdigest()}]
+        response = client.post(f"/api/seq/{target_id}/begin", json={"file_list": file_list, "manual": False})
+        assert response.status_code == 200
+        assert response.get_json()["prefilled"] == 2
+        # Nothing is copied until the upload is finished
+        assert not (tmp_path / "temp").exists()
+
+        # Changed since, so it can't be used and has to be uploaded after all
+        (tmp_path / "target" / backup_id / "b.txt").write_bytes(b"earth")
+        response = client.post(f"/api/seq/{target_id}/finish")
+        assert response.status_code == 409
+        assert (tmp_path / "temp" / f"seq_{target_id}" / "a.txt").read_bytes() == b"hello"
+        response = client.get(f"/api/seq/{target_id}")
+        assert [file["uploaded"] for file in response.get_json()["file_list"]] == [True, False]
+
+        response = client.post(f"/api/seq/{target_id}/upload", data={"name": "b.txt", "path": "", "file": (io.BytesIO(b"world"), "b.txt")}, content_type="multipart/form-data")
+        assert response.status_code == 200
+        response = client.post(f"/api/seq/{target_id}/finish")
+        assert response.status_code == 200
+    finally:
+        config.config["temp_save_path"] = serverconfig.get_server_config(True).get("temp_save_path")
+        seq_upload_manager.delete(target_id)
+
 def test_delete_target_backups(client):
     db.reset()
     
@@ -198,6 +849,126 @@ def test_recycle_bin_clear(client):
     recycle_bin = db.list_recycled_backups()
     assert len(recycle_bin) == 0
 
+def test_target_locks_independent():
+    db.reset()
+    locked_api = serverapi.ServerAPI(db, file_manager)
+
+    target_a = create_test_target()
+    target_b = create_test_target()
+    backup_a = create_test_backup(target_a)
+    backup_b = create_test_backup(target_b)
+
+    done = threading.Event()
+    def delete_a():
+        locked_api.delete_backup(backup_a, False)
+        done.set()
+
+    with locked_api.target_lock(target_a):
+        thread = threading.Thread(target=delete_a)
+        thread.start()
+        # A different target isn't held up by target A being busy
+        locked_api.delete_backup(backup_b, False)
+        assert db.get_backup(backup_b) is None
+        # Target A's own operation waits for it
+        assert not done.wait(0.2)
+        assert db.get_backup(backup_a) is not None
+    thread.join(5)
+    assert done.is_set()
+    assert db.get_backup(backup_a) is None
+
+def test_recycle_bin_clear_lock_order(monkeypatch):
+    db.reset()
+    locked_api = serverapi.ServerAPI(db, file_manager)
+
+    target_ids = [create_test_target() for _ in range(4)]
+    for target_id in target_ids:
+        db.recycle_backup(create_test_backup(target_id), True)
+    other_backup = create_test_backup(target_ids[2])
+
+    taken = []
+    get_lock = locked_api.locks.get
+    def record_get(target_id: str):
+        if threading.current_thread().name == "clear":
+            taken.append(target_id)
+        return get_lock(target_id)
+    monkeypatch.setattr(locked_api.locks, "get", record_get)
+
+    # One target is busy with a delete of its own, which finishes while the recycle bin is being cleared
+    cleared = threading.Event()
+    def clear():
+        locked_api.recycle_bin_clear(False)
+        cleared.set()
+
+    with locked_api.target_lock(target_ids[2]):
+        thread = threading.Thread(target=clear, name="clear")
+        thread.start()
+        assert not cleared.wait(0.2)
+        locked_api.delete_backup(other_backup, False)
+    thread.join(5)
+
+    assert cleared.is_set()
+    assert len(db.list_recycled_backups()) == 0
+    # All at once and in order first, then again for each backup
+    assert taken[:4] == sorted(target_ids)
+
+def add_files_backup(target_id: str, location, files: dict[str, bytes]) -> str:
+    backup_id = create_test_backup(target_id)
+    for name, data in files.items():
+        path = location / backup_id / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    db.set_backup_filesize(backup_id, sum(len(data) for data in files.values()))
+    return backup_id
+
+def test_delete_to_trash(tmp_path):
+    db.reset()
+    real_file_manager = FileManager(db, str(tmp_path / "recycle"))
+    real_server_api = serverapi.ServerAPI(db, real_file_manager)
+
+    target_id = db.add_target("trash", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "target"), "$I", False, None, 0, [])
+    add_files_backup(target_id, tmp_path / "target", {"a.txt": b"0123456789", "sub/b.txt": b"01234"})
+    add_files_backup(target_id, tmp_path / "target", {"c.txt": b"01234"})
+
+    real_server_api.delete_target(target_id, True)
+
+    # Only renamed out of the way, the files are still there for the reaper to remove
+    assert os.listdir(tmp_path / "target") == [".backupchan-trash"]
+    trashed = sorted(os.listdir(tmp_path / "target" / ".backupchan-trash"))
+    assert len(trashed) == 2
+    assert sorted(entry.path for entry in db.list_trash()) == sorted(str(tmp_path / "target" / ".backupchan-trash" / name) for name in trashed)
+    assert sum((tmp_path / "target" / ".backupchan-trash" / name / "sub" / "b.txt").exists() for name in trashed) == 1
+
+    # Clearing the recycle bin goes through the trash of the recycle bin
+    target_id = db.add_target("trash2", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "target2"), "$I", False, None, 0, [])
+    backup_id = add_files_backup(target_id, tmp_path / "target2", {"d.txt": b"0123456789"})
+    real_server_api.recycle_backup(backup_id)
+    real_server_api.recycle_bin_clear(True)
+
+    assert os.listdir(tmp_path / "recycle") == [".backupchan-trash"]
+    assert len(os.listdir(tmp_path / "recycle" / ".backupchan-trash")) == 1
+    assert db.get_backup(backup_id) is None
+
+    assert stats.total_pending_delete_size() == 30
+
+def test_trash_reaper(tmp_path):
+    db.reset()
+    real_file_manager = FileManager(db, str(tmp_path / "recycle"))
+
+    files = {f"{i}.txt": b"0123456789" for i in range(4)} | {f"sub/{i}.txt": b"0123456789" for i in range(2)}
+    target_id = db.add_target("reaper", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "target"), "$I", False, None, 0, [])
+    backup_id = add_files_backup(target_id, tmp_path / "target", files)
+    real_file_manager.delete_backup(backup_id)
+    assert db.get_trash_size() == 60
+
+    start = time.monotonic()
+    scheduled_jobs.TrashReaperJob(60, db, real_file_manager, 20).run()
+    # 6 files at 20 files per second
+    assert time.monotonic() - start >= 0.25
+
+    assert os.listdir(tmp_path / "target") == []
+    assert db.list_trash() == []
+    assert db.get_trash_size() == 0
+
 def test_auth(client):
     db.reset()
     api.auth.key = "kantai_collection"
@@ -226,7 +997,454 @@ def test_stats(client):
     assert "program_version" in data
     assert isinstance(data["program_version"], str)
 
-    fields = ["total_target_size", "total_recycle_bin_size", "total_targets", "total_backups", "total_backups", "total_recycled_backups"]
+    fields = ["total_target_size", "total_recycle_bin_size", "total_pending_delete_size", "total_targets", "total_backups", "total_backups", "total_recycled_backups"]
     for field in fields:
         assert field in data
         assert isinstance(data[field], int)
+
+def test_download_backup_range(client, tmp_path):
+    db.reset()
+
+    target_id = db.add_target("range", models.BackupType.SINGLE, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path), "$I", False, None, 0, [])
+    backup_id = create_test_backup(target_id)
+    db.get_backup(backup_id).hash = "cafe"
+    (tmp_path / f"{backup_id}.txt").write_bytes(b"0123456789")
+
+    response = client.get(f"/api/backup/{backup_id}/download")
+    assert response.status_code == 200
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["ETag"] == '"cafe"'
+    assert response.data == b"0123456789"
+
+    # Resuming with a matching ETag
+    response = client.get(f"/api/backup/{backup_id}/download", headers={"Range": "bytes=4-", "If-Range": '"cafe"'})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 4-9/10"
+    assert response.data == b"456789"
+
+    # The backup changed since, so the whole file is sent again
+    response = client.get(f"/api/backup/{backup_id}/download", headers={"Range": "bytes=4-", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.data == b"0123456789"
+
+def test_download_backup_offload(client, tmp_path):
+    db.reset()
+
+    target_id = db.add_target("offload", models.BackupType.SINGLE, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path), "$I", False, None, 0, [])
+    backup_id = create_test_backup(target_id)
+    db.get_backup(backup_id).hash = "cafe"
+    (tmp_path / f"{backup_id}.txt").write_bytes(b"0123456789")
+
+    try:
+        config.config["download_offload"] = "x-sendfile"
+        response = client.get(f"/api/backup/{backup_id}/download")
+        assert response.status_code == 200
+        assert response.headers["X-Sendfile"] == str(tmp_path / f"{backup_id}.txt")
+        assert response.headers["ETag"] == '"cafe"'
+        assert f"{backup_id}.txt" in response.headers["Content-Disposition"]
+        assert response.data == b""
+
+        config.config["download_offload"] = "x-accel-redirect"
+        config.config["download_offload_locations"] = {str(tmp_path): "/internal/backups/"}
+        response = client.get(f"/api/backup/{backup_id}/download")
+        assert response.status_code == 200
+        assert response.headers["X-Accel-Redirect"] == f"/internal/backups/{backup_id}.txt"
+        assert "X-Sendfile" not in response.headers
+        assert response.data == b""
+
+        # Not covered by any location, so it's sent directly
+        config.config["download_offload_locations"] = {"/somewhere/else": "/internal/else"}
+        response = client.get(f"/api/backup/{backup_id}/download")
+        assert "X-Accel-Redirect" not in response.headers
+        assert response.data == b"0123456789"
+    finally:
+        config.config["download_offload"] = ""
+        config.config["download_offload_locations"] = {}
+
+def test_download_backup_range_uncached(client, tmp_path):
+    db.reset()
+
+    target_id = db.add_target("uncached", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path), "$I", False, None, 0, [])
+    backup_id = create_test_backup(target_id)
+    db.get_backup(backup_id).hash = "cafe"
+    (tmp_path / backup_id).mkdir()
+    (tmp_path / backup_id / "readme.txt").write_bytes(b"hello")
+
+    # The archive is built again for every download, so it can't be resumed
+    response = client.get(f"/api/backup/{backup_id}/download", headers={"Range": "bytes=4-"})
+    assert response.status_code == 200
+    assert response.headers["Accept-Ranges"] == "none"
+    assert "ETag" not in response.headers
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as tar:
+        assert tar.extractfile(f"{backup_id}/readme.txt").read() == b"hello"
+
+def write_archive(data: bytes, built: list | None = None):
+    def build(path: str):
+        if built is not None:
+            built.append(path)
+        with open(path, "wb") as file:
+            file.write(data)
+    return build
+
+def test_download_cache_hit(tmp_path):
+    cache = download_cache.DownloadCache(str(tmp_path), 100)
+    built = []
+
+    path = cache.get("a", "cafe", "tar.xz", write_archive(b"0123456789", built))
+    assert open(path, "rb").read() == b"0123456789"
+    assert cache.get("a", "cafe", "tar.xz", write_archive(b"rebuilt", built)) == path
+    assert open(path, "rb").read() == b"0123456789"
+    assert len(built) == 1
+
+    # A different hash is a different archive
+    cache.get("a", "beef", "tar.xz", write_archive(b"other", built))
+    assert len(built) == 2
+    assert cache.size == 15
+
+def test_download_cache_evict(tmp_path):
+    cache = download_cache.DownloadCache(str(tmp_path), 25)
+
+    path_a = cache.get("a", "cafe", "tar.xz", write_archive(b"0" * 10))
+    path_b = cache.get("b", "cafe", "tar.xz", write_archive(b"1" * 10))
+    # Used more recently than b now
+    cache.get("a", "cafe", "tar.xz", write_archive(b""))
+    path_c = cache.get("c", "cafe", "tar.xz", write_archive(b"2" * 10))
+
+    assert list(cache.entries) == [download_cache.entry_name("a", "cafe", "tar.xz"), download_cache.entry_name("c", "cafe", "tar.xz")]
+    assert cache.size == 20
+    assert os.path.exists(path_a) and os.path.exists(path_c)
+    assert not os.path.exists(path_b)
+
+    # Bigger than the whole budget, still kept until the next one comes in
+    path_d = cache.get("d", "cafe", "tar.xz", write_archive(b"3" * 30))
+    assert list(cache.entries) == [download_cache.entry_name("d", "cafe", "tar.xz")]
+    assert os.path.exists(path_d)
+
+def test_download_cache_invalidate(tmp_path):
+    cache = download_cache.DownloadCache(str(tmp_path), 100)
+
+    path = cache.get("a", "cafe", "tar.xz", write_archive(b"0123456789"))
+    cache.get("b", "cafe", "tar.xz", write_archive(b"0123456789"))
+    cache.invalidate("a")
+    assert list(cache.entries) == [download_cache.entry_name("b", "cafe", "tar.xz")]
+    assert cache.size == 10
+    assert not os.path.exists(path)
+
+    built = []
+    cache.get("a", "cafe", "tar.xz", write_archive(b"0123456789", built))
+    assert len(built) == 1
+
+def test_download_cache_invalidate_building(tmp_path):
+    cache = download_cache.DownloadCache(str(tmp_path), 100)
+    builds = []
+
+    def build(path: str):
+        builds.append(path)
+        if len(builds) == 1:
+            # Recycled while the first build was still going
+            cache.invalidate("a")
+        with open(path, "wb") as file:
+            file.write(f"build {len(builds)}".encode())
+
+    path = cache.get("a", "cafe", "tar.xz", build)
+    assert len(builds) == 2
+    assert open(path, "rb").read() == b"build 2"
+    assert cache.size == 7
+    assert os.listdir(tmp_path) == [download_cache.entry_name("a", "cafe", "tar.xz")]
+
+def test_download_cache_concurrent(tmp_path):
+    cache = download_cache.DownloadCache(str(tmp_path), 100)
+    started = threading.Event()
+    release = threading.Event()
+    built = []
+
+    def build(path: str):
+        built.append(path)
+        started.set()
+        release.wait(5)
+        with open(path, "wb") as file:
+            file.write(b"0123456789")
+
+    paths = []
+    threads = [threading.Thread(target=lambda: paths.append(cache.get("a", "cafe", "tar.xz", build))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    assert started.wait(5)
+    # Give the others a chance to pile up behind the first build
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(built) == 1
+    assert len(paths) == 4 and len(set(paths)) == 1
+    assert cache.size == 10
+
+def make_upload_dir(path, files: dict[str, bytes]) -> str:
+    for name, data in files.items():
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_bytes(data)
+    return str(path)
+
+def test_archive_storage_format(tmp_path):
+    db.reset()
+    real_file_manager = FileManager(db, str(tmp_path / "recycle"))
+    real_server_api = serverapi.ServerAPI(db, real_file_manager)
+    files = {"a.txt": b"0123456789", "sub/b.txt": b"01234"}
+
+    files_target = db.add_target("files", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "files"), "$I", False, None, 0, [])
+    files_id = real_server_api.upload_backup(files_target, False, [make_upload_dir(tmp_path / "upload1" / "data", files)]).backup_id
+    archive_target = db.add_target("archive", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "archive"), "archived-$I", False, None, 0, [])
+    db.set_target_storage_format(archive_target, "archive")
+    archive_id = real_server_api.upload_backup(archive_target, False, [make_upload_dir(tmp_path / "upload2" / "data", files)]).backup_id
+
+    assert os.path.isfile(tmp_path / "archive" / f"archived-{archive_id}.tar")
+    # Stored differently, but the same backup either way
+    assert db.get_backup(archive_id).hash == db.get_backup(files_id).hash
+    assert [entry.path for entry in db.get_backup_manifest(archive_id)] == [entry.path for entry in db.get_backup_manifest(files_id)] == ["data/a.txt", "data/sub/b.txt"]
+
+    for backup_id in (files_id, archive_id):
+        assert [file.path for file in real_file_manager.list_backup_files(backup_id, "")] == ["data"]
+        assert [file.path for file in real_file_manager.list_backup_files(backup_id, "data")] == ["data/sub", "data/a.txt"]
+
+    # Restored through the index
+    assert real_file_manager.copy_backup_file(archive_id, "data/sub/b.txt", str(tmp_path / "restored.txt"), hashlib.sha256(b"01234").hexdigest())
+    assert (tmp_path / "restored.txt").read_bytes() == b"01234"
+
+    with app.test_request_context():
+        response = download.send_backup(db.get_backup(archive_id), db.get_target(archive_target), real_file_manager, config)
+        response.direct_passthrough = False
+        assert response.status_code == 200
+        assert f"archive_{archive_id}.tar" in response.headers["Content-Disposition"]
+        with tarfile.open(fileobj=io.BytesIO(response.get_data())) as tar:
+            assert tar.getnames() == ["data", "data/a.txt", "data/sub", "data/sub/b.txt"]
+            assert tar.extractfile("data/a.txt").read() == b"0123456789"
+
+def test_pack_storage_format(tmp_path):
+    db.reset()
+    real_file_manager = FileManager(db, str(tmp_path / "recycle"), pack_threshold=100)
+    real_server_api = serverapi.ServerAPI(db, real_file_manager)
+    files = {"a.txt": b"0123456789", "sub/b.txt": b"01234", "sub/big.bin": bytes(range(256)) * 4}
+
+    files_target = db.add_target("files", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "files"), "$I", False, None, 0, [])
+    files_id = real_server_api.upload_backup(files_target, False, [make_upload_dir(tmp_path / "upload1" / "data", files)]).backup_id
+    pack_target = db.add_target("pack", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "pack"), "packed-$I", False, None, 0, [])
+    db.set_target_storage_format(pack_target, "pack")
+    pack_id = real_server_api.upload_backup(pack_target, False, [make_upload_dir(tmp_path / "upload2" / "data", files)]).backup_id
+
+    # Small files went into the pack, the big one stayed as it is
+    backup_path = tmp_path / "pack" / f"packed-{pack_id}"
+    assert sorted(os.listdir(backup_path)) == [PACK_FILE_NAME, "data"]
+    assert os.listdir(backup_path / "data") == ["sub"]
+    assert os.listdir(backup_path / "data" / "sub") == ["big.bin"]
+
+    assert db.get_backup(pack_id).hash == db.get_backup(files_id).hash
+    assert real_file_manager.get_backup_hash(pack_id) == db.get_backup(pack_id).hash
+    assert [file.path for file in real_file_manager.list_backup_files(pack_id, "")] == ["data"]
+    assert [file.path for file in real_file_manager.list_backup_files(pack_id, "data")] == ["data/sub", "data/a.txt"]
+    assert [(file.path, file.size) for file in real_file_manager.list_backup_files(pack_id, "data/sub")] == [("data/sub/b.txt", 5), ("data/sub/big.bin", 1024)]
+
+    for path, data in files.items():
+        with real_file_manager.open_backup_file(pack_id, f"data/{path}") as file:
+            assert file.read() == data
+
+    with app.test_request_context():
+        response = download.send_backup(db.get_backup(pack_id), db.get_target(pack_target), real_file_manager, config)
+        response.direct_passthrough = False
+        with tarfile.open(fileobj=io.BytesIO(response.get_data())) as tar:
+            assert sorted(tar.getnames()) == sorted([f"packed-{pack_id}/{name}" for name in ("data", "data/a.txt", "data/sub", "data/sub/b.txt", "data/sub/big.bin")])
+            for path, data in files.items():
+                assert tar.extractfile(f"packed-{pack_id}/data/{path}").read() == data
+
+def test_browse_backup_files(client, tmp_path):
+    db.reset()
+
+    target_id = db.add_target("browse", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path), "$I", False, None, 0, [])
+    backup_id = create_test_backup(target_id)
+    (tmp_path / backup_id / "etc").mkdir(parents=True)
+    (tmp_path / backup_id / "etc" / "app.conf").write_bytes(b"key = value")
+    (tmp_path / backup_id / "readme.txt").write_bytes(b"hello")
+
+    response = client.get(f"/api/backup/{backup_id}/files")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [file["path"] for file in data["files"]] == ["etc", "readme.txt"]
+    assert data["files"][0]["is_dir"]
+    assert data["files"][1]["size"] == 5
+    assert not data["has_more"]
+
+    response = client.get(f"/api/backup/{backup_id}/files?path=etc")
+    assert [file["path"] for file in response.get_json()["files"]] == ["etc/app.conf"]
+
+    response = client.get(f"/api/backup/{backup_id}/files/download?path=etc/app.conf")
+    assert response.status_code == 200
+    assert response.data == b"key = value"
+
+    response = client.get(f"/api/backup/{backup_id}/files/download?path=etc")
+    assert response.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as tar:
+        assert tar.getnames() == ["etc", "etc/app.conf"]
+        assert tar.extractfile("etc/app.conf").read() == b"key = value"
+
+    response = client.get(f"/api/backup/{backup_id}/files?path=../../")
+    assert response.status_code == 400
+
+    response = client.get(f"/api/backup/{backup_id}/files/download?path=nope.txt")
+    assert response.status_code == 404
+
+def test_browse_backup_files_symlinks(client, tmp_path):
+    db.reset()
+
+    target_id = db.add_target("browse", models.BackupType.MULTI, models.BackupRecycleCriteria.NONE, 0, models.BackupRecycleAction.RECYCLE, str(tmp_path / "target"), "$I", False, None, 0, [])
+    backup_id = create_test_backup(target_id)
+    backup_path = tmp_path / "target" / backup_id
+    (backup_path / "etc").mkdir(parents=True)
+    (backup_path / "etc" / "app.conf").write_bytes(b"key = value")
+    (tmp_path / "secret.txt").write_bytes(b"secret")
+    (backup_path / "etc" / "outside.txt").symlink_to(tmp_path / "secret.txt")
+    (backup_path / "etc" / "dangling.txt").symlink_to(backup_path / "nope.txt")
+    (backup_path / "linked").symlink_to(backup_path / "etc")
+
+    # Symlinks are left out, wherever they point
+    response = client.get(f"/api/backup/{backup_id}/files?path=etc")
+    assert response.status_code == 200
+    assert [file["path"] for file in response.get_json()["files"]] == ["etc/app.conf"]
+
+    response = client.get(f"/api/backup/{backup_id}/files")
+    assert [file["path"] for file in response.get_json()["files"]] == ["etc"]
+
+    for path in ("etc/outside.txt", "etc/dangling.txt", "linked/app.conf"):
+        response = client.get(f"/api/backup/{backup_id}/files/download?path={path}")
+        assert response.status_code == 404
+
+    response = client.get(f"/api/backup/{backup_id}/files/download?path=etc")
+    assert response.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as tar:
+        assert tar.getnames() == ["etc", "etc/app.conf"]
+
+def test_diff_backups(client):
+    db.reset()
+
+    target_id = create_test_target()
+    backup_id0 = create_test_backup(target_id)
+    backup_id1 = create_test_backup(target_id)
+    backup_id2 = create_test_backup(target_id)
+    db.set_backup_manifest(backup_id0, [manifest.ManifestEntry("a.txt", 1, 0, "a" * 64), manifest.ManifestEntry("b.txt", 1, 0, "b" * 64), manifest.ManifestEntry("c.txt", 1, 0, "c" * 64)])
+    db.set_backup_manifest(backup_id1, [manifest.ManifestEntry("a.txt", 1, 0, "a" * 64), manifest.ManifestEntry("b.txt", 2, 0, "d" * 64), manifest.ManifestEntry("e.txt", 1, 0, "e" * 64)])
+
+    response = client.get(f"/api/backup/{backup_id0}/diff/{backup_id1}")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["added"] == ["e.txt"]
+    assert data["removed"] == ["c.txt"]
+    assert data["modified"] == ["b.txt"]
+
+    # No manifest recorded
+    response = client.get(f"/api/backup/{backup_id0}/diff/{backup_id2}")
+    assert response.status_code == 409
+
+def test_backup_integrity(client):
+    db.reset()
+
+    target_id = create_test_target()
+    backup_id = create_test_backup(target_id)
+    db.set_backup_hash_mismatch(backup_id, True)
+    db.set_backup_file_mismatches(backup_id, ["etc/hosts", "etc/fstab"], {"etc/hosts": [0, 2], "etc/fstab": None})
+
+    response = client.get(f"/api/backup/{backup_id}/integrity")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["hash_mismatch"]
+    assert data["corrupted_files"] == ["etc/hosts", "etc/fstab"]
+    assert data["corrupted_chunks"] == {"etc/hosts": [0, 2]}
+
+class BlockingJob(scheduled_jobs.ScheduledJob):
+    def __init__(self, name: str, group: str | None):
+        super().__init__(3600, name, name, group)
+        self.release = threading.Event()
+
+    def run(self):
+        self.release.wait(5)
+
+def test_list_scheduled_jobs(client):
+    first = BlockingJob("first", scheduled_jobs.DISK_HEAVY)
+    second = BlockingJob("second", scheduled_jobs.DISK_HEAVY)
+    job_scheduler.add_job(first)
+    job_scheduler.add_job(second)
+    job_scheduler.force_run_job("first")
+    job_scheduler.force_run_job("second")
+    job_scheduler.tick()
+
+    # Jobs of the same group wait for each other
+    response = client.get("/api/jobs")
+    assert response.status_code == 200
+    scheduled = {job["name"]: job for job in response.get_json()["scheduled"]}
+    assert scheduled["first"]["status"] in ("QUEUED", "RUNNING")
+    assert scheduled["second"]["status"] == "QUEUED"
+    assert scheduled["second"]["group"] == scheduled_jobs.DISK_HEAVY
+
+    # Forcing a job that's already running doesn't run it twice at once
+    job_scheduler.force_run_job("first")
+    job_scheduler.tick()
+    assert job_scheduler.dispatched == {"first"}
+
+    first.release.set()
+    second.release.set()
+    for _ in range(50):
+        job_scheduler.tick()
+        if first.last_duration is not None and second.last_duration is not None and not job_scheduler.dispatched:
+            break
+        time.sleep(0.1)
+
+    response = client.get("/api/jobs")
+    scheduled = {job["name"]: job for job in response.get_json()["scheduled"]}
+    assert scheduled["first"]["status"] == "IDLE"
+    assert scheduled["second"]["last_duration"] is not None
+    job_scheduler.jobs = []
+
+def test_scheduled_job_state(client):
+    db.reset()
+
+    now = datetime.datetime.now().replace(microsecond=0)
+    db.set_job_run_state(database.JobRunState("first", now - datetime.timedelta(hours=1), now + datetime.timedelta(minutes=10), 12.5))
+    db.set_job_run_state(database.JobRunState("second", now - datetime.timedelta(days=1), now - datetime.timedelta(hours=1), 1.0))
+    scheduler = scheduled_jobs.JobScheduler(db=db, stagger=600)
+    first = BlockingJob("first", scheduled_jobs.DISK_HEAVY)
+    second = BlockingJob("second", scheduled_jobs.DISK_HEAVY)
+    scheduler.add_job(first)
+    scheduler.add_job(second)
+
+    # Picks up where it left off
+    assert first.next_run == (now + datetime.timedelta(minutes=10)).timestamp()
+    assert first.last_duration == 12.5
+    # Overdue, but kept away from the other disk-heavy job
+    assert second.next_run >= first.next_run + 600
+
+    # State is saved once a job finishes
+    second.release.set()
+    scheduler.force_run_job("second")
+    scheduler.tick()
+    for _ in range(50):
+        if second.last_duration is not None and db.list_job_run_states()["second"].last_duration != 1.0:
+            break
+        time.sleep(0.1)
+    state = db.list_job_run_states()["second"]
+    assert state.last_duration != 1.0
+    assert state.next_run > now
+
+def test_scheduled_job_state_before_first_run(monkeypatch):
+    db.reset()
+
+    scheduler = scheduled_jobs.JobScheduler(db=db)
+    job = BlockingJob("fresh", None)
+    scheduler.add_job(job)
+    assert db.list_job_run_states()["fresh"].next_run.timestamp() == pytest.approx(job.next_run, abs=1)
+
+    # Restarted half an hour later, before it ever ran, it still runs when it was going to
+    started_at = time.time()
+    monkeypatch.setattr(time, "time", lambda: started_at + 1800)
+    restarted_scheduler = scheduled_jobs.JobScheduler(db=db)
+    restarted_job = BlockingJob("fresh", None)
+    restarted_scheduler.add_job(restarted_job)
+    assert restarted_job.next_run == pytest.approx(job.next_run, abs=1)
+    assert restarted_job.last_run is None
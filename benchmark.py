@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+"""
+Compares storage formats of multi-file backups on a generated tree of files.
+Measures how long it takes to store the tree, walk it and read every file back, and how much disk space it takes.
+The tree is read right after being written, so this measures with a warm page cache.
+"""
+
+import file_manager
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from backupchan_server import utility
+
+WORDS = ["backup", "chan", "target", "config", "server", "value", "true", "false", "path", "name", "import", "return", "def", "class", "self", "=", "{", "}"]
+
+def generate_tree(path: str, num_files: int, file_size: int, num_large: int, large_size: int):
+    rng = random.Random(0)
+    for i in range(num_files):
+        directory = utility.join_path(path, f"dir{i % 50}", f"sub{i % 7}")
+        os.makedirs(directory, exist_ok=True)
+        # Text-like contents, compressible like configs and source code are.
+        size = rng.randint(file_size // 2, file_size * 3 // 2)
+        text = []
+        length = 0
+        while length < size:
+            word = rng.choice(WORDS)
+            text.append(word)
+            length += len(word) + 1
+        with open(utility.join_path(directory, f"file{i}.txt"), "w") as file:
+            file.write(" ".join(text)[:size])
+    for i in range(num_large):
+        with open(utility.join_path(path, f"large{i}.bin"), "wb") as file:
+            file.write(rng.randbytes(large_size))
+
+def disk_usage(path: str) -> tuple[int, int]:
+    """
+    Returns bytes allocated on disk and number of inodes used.
+    """
+    allocated = 0
+    inodes = 0
+    for root, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            allocated += os.lstat(utility.join_path(root, name)).st_blocks * 512
+            inodes += 1
+    return allocated, inodes
+
+def timed(function) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+def store_files(source: str, dest: str):
+    shutil.copytree(source, dest)
+    return file_manager.directory_manifest(dest)
+
+def store_pack(source: str, dest: str, threshold: int):
+    shutil.copytree(source, dest)
+    return file_manager.pack_directory(dest, threshold)
+
+def walk_files(path: str) -> int:
+    # Same as FileManager.walk_backup_files, which stats every file.
+    count = 0
+    for root, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            file_manager.stat_backup_file(utility.join_path(root, name), name)
+            count += 1
+    return count
+
+def walk_pack(entries) -> int:
+    # The index of a packed backup comes from the database, so the walk doesn't touch the disk.
+    return sum(1 for _ in file_manager.walk_index(entries, ""))
+
+def restore_files(path: str, entries) -> int:
+    total = 0
+    for entry in entries:
+        with open(utility.join_path(path, entry.path), "rb") as file:
+            total += len(file.read())
+    return total
+
+def restore_pack(path: str, entries) -> int:
+    pack_path = utility.join_path(path, file_manager.PACK_FILE_NAME)
+    total = 0
+    for entry in entries:
+        if entry.offset is None:
+            file = open(utility.join_path(path, entry.path), "rb")
+        else:
+            file = file_manager.open_pack_member(pack_path, entry.offset)
+        with file:
+            total += len(file.read())
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the files and pack storage formats.")
+    parser.add_argument("--files", type=int, default=5000, help="Number of small files to generate.")
+    parser.add_argument("--file-size", type=int, default=4096, help="Average size of small files in bytes.")
+    parser.add_argument("--large", type=int, default=4, help="Number of large files to generate.")
+    parser.add_argument("--large-size", type=int, default=16 * 1024 * 1024, help="Size of large files in bytes.")
+    parser.add_argument("--threshold", type=int, default=file_manager.DEFAULT_PACK_THRESHOLD, help="Pack threshold in bytes.")
+    parser.add_argument("--dir", default=None, help="Directory to run in, a temporary one by default.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="backupchan-benchmark-", dir=args.dir)
+    try:
+        source = utility.join_path(work_dir, "source")
+        print(f"Generating {args.files} small and {args.large} large files in {source}")
+        generate_tree(source, args.files, args.file_size, args.large, args.large_size)
+
+        files_path = utility.join_path(work_dir, "files")
+        pack_path = utility.join_path(work_dir, "pack")
+
+        ingest_files, files_entries = timed(lambda: store_files(source, files_path))
+        ingest_pack, pack_entries = timed(lambda: store_pack(source, pack_path, args.threshold))
+        walk_files_time, _ = timed(lambda: walk_files(files_path))
+        walk_pack_time, _ = timed(lambda: walk_pack(pack_entries))
+        restore_files_time, files_bytes = timed(lambda: restore_files(files_path, files_entries))
+        restore_pack_time, pack_bytes = timed(lambda: restore_pack(pack_path, pack_entries))
+
+        if files_bytes != pack_bytes or [e.digest for e in files_entries] != [e.digest for e in pack_entries]:
+            print("Packed files don't match the originals!")
+
+        files_usage = disk_usage(files_path)
+        pack_usage = disk_usage(pack_path)
+
+        print(f"{'':10}{'files':>14}{'pack':>14}")
+        print(f"{'ingest':10}{ingest_files:>13.3f}s{ingest_pack:>13.3f}s")
+        print(f"{'walk':10}{walk_files_time:>13.3f}s{walk_pack_time:>13.3f}s")
+        print(f"{'restore':10}{restore_files_time:>13.3f}s{restore_pack_time:>13.3f}s")
+        print(f"{'disk':10}{utility.humanread_file_size(files_usage[0]):>14}{utility.humanread_file_size(pack_usage[0]):>14}")
+        print(f"{'inodes':10}{files_usage[1]:>14}{pack_usage[1]:>14}")
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
@@ -11,16 +11,66 @@ import unicodedata
 import threading
 import os
 import sys
+import manifest
 from search_query import SearchQuery
 from datetime import datetime
 from pathlib import Path
+from dataclasses import dataclass
 from backupchan_server import models
 from backupchan_server import nameformat
 from backupchan_server import utility
 
+# Columns of the backups table that make up models.Backup, in order.
+# Everything else in that table is accessed through dedicated methods.
+BACKUP_COLUMNS = "id, target_id, created_at, manual, is_recycled, filesize, hash, hash_mismatch"
+
+# How backups of multi-file targets are kept on disk.
+# "files" extracts them into a directory, "archive" keeps the uploaded archive with an index of its members,
+# "pack" extracts them as well but moves small files into a compressed pack file.
+STORAGE_FORMATS = ["files", "archive", "pack"]
+
 class DatabaseError(Exception):
     pass
 
+def validate_storage_format(storage_format: str, target_type: models.BackupType):
+    if storage_format not in STORAGE_FORMATS:
+        raise DatabaseError(f"Invalid storage format '{storage_format}'")
+    if storage_format != STORAGE_FORMATS[0] and target_type != models.BackupType.MULTI:
+        raise DatabaseError("Storage format can only be set for multi-file targets")
+
+class TargetNotFoundError(DatabaseError):
+    pass
+
+@dataclass
+class TrashEntry:
+    """
+    Files of a deleted backup that were moved out of the way and are waiting to be removed from disk.
+    """
+    id: int
+    path: str
+    size: int
+    created_at: datetime
+
+@dataclass
+class JobRunState:
+    """
+    When a scheduled job last ran and is to run next. Last run and duration are None if it never ran.
+    """
+    name: str
+    last_run: datetime | None
+    next_run: datetime
+    last_duration: float | None
+
+@dataclass
+class BackupRelocation:
+    """
+    Backup that has to be moved because its target's location or name template changed.
+    """
+    backup_id: str
+    target_id: str
+    old_path: str
+    new_path: str
+
 class SortOptions:
     def __init__(self, valid_columns: list[str], default_column: str, asc: bool, column: str | None):
         self.valid_columns = valid_columns
@@ -63,7 +113,7 @@ class Database:
     It does not perform any actual file operations on backups.
     """
 
-    CURRENT_SCHEMA_VERSION = 13
+    CURRENT_SCHEMA_VERSION = 25
 
     def __init__(self, connection_config: dict, page_size: int = 10):
         if connection_config == {}:
@@ -145,7 +195,7 @@ class Database:
         with self.lock:
             target = self.get_target(id)
             if target is None:
-                raise DatabaseError(f"Target with id or alias {id} does not exist")
+                raise TargetNotFoundError(f"Target with id or alias {id} does not exist")
 
             target_id = target.id
             self.validate_target(name, name_template, location, target_id, alias)
@@ -245,6 +295,25 @@ class Database:
 
             self.connection.commit()
 
+    def get_target_storage_format(self, id: str) -> str:
+        with self.lock:
+            self.cursor.execute("SELECT s.storage_format FROM target_storage s JOIN targets t ON t.id = s.target_id WHERE t.id = ? OR t.alias = ?", (id, id))
+            row = self.cursor.fetchone()
+            return STORAGE_FORMATS[0] if row is None else row[0]
+
+    def set_target_storage_format(self, id: str, storage_format: str):
+        """
+        Only affects backups added afterwards.
+        """
+        with self.lock:
+            target = self.get_target(id)
+            if target is None:
+                raise DatabaseError(f"Target with id or alias '{id}' does not exist")
+            validate_storage_format(storage_format, target.target_type)
+
+            self.cursor.execute("INSERT INTO target_storage (target_id, storage_format) VALUES (?, ?) ON DUPLICATE KEY UPDATE storage_format = VALUES(storage_format)", (target.id, storage_format))
+            self.connection.commit()
+
     def validate_target(self, name: str, name_template: str, location: str, target_id: str | None, alias: str | None):
         with self.lock:
             # The name must not be empty.
@@ -294,7 +363,7 @@ class Database:
                 raise DatabaseError(f"Target with id or alias '{target_id}' does not exist")
 
             backup_id = str(uuid.uuid4())
-            self.cursor.execute("INSERT INTO backups VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (backup_id, target.id, created_at, manual, False, 0, "", 0))
+            self.cursor.execute(f"INSERT INTO backups ({BACKUP_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (backup_id, target.id, created_at, manual, False, 0, "", 0))
             self.connection.commit()
 
             self.logger.info("Add backup for target {%s} created at: %s, manual: %s", target.id, str(created_at), str(manual))
@@ -305,22 +374,171 @@ class Database:
             self.cursor.execute("UPDATE backups SET filesize = ? WHERE id = ?", (filesize, backup_id))
             self.connection.commit()
 
+    def set_backup_filesizes(self, sizes: list[tuple[str, int, str | None]]):
+        """
+        Sets size of many backups at once, along with the fingerprint they were computed for. Takes tuples of backup ID, filesize and fingerprint.
+        """
+        if not sizes:
+            return
+        with self.lock:
+            self.cursor.executemany("UPDATE backups SET filesize = ?, size_fingerprint = ? WHERE id = ?", [(filesize, fingerprint, backup_id) for backup_id, filesize, fingerprint in sizes])
+            self.connection.commit()
+
+    def list_backup_size_fingerprints(self, target_id: str) -> dict[str, str | None]:
+        with self.lock:
+            self.cursor.execute("SELECT id, size_fingerprint FROM backups WHERE target_id = ?", (target_id,))
+            return dict(self.cursor.fetchall())
+
     def set_backup_hash(self, backup_id: str, hash: int):
         with self.lock:
             self.cursor.execute("UPDATE backups SET hash = ? WHERE id = ?", (hash, backup_id))
             self.connection.commit()
 
+    def list_duplicate_backups(self, target_id: str) -> list[str]:
+        """
+        Returns IDs of active backups in the target that have the same hash as an older active backup in it.
+        Backups with no hash or a mismatching one are left out.
+        """
+        with self.lock:
+            # Older meaning created earlier, with the ID breaking ties so exactly one backup of each hash is kept.
+            # Recycled backups are on their way out, so they don't count, same as in find_backup_by_hash.
+            self.cursor.execute("SELECT b.id FROM backups b WHERE b.target_id = ? AND b.hash IS NOT NULL AND b.hash != '' AND NOT b.hash_mismatch AND NOT b.is_recycled AND EXISTS (SELECT 1 FROM backups o WHERE o.target_id = b.target_id AND o.hash = b.hash AND NOT o.hash_mismatch AND NOT o.is_recycled AND (o.created_at < b.created_at OR (o.created_at = b.created_at AND o.id < b.id))) ORDER BY b.created_at DESC", (target_id,))
+            return [row[0] for row in self.cursor.fetchall()]
+
+    def find_backup_by_hash(self, target_id: str, hash: str) -> str | None:
+        """
+        Returns ID of the oldest active backup in the target with the given hash, or None if there's none.
+        """
+        with self.lock:
+            self.cursor.execute("SELECT id FROM backups WHERE target_id = ? AND hash = ? AND NOT hash_mismatch AND NOT is_recycled ORDER BY created_at, id LIMIT 1", (target_id, hash))
+            row = self.cursor.fetchone()
+            return None if row is None else row[0]
+
     def set_backup_hash_mismatch(self, backup_id: str, mismatch: bool):
         with self.lock:
             self.cursor.execute("UPDATE backups SET hash_mismatch = ? WHERE id = ?", (mismatch, backup_id))
             self.connection.commit()
 
+    def set_backup_last_verified(self, backup_id: str, verified_at: datetime):
+        with self.lock:
+            self.cursor.execute("UPDATE backups SET last_verified_at = ? WHERE id = ?", (verified_at, backup_id))
+            self.connection.commit()
+
+    def set_backup_last_full_verified(self, backup_id: str, verified_at: datetime):
+        with self.lock:
+            self.cursor.execute("UPDATE backups SET last_full_verified_at = ? WHERE id = ?", (verified_at, backup_id))
+            self.connection.commit()
+
+    def get_backup_last_full_verified(self, backup_id: str) -> None | datetime:
+        """
+        Returns None if the backup was never read as a whole by the integrity check.
+        """
+        with self.lock:
+            self.cursor.execute("SELECT last_full_verified_at FROM backups WHERE id = ?", (backup_id,))
+            row = self.cursor.fetchone()
+            return None if row is None else row[0]
+
+    def get_backup_last_verified(self, backup_id: str) -> None | datetime:
+        """
+        Returns None if the backup was never checked for integrity.
+        """
+        with self.lock:
+            self.cursor.execute("SELECT last_verified_at FROM backups WHERE id = ?", (backup_id,))
+            row = self.cursor.fetchone()
+            return None if row is None else row[0]
+
+    def list_backups_by_verification(self) -> list[tuple[models.Backup, None | datetime]]:
+        """
+        Lists all backups along with when they were last checked for integrity. Ones never checked come first,
+        then the least recently checked ones.
+        """
+        with self.lock:
+            self.cursor.execute(f"SELECT {BACKUP_COLUMNS}, last_verified_at FROM backups ORDER BY last_verified_at IS NOT NULL, last_verified_at, id")
+            return [(models.Backup(*row[:-1]), row[-1]) for row in self.cursor.fetchall()]
+
+    def set_backup_path(self, backup_id: str, path: str):
+        with self.lock:
+            self.cursor.execute("UPDATE backups SET path = ? WHERE id = ?", (path, backup_id))
+            self.connection.commit()
+
+    def get_backup_path(self, backup_id: str) -> None | str:
+        """
+        Path of the backup relative to its target's location, or the recycle bin if it's recycled.
+        Including the extension for single-file backups. None if it wasn't stored yet.
+        """
+        with self.lock:
+            self.cursor.execute("SELECT path FROM backups WHERE id = ?", (backup_id,))
+            row = self.cursor.fetchone()
+            return None if row is None else row[0]
+
+    def set_backup_manifest(self, backup_id: str, entries: list[manifest.ManifestEntry]):
+        with self.lock:
+            self.cursor.execute("DELETE FROM backup_files WHERE backup_id = ?", (backup_id,))
+            if entries:
+                self.cursor.executemany("INSERT INTO backup_files (backup_id, path, size, mtime, digest, data_offset, chunk_digests) VALUES (?, ?, ?, ?, ?, ?, ?)", [(backup_id, entry.path, entry.size, entry.mtime, entry.digest, entry.offset, entry.chunks) for entry in entries])
+            self.cursor.execute("UPDATE backups SET has_manifest = TRUE WHERE id = ?", (backup_id,))
+            self.connection.commit()
+
+    def get_backup_manifest(self, backup_id: str) -> None | list[manifest.ManifestEntry]:
+        """
+        Returns None if no manifest was recorded for the backup.
+        """
+        with self.lock:
+            self.cursor.execute("SELECT has_manifest FROM backups WHERE id = ?", (backup_id,))
+            row = self.cursor.fetchone()
+            if row is None or not row[0]:
+                return None
+            self.cursor.execute("SELECT path, size, mtime, digest, data_offset, chunk_digests FROM backup_files WHERE backup_id = ?", (backup_id,))
+            return [manifest.ManifestEntry(*row) for row in self.cursor.fetchall()]
+
+    def set_backup_file_mismatches(self, backup_id: str, paths: list[str], chunks: dict[str, list[int] | None] | None = None):
+        """
+        Flags the given files of the backup as not matching their recorded digest, and clears the flag on every other file.
+        Chunks has the indexes of the chunks that changed in each file, where they're known.
+        """
+        chunks = chunks or {}
+        with self.lock:
+            self.cursor.execute("UPDATE backup_files SET hash_mismatch = FALSE, mismatched_chunks = NULL WHERE backup_id = ?", (backup_id,))
+            if paths:
+                self.cursor.executemany("UPDATE backup_files SET hash_mismatch = TRUE, mismatched_chunks = ? WHERE backup_id = ? AND path = ?", [(None if chunks.get(path) is None else ",".join(map(str, chunks[path])), backup_id, path) for path in paths])
+            self.connection.commit()
+
+    def get_backup_chunk_mismatches(self, backup_id: str) -> dict[str, list[int]]:
+        """
+        Indexes of the chunks that changed in each mismatching file, for files where that's known.
+        """
+        with self.lock:
+            self.cursor.execute("SELECT path, mismatched_chunks FROM backup_files WHERE backup_id = ? AND hash_mismatch = TRUE AND mismatched_chunks IS NOT NULL ORDER BY path", (backup_id,))
+            return {path: [int(index) for index in indexes.split(",") if index] for path, indexes in self.cursor.fetchall()}
+
+    def find_files_by_digest(self, target_id: str, digests: list[str]) -> dict[str, tuple[str, str]]:
+        """
+        Looks for files with the given digests in backups of the target.
+        Returns backup ID and path of one intact file for every digest that was found.
+        """
+        found = {}
+        with self.lock:
+            digests = list(set(digests))
+            # Looked up in batches to keep the queries a sane size.
+            for start in range(0, len(digests), 1000):
+                batch = digests[start:start + 1000]
+                placeholders = ", ".join("?" * len(batch))
+                self.cursor.execute(f"SELECT f.digest, f.backup_id, f.path FROM backup_files f JOIN backups b ON b.id = f.backup_id WHERE b.target_id = ? AND NOT f.hash_mismatch AND f.digest IN ({placeholders})", (target_id, *batch))
+                for digest, backup_id, path in self.cursor.fetchall():
+                    found.setdefault(digest, (backup_id, path))
+        return found
+
+    def get_backup_file_mismatches(self, backup_id: str) -> list[str]:
+        with self.lock:
+            self.cursor.execute("SELECT path FROM backup_files WHERE backup_id = ? AND hash_mismatch = TRUE ORDER BY path", (backup_id,))
+            return [row[0] for row in self.cursor.fetchall()]
+
     def get_backup(self, id: str) -> None | models.Backup:
         """
         Returns None if the backups wasn't found.
         """
         with self.lock:
-            self.cursor.execute("SELECT * FROM backups WHERE id = ?", (id,))
+            self.cursor.execute(f"SELECT {BACKUP_COLUMNS} FROM backups WHERE id = ?", (id,))
             row = self.cursor.fetchone()
             if row is None:
                 return None
@@ -338,10 +556,37 @@ class Database:
             self.connection.commit()
             self.logger.info("Recycle backup {%s} to %s", id, recycled)
 
+    def delete_backups(self, ids: list[str]):
+        if not ids:
+            return
+        with self.lock:
+            self.cursor.executemany("DELETE FROM backups WHERE id = ?", [(id,) for id in ids])
+            self.connection.commit()
+            self.logger.info("Delete %d backups", len(ids))
+
+    def recycle_backups(self, ids: list[str], recycled: bool):
+        if not ids:
+            return
+        with self.lock:
+            self.cursor.executemany("UPDATE backups SET is_recycled = ? WHERE id = ?", [(recycled, id) for id in ids])
+            self.connection.commit()
+            self.logger.info("Recycle %d backups to %s", len(ids), recycled)
+
+    def list_expired_backups(self, now: datetime, target_id: str | None = None) -> list[tuple[str, str, models.BackupRecycleAction]]:
+        """
+        Returns ID, target ID and recycle action of every active backup that's past its target's recycle criteria,
+        grouped by target and oldest first. The newest min_backups backups of targets recycling by age are always kept.
+        Only looks at the given target if there is one.
+        """
+        with self.lock:
+            # Backups are ranked from the newest one down. Age is in whole days, a backup that's 3.5 days old is 3 days old.
+            self.cursor.execute("SELECT r.id, r.target_id, t.recycle_action FROM (SELECT id, target_id, created_at, ROW_NUMBER() OVER (PARTITION BY target_id ORDER BY created_at DESC, id DESC) AS newer FROM backups WHERE NOT is_recycled AND (? IS NULL OR target_id = ?)) r JOIN targets t ON t.id = r.target_id WHERE (t.recycle_criteria = 'count' AND r.newer > t.recycle_value) OR (t.recycle_criteria = 'age' AND r.newer > t.min_backups AND r.created_at <= ? - INTERVAL (t.recycle_value + 1) DAY) ORDER BY r.target_id, r.created_at, r.id", (target_id, target_id, now))
+            return [(backup_id, target_id, models.BackupRecycleAction(action)) for backup_id, target_id, action in self.cursor.fetchall()]
+
     def list_backups(self, sort_options: None | BackupSortOptions = None) -> list[models.Backup]:
         sort_options = sort_options or BackupSortOptions.default()
         with self.lock:
-            self.cursor.execute(f"SELECT * FROM backups {sort_options.sql()}")
+            self.cursor.execute(f"SELECT {BACKUP_COLUMNS} FROM backups {sort_options.sql()}")
             rows = self.cursor.fetchall()
             return [models.Backup(*row) for row in rows]
 
@@ -352,14 +597,14 @@ class Database:
             if target is None:
                 raise DatabaseError(f"Target with id or alias '{target_id}' does not exist")
 
-            self.cursor.execute(f"SELECT * FROM backups WHERE target_id = ? {sort_options.sql()}", (target.id,))
+            self.cursor.execute(f"SELECT {BACKUP_COLUMNS} FROM backups WHERE target_id = ? {sort_options.sql()}", (target.id,))
             rows = self.cursor.fetchall()
             return [models.Backup(*row) for row in rows]
 
     def list_recycled_backups(self, sort_options: None | BackupSortOptions = None) -> list[models.Backup]:
         sort_options = sort_options or BackupSortOptions.default()
         with self.lock:
-            self.cursor.execute(f"SELECT * FROM backups WHERE is_recycled = TRUE {sort_options.sql()}")
+            self.cursor.execute(f"SELECT {BACKUP_COLUMNS} FROM backups WHERE is_recycled = TRUE {sort_options.sql()}")
             rows = self.cursor.fetchall()
             return [models.Backup(*row) for row in rows]
 
@@ -370,7 +615,7 @@ class Database:
             if target is None:
                 raise DatabaseError(f"Target with id or alias '{target_id}' does not exist")
 
-            self.cursor.execute(f"SELECT * FROM backups WHERE (target_id = ?) AND is_recycled = ? {sort_options.sql()}", (target.id, is_recycled))
+            self.cursor.execute(f"SELECT {BACKUP_COLUMNS} FROM backups WHERE (target_id = ?) AND is_recycled = ? {sort_options.sql()}", (target.id, is_recycled))
             rows = self.cursor.fetchall()
             return [models.Backup(*row) for row in rows]
 
@@ -384,6 +629,100 @@ class Database:
             self.cursor.execute("SELECT COUNT(*) FROM backups WHERE is_recycled = TRUE")
             return self.cursor.fetchone()[0]
 
+    #
+    # Backup relocation methods
+    #
+
+    def add_backup_relocations(self, target_id: str, relocations: list[tuple[str, str, str]]):
+        """
+        Takes (backup ID, old path, new path) tuples. Backups already waiting to be relocated keep their old path,
+        since that's where they still are.
+        """
+        with self.lock:
+            self.cursor.executemany("INSERT INTO backup_relocations (backup_id, target_id, old_path, new_path) VALUES (?, ?, ?, ?) ON DUPLICATE KEY UPDATE new_path = VALUES(new_path)", [(backup_id, target_id, old_path, new_path) for backup_id, old_path, new_path in relocations])
+            self.connection.commit()
+
+    def get_backup_relocation(self, backup_id: str) -> None | BackupRelocation:
+        with self.lock:
+            self.cursor.execute("SELECT backup_id, target_id, old_path, new_path FROM backup_relocations WHERE backup_id = ?", (backup_id,))
+            row = self.cursor.fetchone()
+            if row is None:
+                return None
+            return BackupRelocation(*row)
+
+    def list_backup_relocations(self, target_id: str) -> list[BackupRelocation]:
+        with self.lock:
+            self.cursor.execute("SELECT backup_id, target_id, old_path, new_path FROM backup_relocations WHERE target_id = ?", (target_id,))
+            return [BackupRelocation(*row) for row in self.cursor.fetchall()]
+
+    def list_relocating_targets(self) -> list[str]:
+        with self.lock:
+            self.cursor.execute("SELECT DISTINCT target_id FROM backup_relocations")
+            return [row[0] for row in self.cursor.fetchall()]
+
+    def complete_backup_relocation(self, backup_id: str, moved_to: str, path: str) -> bool:
+        """
+        Called after the backup got moved to moved_to, path being moved_to relative to the backup's base location.
+        The relocation is done and the backup's path updated in one go. If the target was edited again in the meantime,
+        the relocation stays with moved_to as the old path.
+        Returns False if the backup still has to be moved.
+        """
+        with self.lock:
+            self.cursor.execute("DELETE FROM backup_relocations WHERE backup_id = ? AND new_path = ?", (backup_id, moved_to))
+            completed = self.cursor.rowcount > 0
+            self.cursor.execute("UPDATE backup_relocations SET old_path = ? WHERE backup_id = ?", (moved_to, backup_id))
+            self.cursor.execute("DELETE FROM backup_relocations WHERE backup_id = ? AND old_path = new_path", (backup_id,))
+            completed = completed or self.cursor.rowcount > 0
+            if completed:
+                self.cursor.execute("UPDATE backups SET path = ? WHERE id = ?", (path, backup_id))
+            self.connection.commit()
+            return completed
+
+    #
+    # Trash methods
+    #
+
+    def add_trash(self, path: str, size: int) -> int:
+        with self.lock:
+            self.cursor.execute("INSERT INTO trash (path, size, created_at) VALUES (?, ?, ?)", (path, size, datetime.now()))
+            self.connection.commit()
+            return self.cursor.lastrowid
+
+    def list_trash(self, limit: int | None = None) -> list[TrashEntry]:
+        """
+        Oldest first.
+        """
+        with self.lock:
+            if limit is None:
+                self.cursor.execute("SELECT id, path, size, created_at FROM trash ORDER BY id")
+            else:
+                self.cursor.execute("SELECT id, path, size, created_at FROM trash ORDER BY id LIMIT ?", (limit,))
+            return [TrashEntry(*row) for row in self.cursor.fetchall()]
+
+    def delete_trash(self, id: int):
+        with self.lock:
+            self.cursor.execute("DELETE FROM trash WHERE id = ?", (id,))
+            self.connection.commit()
+
+    def get_trash_size(self) -> int:
+        with self.lock:
+            self.cursor.execute("SELECT COALESCE(SUM(size), 0) FROM trash")
+            return int(self.cursor.fetchone()[0])
+
+    #
+    # Scheduled job methods
+    #
+
+    def list_job_run_states(self) -> dict[str, JobRunState]:
+        with self.lock:
+            self.cursor.execute("SELECT name, last_run, next_run, last_duration FROM scheduled_job_state")
+            return {row[0]: JobRunState(*row) for row in self.cursor.fetchall()}
+
+    def set_job_run_state(self, state: JobRunState):
+        with self.lock:
+            self.cursor.execute("INSERT INTO scheduled_job_state (name, last_run, next_run, last_duration) VALUES (?, ?, ?, ?) ON DUPLICATE KEY UPDATE last_run = VALUES(last_run), next_run = VALUES(next_run), last_duration = VALUES(last_duration)", (state.name, state.last_run, state.next_run, state.last_duration))
+            self.connection.commit()
+
     #
     # Miscellaneous
     #
@@ -1,5 +1,6 @@
 from .manager import JobManager, DelayedJob, DelayedJobState
 from .test_job import TestJob
 from .upload_job import UploadJob
+from .relocate_job import RelocateJob
 
-__all__ = ["JobManager", "DelayedJob", "DelayedJobState", "TestJob", "UploadJob"]
+__all__ = ["JobManager", "DelayedJob", "DelayedJobState", "TestJob", "UploadJob", "RelocateJob"]
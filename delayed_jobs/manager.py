@@ -33,6 +33,12 @@ class DelayedJob:
     def run(self):
         raise NotImplementedError()
 
+    def details(self) -> dict:
+        """
+        Job-specific information to show about it, like its result.
+        """
+        return {}
+
     def pretty_start_time(self):
         if self.start_time == 0:
             return "not started yet"
@@ -0,0 +1,57 @@
+import delayed_jobs
+import file_manager
+import throttle
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class RelocateJob(delayed_jobs.DelayedJob):
+    def __init__(self, target_id: str, fm: file_manager.FileManager, workers: int, old_location: str | None = None):
+        """
+        Old location is removed afterwards if it ends up empty. It's not known when resuming after a restart.
+        """
+        super().__init__(__name__.split(".")[-1])
+        self.target_id = target_id
+        self.fm = fm
+        self.workers = workers
+        self.old_location = old_location
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def run(self) -> delayed_jobs.DelayedJobState:
+        relocations = self.fm.db.list_backup_relocations(self.target_id)
+        self.total = len(relocations)
+        self.logger.info("Relocate %d backups of target {%s} with %d workers", self.total, self.target_id, self.workers)
+
+        # Each finished move is recorded in the database right away, so nothing is lost if this gets interrupted.
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as executor:
+            for relocation in relocations:
+                executor.submit(self.relocate, relocation.backup_id)
+
+        if self.old_location is not None and os.path.isdir(self.old_location):
+            # Backups deleted from the old location would otherwise keep it around, and the reaper never comes back here.
+            try:
+                self.fm.empty_trash(self.old_location, throttle.Throttle(0))
+            except OSError as exc:
+                self.logger.error("Unable to empty trash of old location", exc_info=exc)
+            if not any(os.scandir(self.old_location)):
+                self.logger.info("Old location directory empty, removing")
+                os.rmdir(self.old_location)
+
+        self.logger.info("Finished relocating: %d moved, %d failed", self.done, self.failed)
+        return delayed_jobs.DelayedJobState.ERROR if self.failed else delayed_jobs.DelayedJobState.FINISHED
+
+    def relocate(self, backup_id: str):
+        try:
+            self.fm.relocate_backup(backup_id)
+            with self.lock:
+                self.done += 1
+        except Exception as exc:
+            self.logger.error("Unable to relocate backup {%s}", backup_id, exc_info=exc)
+            with self.lock:
+                self.failed += 1
+
+    def __str__(self) -> str:
+        return f"RelocateJob(target_id={self.target_id}, done={self.done}/{self.total})"
@@ -9,11 +9,19 @@ class UploadJob(delayed_jobs.DelayedJob):
         self.manual = manual
         self.filenames = filenames
         self.server_api = server_api
+        self.result: serverapi.UploadResult | None = None
 
     def run(self) -> delayed_jobs.DelayedJobState:
         self.logger.info("Upload backup to target {%s}: manual {%s}, backup files: %s", self.target_id, self.manual, self.filenames)
-        self.server_api.upload_backup(self.target_id, self.manual, self.filenames)
+        self.result = self.server_api.upload_backup(self.target_id, self.manual, self.filenames)
+        if self.result.duplicate_of is not None:
+            self.logger.info("Upload is identical to backup {%s}, not keeping it", self.result.duplicate_of)
         return delayed_jobs.DelayedJobState.FINISHED
 
+    def details(self) -> dict:
+        if self.result is None:
+            return {}
+        return {"backup_id": self.result.backup_id, "duplicate_of": self.result.duplicate_of}
+
     def __str__(self) -> str:
         return f"UploadJob(target_id={self.target_id}, manual={self.manual}, filenames={self.filenames})"
@@ -1,12 +1,202 @@
 import file_manager
+import configtony
+import logging
 import os
+import posixpath
+import tarfile
+import uuid
+import werkzeug.utils
+from pathlib import Path
+from urllib.parse import quote
 from backupchan_server import models, utility
+from flask import Response, request, send_file
 from werkzeug.utils import secure_filename
 
-def get_download_path(backup: models.Backup, target: models.BackupTarget, recycle_bin_path: str, temp_save_path: str, fm: file_manager.FileManager) -> str:
+ARCHIVE_FORMAT = "tar.xz"
+CHUNK_SIZE = 1024 * 1024
+
+# Value of the download_offload option -> header the proxy looks for
+OFFLOAD_HEADERS = {
+    "x-accel-redirect": "X-Accel-Redirect",
+    "x-sendfile": "X-Sendfile"
+}
+
+def get_download_path(backup: models.Backup, target: models.BackupTarget, recycle_bin_path: str, temp_save_path: str, fm: file_manager.FileManager) -> tuple[str, bool]:
+    """
+    Returns path to the file to send, and whether it stays the same between downloads so they can be resumed.
+    """
+    if target.target_type == models.BackupType.SINGLE:
+        return fm.get_backup_path(backup.id), True
+
+    # Backups stored as an archive are sent as they are.
+    stored_archive = fm.get_stored_archive(backup.id)
+    if stored_archive is not None:
+        return stored_archive, True
+
+    # Without a hash there's nothing to tell if the cached archive is still up to date.
+    if fm.download_cache is not None and fm.download_cache.enabled() and backup.hash:
+        return fm.download_cache.get(backup.id, backup.hash, ARCHIVE_FORMAT, lambda path: fm.create_backup_archive(backup.id, path)), True
+
+    # Built for every download. Concurrent downloads each build their own and the last one to finish is left in place,
+    # anyone already sending an earlier build keeps reading it.
+    os.makedirs(temp_save_path, exist_ok=True)
+    file_name = utility.join_path(temp_save_path, secure_filename(f"{target.name}_{backup.id}.{ARCHIVE_FORMAT}"))
+    partial_name = utility.join_path(temp_save_path, f"{uuid.uuid4().hex}.part")
+    try:
+        fm.create_backup_archive(backup.id, partial_name)
+    except Exception:
+        if os.path.exists(partial_name):
+            os.remove(partial_name)
+        raise
+    os.replace(partial_name, file_name)
+    return file_name, False
+
+def get_download_name(backup: models.Backup, target: models.BackupTarget, download_path: str) -> str:
+    """
+    Name of the file as presented to the client.
+    """
     if target.target_type == models.BackupType.SINGLE:
-        return file_manager.find_single_backup_file(file_manager.get_backup_fs_location(backup, target, recycle_bin_path))
-    
-    file_name = utility.join_path(temp_save_path, secure_filename(f"{target.name}_{backup.id}.tar.xz"))
-    fm.create_backup_archive(backup.id, file_name)
-    return file_name
+        return os.path.basename(download_path)
+    if download_path.endswith(tuple(file_manager.STORED_ARCHIVE_EXTENSIONS.values())):
+        return secure_filename(f"{target.name}_{backup.id}{Path(download_path).suffix}")
+    return secure_filename(f"{target.name}_{backup.id}.{ARCHIVE_FORMAT}")
+
+def get_etag(backup: models.Backup, target: models.BackupTarget, download_path: str, stable: bool = True) -> str | bool:
+    """
+    Returns the ETag for the downloaded file, True to let werkzeug generate one from file metadata,
+    or False if the file is built again for every download and there's nothing to tag.
+    """
+    if not stable:
+        return False
+
+    # A mismatching hash no longer describes what's on disk.
+    if not backup.hash or backup.hash_mismatch:
+        return True
+
+    if target.target_type == models.BackupType.SINGLE:
+        return str(backup.hash)
+
+    # The same backup can be archived into different bytes if the cached archive gets evicted and built again,
+    # so the archive's modification time goes into the ETag as well. Otherwise a resumed download could mix two builds.
+    return f"{backup.hash}-{os.stat(download_path).st_mtime_ns}"
+
+def get_offload_location(download_path: str, offload_mode: str, offload_locations: dict) -> str | None:
+    """
+    Returns what to put in the offload header for the file, or None if the proxy can't serve it.
+    X-Sendfile takes the path itself, X-Accel-Redirect takes an internal URI mapped from the path.
+    """
+    path = os.path.abspath(download_path)
+    if offload_mode == "x-sendfile":
+        return path
+
+    for fs_prefix, uri_prefix in offload_locations.items():
+        fs_prefix = os.path.abspath(fs_prefix)
+        if path.startswith(fs_prefix + os.sep):
+            return uri_prefix.rstrip("/") + "/" + quote(os.path.relpath(path, fs_prefix))
+    return None
+
+def send_backup(backup: models.Backup, target: models.BackupTarget, fm: file_manager.FileManager, config: configtony.Config) -> Response:
+    """
+    Sends the backup as an attachment. Range, If-Range and other conditional requests are supported.
+    If download offloading is configured, the reverse proxy is told to send the file instead.
+    """
+    download_path, stable = get_download_path(backup, target, fm.recycle_bin_path, config.get("temp_save_path"), fm)
+
+    offload_mode = config.get("download_offload")
+    if offload_mode in OFFLOAD_HEADERS:
+        offload_location = get_offload_location(download_path, offload_mode, config.get("download_offload_locations"))
+        if offload_location is not None:
+            return send_offloaded(backup, target, download_path, stable, OFFLOAD_HEADERS[offload_mode], offload_location)
+        logging.getLogger(__name__).warning("No offload location configured for '%s', sending it directly", download_path)
+    elif offload_mode:
+        logging.getLogger(__name__).error("Unknown download offload mode '%s', sending file directly", offload_mode)
+
+    response = send_file(
+        download_path,
+        as_attachment=True,
+        download_name=get_download_name(backup, target, download_path),
+        etag=get_etag(backup, target, download_path, stable),
+        # A range of one build would be resumed with the rest of another.
+        conditional=stable
+    )
+    if not stable:
+        response.accept_ranges = "none"
+    return response
+
+def send_offloaded(backup: models.Backup, target: models.BackupTarget, download_path: str, stable: bool, header: str, location: str) -> Response:
+    response = werkzeug.utils.send_file(
+        download_path,
+        request.environ,
+        as_attachment=True,
+        download_name=get_download_name(backup, target, download_path),
+        etag=get_etag(backup, target, download_path, stable),
+        use_x_sendfile=True,
+        # Ranges are handled by the proxy as it's the one sending the bytes.
+        conditional=False
+    )
+    del response.headers["X-Sendfile"]
+    # The body is empty, the proxy fills in the real length.
+    del response.headers["Content-Length"]
+    response.headers[header] = location
+    return response
+
+def send_backup_file(backup: models.Backup, fm: file_manager.FileManager, path: str) -> Response:
+    """
+    Sends a single file from inside a multi-file backup.
+    Directories are sent as an uncompressed tar archive, which is streamed as it's being made.
+    """
+    backup_file = fm.get_backup_file(backup.id, path)
+    name = posixpath.basename(backup_file.path) or backup.id
+
+    if not backup_file.is_dir:
+        response = send_file(fm.open_backup_file(backup.id, backup_file.path), as_attachment=True, download_name=name, last_modified=backup_file.mtime)
+        response.content_length = backup_file.size
+        return response
+
+    # Walked before anything is sent, so a problem with any of the files is still reported as an error response
+    # instead of cutting the archive short.
+    backup_files = list(fm.walk_backup_files(backup.id, backup_file.path))
+    response = Response(iter_tar(fm, backup.id, backup_file.path, name, backup_files), mimetype="application/x-tar")
+    response.headers.set("Content-Disposition", "attachment", filename=secure_filename(f"{name}.tar") or "backup.tar")
+    return response
+
+def iter_tar(fm: file_manager.FileManager, backup_id: str, path: str, top_name: str, backup_files: list[file_manager.BackupFile]):
+    """
+    Yields a tar archive of the given files, which are everything under path in the backup.
+    Only one chunk of a file is held in memory at a time.
+    """
+    written = 0
+    for backup_file in backup_files:
+        rel_path = backup_file.path[len(path):].lstrip("/")
+        info = tarfile.TarInfo(f"{top_name}/{rel_path}" if rel_path else top_name)
+        info.mtime = int(backup_file.mtime)
+        if backup_file.is_dir:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+        else:
+            info.size = backup_file.size
+            info.mode = 0o644
+
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        written += len(header)
+        yield header
+
+        if backup_file.is_dir:
+            continue
+
+        # The size is already in the header, so exactly that many bytes have to follow.
+        remaining = backup_file.size
+        with fm.open_backup_file(backup_id, backup_file.path) as file:
+            while remaining > 0 and (chunk := file.read(min(CHUNK_SIZE, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+        if remaining > 0:
+            yield tarfile.NUL * remaining
+
+        padding = -backup_file.size % tarfile.BLOCKSIZE
+        written += backup_file.size + padding
+        yield tarfile.NUL * padding
+
+    # End of archive marker, then padding up to a full record like tarfile does.
+    written += 2 * tarfile.BLOCKSIZE
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE + (-written % tarfile.RECORDSIZE))
@@ -0,0 +1,143 @@
+"""
+Cache for archives generated when downloading multi-file backups.
+Entries are keyed by backup ID, backup hash and archive format and evicted least recently used first.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable
+from backupchan_server import utility
+
+PARTIAL_SUFFIX = ".part"
+
+def entry_name(backup_id: str, backup_hash: str, archive_format: str) -> str:
+    return f"{backup_id}_{backup_hash}.{archive_format}"
+
+class DownloadCache:
+    def __init__(self, path: str, budget: int):
+        """
+        Budget is the maximum total size of cached archives in bytes. 0 disables the cache.
+        """
+        self.path = path
+        self.budget = budget
+        self.size = 0
+        # Entry name -> size in bytes. Least recently used entry comes first.
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.build_locks: dict[str, threading.Lock] = {}
+        # Backup ID -> how many times it was invalidated. A build that started before an invalidation is thrown away.
+        self.generations: dict[str, int] = {}
+        self.lock = threading.RLock()
+        self.logger = logging.getLogger(__name__)
+
+        if self.enabled():
+            self.load()
+
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    def load(self):
+        """
+        Picks up archives left over from the previous run, using access time to restore LRU order.
+        """
+        if not os.path.isdir(self.path):
+            return
+
+        found = []
+        for entry in os.scandir(self.path):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(PARTIAL_SUFFIX):
+                # Interrupted while building, can't be trusted.
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            found.append((stat.st_atime, entry.name, stat.st_size))
+
+        with self.lock:
+            for _, name, size in sorted(found):
+                self.entries[name] = size
+                self.size += size
+            self.logger.info("Loaded %d cached archives (%s)", len(self.entries), utility.humanread_file_size(self.size))
+            self.evict()
+
+    def get(self, backup_id: str, backup_hash: str, archive_format: str, build: Callable[[str], None]) -> str:
+        """
+        Returns path to the cached archive. If it's not cached yet, build is called with the path to write the archive to.
+        The archive is built again if the backup gets invalidated while it's being built.
+        """
+        name = entry_name(backup_id, backup_hash, archive_format)
+        path = utility.join_path(self.path, name)
+
+        with self.lock:
+            build_lock = self.build_locks.setdefault(name, threading.Lock())
+
+        # Concurrent downloads of the same backup wait for a single build instead of each making their own.
+        with build_lock:
+            with self.lock:
+                if name in self.entries and os.path.isfile(path):
+                    self.entries.move_to_end(name)
+                    # Only bump access time, modification time identifies this particular build of the archive.
+                    os.utime(path, (time.time(), os.path.getmtime(path)))
+                    self.logger.info("Cache hit for backup {%s}", backup_id)
+                    return path
+
+            os.makedirs(self.path, exist_ok=True)
+            partial_path = path + PARTIAL_SUFFIX
+            while True:
+                self.logger.info("Cache miss for backup {%s}, building archive", backup_id)
+                with self.lock:
+                    generation = self.generations.get(backup_id, 0)
+                try:
+                    build(partial_path)
+                except Exception:
+                    if os.path.exists(partial_path):
+                        os.remove(partial_path)
+                    raise
+
+                with self.lock:
+                    if self.generations.get(backup_id, 0) != generation:
+                        # Invalidated while building, what was built may already be out of date.
+                        os.remove(partial_path)
+                        continue
+                    os.replace(partial_path, path)
+                    size = os.path.getsize(path)
+                    self.size -= self.entries.pop(name, 0)
+                    self.entries[name] = size
+                    self.size += size
+                    self.evict(keep=name)
+                    return path
+
+    def evict(self, keep: str | None = None):
+        with self.lock:
+            for name in list(self.entries):
+                if self.size <= self.budget:
+                    break
+                if name == keep:
+                    continue
+                self.remove_entry(name)
+                self.logger.info("Evicted %s from cache", name)
+
+    def invalidate(self, backup_id: str):
+        """
+        Removes every cached archive of the backup.
+        """
+        with self.lock:
+            self.generations[backup_id] = self.generations.get(backup_id, 0) + 1
+            for name in list(self.entries):
+                if name.startswith(f"{backup_id}_"):
+                    self.remove_entry(name)
+                    self.logger.info("Invalidated %s", name)
+
+    def remove_entry(self, name: str):
+        with self.lock:
+            self.size -= self.entries.pop(name)
+            # Kept while held, so downloads waiting on it don't end up building alongside a new one.
+            build_lock = self.build_locks.get(name)
+            if build_lock is not None and not build_lock.locked():
+                del self.build_locks[name]
+            path = utility.join_path(self.path, name)
+            if os.path.exists(path):
+                os.remove(path)
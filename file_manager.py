@@ -1,4 +1,8 @@
 import database
+import download_cache
+import manifest
+import target_locks
+import throttle
 import logging
 import os
 import shutil
@@ -6,42 +10,617 @@ import zipfile
 import tarfile
 import threading
 import hashlib
+import uuid
+import posixpath
+import zlib
+import bz2
+import lzma
+import gzip
+import io
+import datetime
+import struct
+import contextlib
+import math
+import time
+import errno
 from pathlib import Path
+from stat import S_ISDIR, S_ISREG
 from enum import Enum
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator
 from backupchan_server import models, nameformat, utility
 
+# Deleted backups are moved in here first, see FileManager.move_to_trash.
+TRASH_DIR_NAME = ".backupchan-trash"
+# A backup being moved across devices is copied next to its new path, and its old path renamed once the copy is done.
+# See move_backup_files.
+RELOCATING_SUFFIX = ".backupchan-relocating"
+RELOCATED_SUFFIX = ".backupchan-relocated"
+# Changes to a backup seen this many seconds after the server finished changing it are taken to be the server's own.
+SERVER_CHANGE_GRACE = 5
+
 class FileManagerError(Exception):
     pass
 
+class BackupFileNotFoundError(FileManagerError):
+    pass
+
 class BackupUploadMode(Enum):
     DIRECTORY = 0
     ARCHIVE = 1
     SINGLE_FILE = 2
     MULTI_FILE = 3
 
+# Enough to get past the header of any supported format, and to decompress the first tar header out of it.
+ARCHIVE_PROBE_SIZE = 64 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def detect_archive_format(filename: str) -> str | None:
+    """
+    Returns "zip", "tar" or None from the first bytes of the file, without reading the rest of it.
+    Compressed files only count as tar if what's inside starts with a tar header.
+    """
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, "rb") as file:
+        head = file.read(ARCHIVE_PROBE_SIZE)
+
+    if head.startswith((b"PK\x03\x04", b"PK\x05\x06")):
+        return "zip"
+
+    if head.startswith(b"\x1f\x8b"):
+        decompressor = zlib.decompressobj(wbits=31)
+    elif head.startswith(b"BZh"):
+        decompressor = bz2.BZ2Decompressor()
+    elif head.startswith(b"\xfd7zXZ\x00"):
+        decompressor = lzma.LZMADecompressor()
+    else:
+        decompressor = None
+
+    if decompressor is not None:
+        try:
+            head = decompressor.decompress(head, tarfile.BLOCKSIZE)
+        except (zlib.error, OSError, EOFError, lzma.LZMAError):
+            return None
+
+    try:
+        tarfile.TarInfo.frombuf(head[:tarfile.BLOCKSIZE], tarfile.ENCODING, "surrogateescape")
+    except tarfile.HeaderError:
+        return None
+    return "tar"
+
 def is_archive(filename: str) -> bool:
-    return os.path.isfile(filename) and (tarfile.is_tarfile(filename) or zipfile.is_zipfile(filename))
-
-def safe_tar_extract(tar: tarfile.TarFile, path: str):
-    # Validate the file to make sure we don't get any path traversal garbage
-    for member in tar.getmembers():
-        member_path = os.path.join(path, member.name)
-        if not os.path.abspath(member_path).startswith(os.path.abspath(path)):
-            raise FileManagerError("Path traversal detected in tar file")
-    tar.extractall(path)
-
-def extract_archive(fs_location: str, filename: str):
-    suffixes = Path(filename).suffixes
-    if zipfile.is_zipfile(filename):
-        with zipfile.ZipFile(filename, "r") as zip_file:
-            zip_file.extractall(fs_location)
-        return
-    elif tarfile.is_tarfile(filename):
-        with tarfile.open(filename, "r:*") as tar_file:
-            safe_tar_extract(tar_file, fs_location)
-        return
+    return detect_archive_format(filename) is not None
+
+def normalize_member_path(name: str) -> str:
+    """
+    Validates path of an archive member, returns it relative to the extraction root. Empty for the root itself.
+    """
+    path = posixpath.normpath(name.replace("\\", "/"))
+    if path.startswith("/") or path == ".." or path.startswith("../"):
+        raise FileManagerError(f"Path traversal detected in archive member '{name}'")
+    return "" if path == "." else path
+
+def write_member(stream: BinaryIO, fs_path: str, path: str) -> manifest.ManifestEntry:
+    """
+    Copies an archive member to disk, hashing it along the way.
+    """
+    os.makedirs(os.path.dirname(fs_path), exist_ok=True)
+    hasher = manifest.Hasher()
+    size = 0
+    with open(fs_path, "wb") as file:
+        while chunk := stream.read(COPY_CHUNK_SIZE):
+            hasher.update(chunk)
+            file.write(chunk)
+            size += len(chunk)
+    return manifest.ManifestEntry(path, size, os.stat(fs_path).st_mtime, hasher.hexdigest(), chunks=hasher.chunk_digests())
+
+def is_inside(path: str, root: str) -> bool:
+    """
+    Whether the path is the root or in it, after resolving symlinks.
+    """
+    real_root = os.path.realpath(root)
+    real_path = os.path.realpath(path)
+    return real_path == real_root or real_path.startswith(real_root + os.sep)
+
+def extract_tar(fs_location: str, filename: str) -> list[manifest.ManifestEntry] | None:
+    entries = {}
+    # Links are made only once everything else is written, so nothing is ever written through one. A link checked
+    # on its own can still end up pointing elsewhere once the links after it exist, so they're all checked again then.
+    symlinks = {}
+    hardlinks = {}
+    # Streaming mode reads the archive front to back once, decompressing it as it goes.
+    with tarfile.open(filename, "r|*") as tar_file:
+        for member in tar_file:
+            path = normalize_member_path(member.name)
+            fs_path = utility.join_path(fs_location, path) if path else fs_location
+            # A later member replaces an earlier one at the same path.
+            symlinks.pop(path, None)
+            hardlinks.pop(path, None)
+            if member.isdir():
+                os.makedirs(fs_path, exist_ok=True)
+            elif member.isfile():
+                entry = write_member(tar_file.extractfile(member), fs_path, path)
+                os.chmod(fs_path, member.mode & 0o777)
+                os.utime(fs_path, (member.mtime, member.mtime))
+                entry.mtime = member.mtime
+                entries[path] = entry
+            elif member.issym():
+                symlinks[path] = member.linkname
+                entries.pop(path, None)
+            elif member.islnk():
+                hardlinks[path] = normalize_member_path(member.linkname)
+                entries.pop(path, None)
+            # Device files and FIFOs have no business being in a backup.
+
+    # Hard links first, while no symlink can redirect them.
+    for path, link_target in hardlinks.items():
+        if link_target in symlinks:
+            # Linking to a symlink makes another symlink with the same target.
+            symlinks[path] = symlinks[link_target]
+            continue
+        fs_path = utility.join_path(fs_location, path)
+        remove_path(fs_path)
+        os.makedirs(os.path.dirname(fs_path), exist_ok=True)
+        os.link(utility.join_path(fs_location, link_target), fs_path, follow_symlinks=False)
+    for path, link_target in symlinks.items():
+        fs_path = utility.join_path(fs_location, path)
+        if not is_inside(os.path.dirname(fs_path), fs_location):
+            raise FileManagerError(f"Link '{path}' is inside a link pointing outside of the archive")
+        remove_path(fs_path)
+        os.makedirs(os.path.dirname(fs_path), exist_ok=True)
+        os.symlink(link_target, fs_path)
+    for path in symlinks:
+        if not is_inside(utility.join_path(fs_location, path), fs_location):
+            raise FileManagerError(f"Link '{path}' points outside of the archive")
+
+    # Links don't show up in the manifest the same way as regular files, walking the result takes care of them.
+    if symlinks or hardlinks:
+        return None
+    return sorted(entries.values(), key=manifest.sort_key)
+
+def remove_path(fs_path: str):
+    """
+    Removes whatever is at the path, be it a file, a link or a directory.
+    """
+    if os.path.islink(fs_path) or os.path.isfile(fs_path):
+        os.remove(fs_path)
+    elif os.path.isdir(fs_path):
+        shutil.rmtree(fs_path)
+
+def move_backup_files(old_path: str, new_path: str):
+    """
+    Moves a backup from old_path to new_path. If this got interrupted before, it picks up where it left off.
+    Within a device it's a single rename. Across devices, the old path stays untouched until the copy is complete,
+    so while it's there it's always the whole backup and anything at the new path can be thrown away.
+    """
+    copy_path = new_path + RELOCATING_SUFFIX
+    moved_path = old_path + RELOCATED_SUFFIX
+
+    if os.path.lexists(old_path):
+        for leftover in (new_path, copy_path):
+            if os.path.lexists(leftover):
+                remove_path(leftover)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        try:
+            os.rename(old_path, new_path)
+            return
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+        if os.path.isdir(old_path) and not os.path.islink(old_path):
+            shutil.copytree(old_path, copy_path, symlinks=True)
+        else:
+            shutil.copy2(old_path, copy_path, follow_symlinks=False)
+        os.rename(old_path, moved_path)
+
+    if os.path.lexists(copy_path):
+        os.rename(copy_path, new_path)
+    if not os.path.lexists(new_path):
+        raise FileManagerError(f"Backup is neither at {old_path} nor at {new_path}")
+    if os.path.lexists(moved_path):
+        remove_path(moved_path)
+
+def extract_zip(fs_location: str, filename: str) -> list[manifest.ManifestEntry]:
+    entries = {}
+    with zipfile.ZipFile(filename, "r") as zip_file:
+        for info in zip_file.infolist():
+            path = normalize_member_path(info.filename)
+            fs_path = utility.join_path(fs_location, path) if path else fs_location
+            if info.is_dir():
+                os.makedirs(fs_path, exist_ok=True)
+                continue
+            with zip_file.open(info) as stream:
+                entries[path] = write_member(stream, fs_path, path)
+    return sorted(entries.values(), key=manifest.sort_key)
+
+def extract_archive(fs_location: str, filename: str) -> list[manifest.ManifestEntry] | None:
+    """
+    Extracts the archive in one pass and returns the manifest of what was extracted,
+    or None if it has to be built by walking fs_location.
+    """
+    archive_format = detect_archive_format(filename)
+    if archive_format == "zip":
+        return extract_zip(fs_location, filename)
+    elif archive_format == "tar":
+        return extract_tar(fs_location, filename)
     raise FileManagerError("Unsupported archive format")
 
+@dataclass
+class BackupFile:
+    """
+    File or directory inside a multi-file backup.
+    Path is relative to the root of the backup and uses forward slashes. The root itself is an empty string.
+    """
+    path: str
+    is_dir: bool
+    size: int
+    mtime: float
+
+def normalize_backup_file_path(path: str) -> str:
+    """
+    Validates a path inside a backup, returns it without leading, trailing and repeated slashes.
+    """
+    if not utility.is_valid_path(path, True):
+        raise FileManagerError(f"Invalid path '{path}'")
+
+    parts = []
+    for part in path.split("/"):
+        if part in ("", "."):
+            continue
+        if part == "..":
+            raise FileManagerError("Path must not point outside of the backup")
+        parts.append(part)
+    return "/".join(parts)
+
+def stat_backup_file(fs_path: str, path: str) -> BackupFile | None:
+    """
+    Returns None for anything that's not a regular file or a directory. Symlinks aren't followed, they can point
+    anywhere and nothing outside of the backup may be served from it.
+    """
+    stat = os.lstat(fs_path)
+    is_dir = S_ISDIR(stat.st_mode)
+    if not is_dir and not S_ISREG(stat.st_mode):
+        return None
+    return BackupFile(path, is_dir, 0 if is_dir else stat.st_size, stat.st_mtime)
+
+#
+# Archive storage
+#
+# Multi-file targets with the "archive" storage format keep every backup as a single uncompressed tar or zip file,
+# with the position of each member recorded in the manifest. Compressed tars are decompressed once when stored,
+# so members can be read straight from their offset.
+#
+
+STORED_ARCHIVE_EXTENSIONS = {"tar": ".tar", "zip": ".zip"}
+# Extensions of compressed tars, which Path.suffix would cut down to the compression alone.
+COMPRESSED_TAR_EXTENSIONS = (".tar.gz", ".tar.bz2", ".tar.xz")
+
+def get_file_extension(filename: str) -> str:
+    """
+    Returns the extension of the file, keeping the known multi-part extensions whole.
+    """
+    for extension in COMPRESSED_TAR_EXTENSIONS + tuple(STORED_ARCHIVE_EXTENSIONS.values()):
+        if filename.endswith(extension):
+            return extension
+    return Path(filename).suffix
+
+def get_compression(filename: str):
+    """
+    Returns the module to decompress the file with, or None if it's not compressed.
+    """
+    with open(filename, "rb") as file:
+        head = file.read(6)
+    if head.startswith(b"\x1f\x8b"):
+        return gzip
+    elif head.startswith(b"BZh"):
+        return bz2
+    elif head.startswith(b"\xfd7zXZ\x00"):
+        return lzma
+    return None
+
+def hash_stream(stream: BinaryIO, limiter: throttle.Throttle | None = None) -> manifest.Hasher:
+    hasher = manifest.Hasher()
+    while chunk := stream.read(COPY_CHUNK_SIZE):
+        hasher.update(chunk)
+        if limiter is not None:
+            limiter.tick(len(chunk))
+    return hasher
+
+def index_tar(path: str, limiter: throttle.Throttle | None = None) -> list[manifest.ManifestEntry]:
+    entries = {}
+    with tarfile.open(path, "r:") as tar_file:
+        for member in tar_file:
+            if not member.isfile():
+                continue
+            member_path = normalize_member_path(member.name)
+            hasher = hash_stream(tar_file.extractfile(member), limiter)
+            entries[member_path] = manifest.ManifestEntry(member_path, member.size, member.mtime, hasher.hexdigest(), member.offset_data, hasher.chunk_digests())
+    return sorted(entries.values(), key=manifest.sort_key)
+
+def index_zip(path: str, limiter: throttle.Throttle | None = None) -> list[manifest.ManifestEntry]:
+    entries = {}
+    with zipfile.ZipFile(path, "r") as zip_file:
+        for info in zip_file.infolist():
+            if info.is_dir():
+                continue
+            member_path = normalize_member_path(info.filename)
+            with zip_file.open(info) as stream:
+                hasher = hash_stream(stream, limiter)
+            # Zip members are looked up by name, offset is of no use.
+            entries[member_path] = manifest.ManifestEntry(member_path, info.file_size, datetime.datetime(*info.date_time).timestamp(), hasher.hexdigest(), chunks=hasher.chunk_digests())
+    return sorted(entries.values(), key=manifest.sort_key)
+
+def index_archive(path: str, limiter: throttle.Throttle | None = None) -> list[manifest.ManifestEntry]:
+    if path.endswith(STORED_ARCHIVE_EXTENSIONS["zip"]):
+        return index_zip(path, limiter)
+    return index_tar(path, limiter)
+
+def pack_tar(dest: str, filenames: list[str]):
+    """
+    Packs uploaded files into an uncompressed tar. Laid out the same as when they're stored as files,
+    so a directory keeps its name and its contents go under it.
+    """
+    with tarfile.open(dest, "w") as tar_file:
+        for filename in filenames:
+            tar_file.add(filename, arcname=os.path.basename(os.path.normpath(filename)))
+
+class ArchiveMemberFile(io.RawIOBase):
+    """
+    Read-only view of a member's data inside a stored tar.
+    """
+    def __init__(self, path: str, offset: int, size: int):
+        self.file = open(path, "rb")
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, min(offset, self.size))
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+        self.file.seek(self.offset + self.position)
+        read = self.file.readinto(memoryview(buffer)[:length])
+        self.position += read
+        return read
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+def open_zip_member(path: str, member_path: str) -> BinaryIO:
+    zip_file = zipfile.ZipFile(path, "r")
+    for info in zip_file.infolist():
+        if not info.is_dir() and normalize_member_path(info.filename) == member_path:
+            # The member keeps the archive open until it's closed itself.
+            return zip_file.open(info)
+    zip_file.close()
+    raise BackupFileNotFoundError(f"'{member_path}' does not exist in {path}")
+
+def list_index(entries: list[manifest.ManifestEntry], path: str) -> list[BackupFile]:
+    """
+    Direct children of a directory in an archive index. Directories only exist implicitly as prefixes of file paths.
+    """
+    prefix = f"{path}/" if path else ""
+    files = {}
+    for entry in entries:
+        if not entry.path.startswith(prefix):
+            continue
+        name, _, rest = entry.path[len(prefix):].partition("/")
+        child_path = prefix + name
+        if rest:
+            directory = files.get(child_path)
+            mtime = max(directory.mtime, entry.mtime) if directory is not None else entry.mtime
+            files[child_path] = BackupFile(child_path, True, 0, mtime)
+        else:
+            files[child_path] = BackupFile(child_path, False, entry.size, entry.mtime)
+    return sorted(files.values(), key=lambda f: (not f.is_dir, f.path))
+
+def stat_index(entries: list[manifest.ManifestEntry], path: str) -> BackupFile | None:
+    if not path:
+        return BackupFile("", True, 0, max((entry.mtime for entry in entries), default=0))
+    children = []
+    for entry in entries:
+        if entry.path == path:
+            return BackupFile(path, False, entry.size, entry.mtime)
+        if entry.path.startswith(path + "/"):
+            children.append(entry)
+    if not children:
+        return None
+    return BackupFile(path, True, 0, max(entry.mtime for entry in children))
+
+def walk_index(entries: list[manifest.ManifestEntry], path: str) -> Iterator[BackupFile]:
+    """
+    Yields everything under a directory in an archive index, in the same order as walking the directory:
+    contents of a directory, then of each of its subdirectories. The tree is built in one pass over the index.
+    """
+    prefix = f"{path}/" if path else ""
+    children: dict[str, dict[str, BackupFile]] = {}
+    for entry in entries:
+        if not entry.path.startswith(prefix):
+            continue
+        parent = path
+        parts = entry.path[len(prefix):].split("/")
+        for name in parts[:-1]:
+            child_path = f"{parent}/{name}" if parent else name
+            siblings = children.setdefault(parent, {})
+            directory = siblings.get(child_path)
+            siblings[child_path] = BackupFile(child_path, True, 0, entry.mtime if directory is None else max(directory.mtime, entry.mtime))
+            parent = child_path
+        child_path = f"{parent}/{parts[-1]}" if parent else parts[-1]
+        children.setdefault(parent, {})[child_path] = BackupFile(child_path, False, entry.size, entry.mtime)
+
+    def walk(dir_path: str) -> Iterator[BackupFile]:
+        listed = sorted(children.get(dir_path, {}).values(), key=lambda f: (not f.is_dir, f.path))
+        yield from listed
+        for child in listed:
+            if child.is_dir:
+                yield from walk(child.path)
+
+    yield from walk(path)
+
+#
+# Pack storage
+#
+# Multi-file targets with the "pack" storage format keep backups as a directory, like "files" does, except that
+# files smaller than the pack threshold are moved into a pack file at its root. Every file in the pack is compressed
+# on its own, so reading one only needs the record at its offset. Large files stay where they are.
+#
+# The pack file is a magic string followed by records, each made of a header, the file's path and its data.
+#
+
+PACK_FILE_NAME = ".backupchan-pack"
+PACK_MAGIC = b"BCHPACK1"
+# Flags, path length, mtime, size, stored size
+PACK_HEADER = struct.Struct("<BHdQQ")
+PACK_COMPRESSED = 1
+DEFAULT_PACK_THRESHOLD = 64 * 1024
+
+def is_pack_directory(path: str) -> bool:
+    pack_path = utility.join_path(path, PACK_FILE_NAME)
+    if not os.path.isfile(pack_path) or os.path.islink(pack_path):
+        return False
+    with open(pack_path, "rb") as pack_file:
+        return pack_file.read(len(PACK_MAGIC)) == PACK_MAGIC
+
+def write_pack_record(pack_file: BinaryIO, path: str, mtime: float, data: bytes):
+    stored = zlib.compress(data)
+    flags = PACK_COMPRESSED
+    # Not worth decompressing if it didn't get any smaller.
+    if len(stored) >= len(data):
+        stored = data
+        flags = 0
+    path_bytes = os.fsencode(path)
+    pack_file.write(PACK_HEADER.pack(flags, len(path_bytes), mtime, len(data), len(stored)))
+    pack_file.write(path_bytes)
+    pack_file.write(stored)
+
+def read_pack_record(pack_file: BinaryIO) -> tuple[str, float, bytes] | None:
+    """
+    Reads the record at the current position, returns its path, mtime and data. None at the end of the pack.
+    """
+    header = pack_file.read(PACK_HEADER.size)
+    if not header:
+        return None
+    if len(header) != PACK_HEADER.size:
+        raise FileManagerError("Pack file is truncated")
+    flags, path_length, mtime, size, stored_size = PACK_HEADER.unpack(header)
+    path = os.fsdecode(pack_file.read(path_length))
+    data = pack_file.read(stored_size)
+    if flags & PACK_COMPRESSED:
+        data = zlib.decompress(data)
+    if len(data) != size:
+        raise FileManagerError(f"Pack record of '{path}' is corrupt")
+    return path, mtime, data
+
+def index_pack(pack_path: str, limiter: throttle.Throttle | None = None) -> list[manifest.ManifestEntry]:
+    entries = []
+    with open(pack_path, "rb") as pack_file:
+        if pack_file.read(len(PACK_MAGIC)) != PACK_MAGIC:
+            raise FileManagerError(f"{pack_path} is not a pack file")
+        while True:
+            offset = pack_file.tell()
+            record = read_pack_record(pack_file)
+            if record is None:
+                break
+            path, mtime, data = record
+            if limiter is not None:
+                limiter.tick(pack_file.tell() - offset)
+            hasher = manifest.hash_bytes(data)
+            entries.append(manifest.ManifestEntry(path, len(data), mtime, hasher.hexdigest(), offset, hasher.chunk_digests()))
+    return entries
+
+def pack_manifest(path: str, limiter: throttle.Throttle | None = None) -> list[manifest.ManifestEntry]:
+    """
+    Manifest of a packed backup directory. Packed files have the offset of their record, the others have none.
+    """
+    entries = index_pack(utility.join_path(path, PACK_FILE_NAME), limiter)
+    entries += [entry for entry in directory_manifest(path, limiter) if entry.path != PACK_FILE_NAME]
+    entries.sort(key=manifest.sort_key)
+    return entries
+
+def open_pack_member(pack_path: str, offset: int) -> BinaryIO:
+    # Packed files are small, so they're decompressed in one go.
+    with open(pack_path, "rb") as pack_file:
+        pack_file.seek(offset)
+        record = read_pack_record(pack_file)
+    if record is None:
+        raise FileManagerError(f"No pack record at offset {offset} of {pack_path}")
+    return io.BytesIO(record[2])
+
+def pack_directory(path: str, threshold: int, entries: list[manifest.ManifestEntry] | None = None) -> list[manifest.ManifestEntry]:
+    """
+    Moves files smaller than threshold into a pack file in the directory and returns the manifest of the result.
+    Entries is the manifest of the directory if it's already known, so the files that stay don't get hashed again.
+    """
+    pack_path = utility.join_path(path, PACK_FILE_NAME)
+    if os.path.lexists(pack_path):
+        # The upload has a file of that name itself, it's left as plain files then.
+        return entries if entries is not None else directory_manifest(path)
+
+    known = {entry.path: entry for entry in entries or []}
+    result = []
+    packed = []
+    temp_path = utility.join_path(path, f"{PACK_FILE_NAME}.tmp-{uuid.uuid4()}")
+    try:
+        with open(temp_path, "wb") as pack_file:
+            pack_file.write(PACK_MAGIC)
+            for root, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    filepath = utility.join_path(root, filename)
+                    if filepath == temp_path or not os.path.isfile(filepath):
+                        continue
+                    relpath = os.path.relpath(filepath, path).replace(os.sep, "/")
+                    stat = os.stat(filepath)
+                    if os.path.islink(filepath) or stat.st_size >= threshold:
+                        entry = known.get(relpath)
+                        result.append(entry if entry is not None else file_entry(filepath, relpath))
+                        continue
+
+                    with open(filepath, "rb") as file:
+                        data = file.read()
+                    hasher = manifest.hash_bytes(data)
+                    result.append(manifest.ManifestEntry(relpath, len(data), stat.st_mtime, hasher.hexdigest(), pack_file.tell(), hasher.chunk_digests()))
+                    write_pack_record(pack_file, relpath, stat.st_mtime, data)
+                    packed.append(filepath)
+            pack_file.flush()
+            os.fsync(pack_file.fileno())
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    if not packed:
+        os.remove(temp_path)
+        return sorted(result, key=manifest.sort_key)
+
+    # Files are only removed once the pack holding them is in place.
+    os.rename(temp_path, pack_path)
+    for filepath in packed:
+        os.remove(filepath)
+    for root, dirnames, filenames in os.walk(path, topdown=False):
+        if root != path and not os.path.islink(root) and not any(os.scandir(root)):
+            os.rmdir(root)
+
+    return sorted(result, key=manifest.sort_key)
+
 def get_fs_location(location: str, name_template: str, backup_id: str, backup_creation_str: str, manual: bool) -> str:
     return utility.join_path(location, nameformat.parse(name_template, backup_id, backup_creation_str, manual))
 
@@ -86,15 +665,67 @@ def directory_hash(path: str) -> str:
             h.update(file_hash(filepath).encode())
     return h.hexdigest()
 
+def file_entry(fs_path: str, path: str, limiter: throttle.Throttle | None = None) -> manifest.ManifestEntry:
+    stat = os.stat(fs_path)
+    with open(fs_path, "rb") as file:
+        hasher = hash_stream(file, limiter)
+    return manifest.ManifestEntry(path, stat.st_size, stat.st_mtime, hasher.hexdigest(), chunks=hasher.chunk_digests())
+
+def directory_manifest(path: str, limiter: throttle.Throttle | None = None) -> list[manifest.ManifestEntry]:
+    entries = []
+    for root, _, files in os.walk(path):
+        for filename in files:
+            filepath = utility.join_path(root, filename)
+            if not os.path.isfile(filepath):
+                continue
+            relpath = os.path.relpath(filepath, path).replace(os.sep, "/")
+            entries.append(file_entry(filepath, relpath, limiter))
+    entries.sort(key=manifest.sort_key)
+    return entries
+
+def file_manifest(path: str, limiter: throttle.Throttle | None = None) -> list[manifest.ManifestEntry]:
+    return [file_entry(path, os.path.basename(path), limiter)]
+
 class FileManager:
-    def __init__(self, db: database.Database, recycle_bin_path: str):
+    def __init__(self, db: database.Database, recycle_bin_path: str, download_cache: download_cache.DownloadCache | None = None, pack_threshold: int = DEFAULT_PACK_THRESHOLD):
         self.db = db
         self.recycle_bin_path = recycle_bin_path
-        self.lock = threading.RLock()
+        self.download_cache = download_cache
+        self.pack_threshold = pack_threshold
+        self.locks = target_locks.TargetLocks()
+        self.trash_lock = threading.Lock()
+        # Keyed by backup ID rather than target ID. Held while the backup is being added, moved or read as a whole,
+        # so reading it doesn't have to hold up everything else on the target.
+        self.backup_move_locks = target_locks.TargetLocks()
+        # When the server last changed each backup on disk, infinity while it's doing so.
+        self.changed_at: dict[str, float] = {}
         self.logger = logging.getLogger(__name__)
 
-    def add_backup(self, backup_id: str, filenames: list[str]):
-        with self.lock:
+    @contextlib.contextmanager
+    def changing_backup(self, backup_id: str):
+        """
+        Holds the move lock of the backup while the server changes it on disk, and remembers when that was.
+        """
+        with self.backup_move_locks.get(backup_id):
+            previous = self.changed_at.get(backup_id)
+            self.changed_at[backup_id] = math.inf
+            try:
+                yield
+            finally:
+                # Only the outermost change is done when it ends.
+                self.changed_at[backup_id] = math.inf if previous == math.inf else time.monotonic()
+
+    def changed_by_server(self, backup_id: str, seen_at: float) -> bool:
+        """
+        Whether a change to the backup seen at the given time (from time.monotonic) was most likely made by the server.
+        """
+        return seen_at <= self.changed_at.get(backup_id, -math.inf) + SERVER_CHANGE_GRACE
+
+    def add_backup(self, backup_id: str, filenames: list[str]) -> list[manifest.ManifestEntry]:
+        """
+        Returns the manifest of the added backup.
+        """
+        with self.backup_lock(backup_id), self.changing_backup(backup_id):
             self.logger.info("Start add backup operation. Backup id: {%s} filenames: %s", backup_id, filenames)
 
             #
@@ -103,24 +734,15 @@ class FileManager:
 
             backup, target = self.get_backup_and_target(backup_id)
 
-            fs_location = get_backup_fs_location(backup, target, self.recycle_bin_path)
-
-            # If it's single-file, append the extension as well.
-            if target.target_type == models.BackupType.SINGLE:
-                fs_location += Path(filenames[0]).suffix
-
-            if os.path.exists(fs_location):
-                raise FileManagerError(f"Path {fs_location} already exists")
-
-            self.logger.info("Will be put in %s", fs_location)
-
+            archive_format = None
             if len(filenames) == 0:
                 raise FileManagerError("No files specified")
             elif len(filenames) == 1:
                 file = filenames[0]
+                archive_format = detect_archive_format(file)
                 if os.path.isdir(file):
                     upload_mode = BackupUploadMode.DIRECTORY
-                elif is_archive(file) and target.target_type == models.BackupType.MULTI:
+                elif archive_format is not None and target.target_type == models.BackupType.MULTI:
                     upload_mode = BackupUploadMode.ARCHIVE
                 else:
                     upload_mode = BackupUploadMode.SINGLE_FILE
@@ -132,6 +754,23 @@ class FileManager:
             if (upload_mode == BackupUploadMode.DIRECTORY or upload_mode == BackupUploadMode.MULTI_FILE) and target.target_type == models.BackupType.SINGLE:
                 raise FileManagerError("Cannot upload directory or multiple files to a single-file target")
 
+            storage_format = self.db.get_target_storage_format(target.id) if target.target_type == models.BackupType.MULTI else None
+            store_archive = storage_format == "archive"
+
+            fs_location = get_backup_fs_location(backup, target, self.recycle_bin_path)
+
+            # If it's single-file, append the extension as well.
+            if target.target_type == models.BackupType.SINGLE:
+                fs_location += get_file_extension(filenames[0])
+            elif store_archive:
+                # Anything that isn't a zip gets stored as a tar.
+                fs_location += STORED_ARCHIVE_EXTENSIONS["zip" if upload_mode == BackupUploadMode.ARCHIVE and archive_format == "zip" else "tar"]
+
+            if os.path.exists(fs_location):
+                raise FileManagerError(f"Path {fs_location} already exists")
+
+            self.logger.info("Will be put in %s", fs_location)
+
             #
             # Actual operation
             #
@@ -139,93 +778,207 @@ class FileManager:
             self.logger.info("Checks passed. Now uploading")
 
             # Regardless of type, create the directory if it doesn't exist
-            if target.target_type == models.BackupType.MULTI:
+            if target.target_type == models.BackupType.MULTI and not store_archive:
                 os.makedirs(fs_location, exist_ok=True)
             else:
-                os.makedirs(target.location, exist_ok=True)
-
-            if upload_mode == BackupUploadMode.SINGLE_FILE:
-                shutil.move(filenames[0], fs_location)
-            elif upload_mode == BackupUploadMode.MULTI_FILE:
-                for f in filenames:
-                    shutil.move(f, fs_location)
-            elif upload_mode == BackupUploadMode.ARCHIVE:
-                extract_archive(fs_location, filenames[0])
-            elif upload_mode == BackupUploadMode.DIRECTORY:
-                shutil.move(filenames[0], fs_location)
+                os.makedirs(os.path.dirname(fs_location), exist_ok=True)
+
+            try:
+                entries = None
+                if store_archive:
+                    entries = self.store_backup_archive(fs_location, filenames, upload_mode, archive_format)
+                elif upload_mode == BackupUploadMode.SINGLE_FILE:
+                    shutil.move(filenames[0], fs_location)
+                elif upload_mode == BackupUploadMode.MULTI_FILE:
+                    for f in filenames:
+                        shutil.move(f, fs_location)
+                elif upload_mode == BackupUploadMode.ARCHIVE:
+                    entries = extract_archive(fs_location, filenames[0])
+                elif upload_mode == BackupUploadMode.DIRECTORY:
+                    shutil.move(filenames[0], fs_location)
+
+                self.db.set_backup_path(backup_id, os.path.relpath(fs_location, target.location))
+
+                if storage_format == "pack":
+                    entries = pack_directory(fs_location, self.pack_threshold, entries)
+                elif entries is None:
+                    entries = file_manifest(fs_location) if target.target_type == models.BackupType.SINGLE else directory_manifest(fs_location)
+            except Exception:
+                # Nothing was there before, so whatever made it onto disk is left over from this upload.
+                self.logger.info("Upload failed, removing %s", fs_location)
+                remove_path(fs_location)
+                raise
 
             self.logger.info("Finish upload")
+            return entries
+
+    def store_backup_archive(self, fs_location: str, filenames: list[str], upload_mode: BackupUploadMode, archive_format: str | None) -> list[manifest.ManifestEntry]:
+        """
+        Stores the upload as a single archive at fs_location and returns its index.
+        """
+        compression = get_compression(filenames[0]) if upload_mode == BackupUploadMode.ARCHIVE else None
+        if upload_mode == BackupUploadMode.ARCHIVE and compression is None:
+            # Zips and uncompressed tars are kept as they are.
+            shutil.move(filenames[0], fs_location)
+        elif upload_mode == BackupUploadMode.ARCHIVE:
+            with compression.open(filenames[0], "rb") as source, open(fs_location, "wb") as dest:
+                shutil.copyfileobj(source, dest, COPY_CHUNK_SIZE)
+            os.remove(filenames[0])
+        else:
+            pack_tar(fs_location, filenames)
+            for filename in filenames:
+                if os.path.isdir(filename):
+                    shutil.rmtree(filename)
+                else:
+                    os.remove(filename)
+
+        try:
+            return index_archive(fs_location)
+        except Exception:
+            os.remove(fs_location)
+            raise
 
     def delete_backup(self, backup_id: str):
-        with self.lock:
+        with self.backup_lock(backup_id), self.changing_backup(backup_id):
+            self.relocate_backup(backup_id)
             backup, target = self.get_backup_and_target(backup_id)
 
             self.logger.info("Deleting backup {%s}", backup_id)
+            self.invalidate_download_cache(backup_id)
 
-            fs_location = get_backup_fs_location(backup, target, self.recycle_bin_path)
-            if target.target_type == models.BackupType.SINGLE:
-                base_location = self.recycle_bin_path if backup.is_recycled else target.location
-                for path in Path(base_location).glob(nameformat.parse(target.name_template, backup.id, backup.created_at.isoformat(), backup.manual)):
-                    path.unlink()
-            else:
-                shutil.rmtree(fs_location)
+            base_location = self.get_base_location(backup, target)
+            fs_location = self.get_backup_path(backup_id)
+            size = os.path.getsize(fs_location) if target.target_type == models.BackupType.SINGLE else backup.filesize
+            self.move_to_trash(fs_location, base_location, size)
 
     def delete_target_backups(self, target_id: str):
-        with self.lock:
-            self.get_target(target_id)
-
+        with self.locks.target(self.get_target(target_id).id):
             self.logger.info("Deleting all backups for target {%s}", target_id)
             backups = self.db.list_backups_target(target_id)
             for backup in backups:
                 self.delete_backup(backup.id)
 
-    def update_backup_locations(self, target: models.BackupTarget, new_name_template: str, new_location: str, old_name_template: str, old_location: str):
-        with self.lock:
-            self.logger.info("Starting move backups in target {%s}. Name template: '%s' -> '%s', location: '%s' -> '%s'", target.id, old_name_template, new_name_template, old_location, new_location)
-            self.db.validate_target(target.name, new_name_template, new_location, target.id, None)
+    #
+    # Relocation
+    #
+    # When a target's location or name template changes, its backups are queued to be moved in the background,
+    # see delayed_jobs.RelocateJob. Until a backup is moved, its old location is used.
+    #
 
-            os.makedirs(new_location, exist_ok=True)
+    def schedule_backup_relocations(self, target: models.BackupTarget, new_name_template: str, new_location: str, old_name_template: str, old_location: str) -> int:
+        """
+        Returns how many backups of the target are waiting to be relocated.
+        """
+        with self.locks.target(target.id):
+            self.logger.info("Schedule moving backups in target {%s}. Name template: '%s' -> '%s', location: '%s' -> '%s'", target.id, old_name_template, new_name_template, old_location, new_location)
 
+            pending = {relocation.backup_id for relocation in self.db.list_backup_relocations(target.id)}
+            relocations = []
             for backup in self.db.list_backups_target(target.id):
-                old_fs_location = get_fs_location(old_location, old_name_template, backup.id, backup.created_at.isoformat(), backup.manual)
-                new_fs_location = get_fs_location(new_location, new_name_template, backup.id, backup.created_at.isoformat(), backup.manual)
+                # Recycled backups stay in the recycle bin, so for them it only matters if the name template changed.
+                base_old_location = self.recycle_bin_path if backup.is_recycled else old_location
+                base_new_location = self.recycle_bin_path if backup.is_recycled else new_location
+                old_fs_location = utility.join_path(base_old_location, self.get_backup_relative_path(backup, target))
+                new_name = nameformat.parse(new_name_template, backup.id, backup.created_at.isoformat(), backup.manual)
+                new_fs_location = utility.join_path(base_new_location, new_name + self.get_backup_extension(backup, target, old_name_template))
+
+                # A pending relocation has to be updated even then, since the backup isn't at old_fs_location yet.
+                if old_fs_location == new_fs_location and backup.id not in pending:
+                    continue
+                relocations.append((backup.id, old_fs_location, new_fs_location))
+
+            self.db.add_backup_relocations(target.id, relocations)
+            self.logger.info("Scheduled %d backups to be moved", len(relocations))
+            return len(pending | {backup_id for backup_id, _, _ in relocations})
+
+    def relocate_backup(self, backup_id: str):
+        """
+        Moves the backup to its new location if it's waiting to be relocated. Safe to call from several threads.
+        """
+        with self.backup_move_locks.get(backup_id):
+            relocation = self.db.get_backup_relocation(backup_id)
+            if relocation is None:
+                return
+
+            if relocation.old_path != relocation.new_path:
+                with self.changing_backup(backup_id):
+                    self.logger.info("Move %s -> %s", relocation.old_path, relocation.new_path)
+                    # Also finishes a move that got interrupted, including one that was done but not yet recorded.
+                    move_backup_files(relocation.old_path, relocation.new_path)
 
-                if backup.is_recycled:
-                    # In this case, it only matters if the name template changed.
-                    old_fs_location = get_fs_location(self.recycle_bin_path, old_name_template, backup.id, backup.created_at.isoformat(), backup.manual)
-                    new_fs_location = get_fs_location(self.recycle_bin_path, new_name_template, backup.id, backup.created_at.isoformat(), backup.manual)
+            backup, target = self.get_backup_and_target(backup_id)
+            self.db.complete_backup_relocation(backup_id, relocation.new_path, os.path.relpath(relocation.new_path, self.get_base_location(backup, target)))
 
-                if old_fs_location == new_fs_location:
-                    self.logger.info("Skip moving backup {%s} (same source and destination)", backup.id)
+    #
+    # Path resolution
+    #
+    # The path of every backup relative to its base location (target location or recycle bin) is stored in the database.
+    # Looking for the file is only needed for backups added before that, and is done once.
+    #
 
-                if target.target_type == models.BackupType.SINGLE:
-                    old_fs_location = find_single_backup_file(old_fs_location)
-                    new_fs_location += "".join(Path(old_fs_location).suffixes)
+    def get_backup_device(self, backup_id: str) -> int | None:
+        """
+        ID of the device the backup is stored on, None if it can't be found.
+        """
+        try:
+            return os.stat(self.get_backup_path(backup_id)).st_dev
+        except (FileManagerError, OSError):
+            return None
+
+    def get_base_location(self, backup: models.Backup, target: models.BackupTarget) -> str:
+        return self.recycle_bin_path if backup.is_recycled else target.location
 
-                self.logger.info("Move %s -> %s", old_fs_location, new_fs_location)
+    def get_backup_relative_path(self, backup: models.Backup, target: models.BackupTarget) -> str:
+        path = self.db.get_backup_path(backup.id)
+        if path is not None:
+            return path
 
-                shutil.move(old_fs_location, new_fs_location)
+        fs_location = get_backup_fs_location(backup, target, self.recycle_bin_path)
+        if target.target_type == models.BackupType.SINGLE:
+            fs_location = str(find_single_backup_file(fs_location))
+        path = os.path.relpath(fs_location, self.get_base_location(backup, target))
+        self.logger.info("Store path of backup {%s}: %s", backup.id, path)
+        self.db.set_backup_path(backup.id, path)
+        return path
 
-            if os.path.isdir(old_location) and not any(os.scandir(old_location)):
-                self.logger.info("Old location directory empty, removing")
-                os.rmdir(old_location)
+    def get_backup_extension(self, backup: models.Backup, target: models.BackupTarget, name_template: str) -> str:
+        """
+        Extension of backups stored as a single file, empty for directories. Name template is the one the backup was named with.
+        """
+        path = self.get_backup_relative_path(backup, target)
+        name = nameformat.parse(name_template, backup.id, backup.created_at.isoformat(), backup.manual)
+        if path.startswith(name):
+            return path[len(name):]
+        if os.path.isfile(self.get_backup_location(backup, target)):
+            return get_file_extension(path)
+        return ""
+
+    def get_backup_location(self, backup: models.Backup, target: models.BackupTarget) -> str:
+        """
+        Where the backup currently is. For single-file backups, that's the file itself.
+        """
+        relocation = self.db.get_backup_relocation(backup.id)
+        if relocation is not None:
+            return relocation.old_path
+        return utility.join_path(self.get_base_location(backup, target), self.get_backup_relative_path(backup, target))
 
-            self.logger.info("Finished moving")
+    def get_backup_path(self, backup_id: str) -> str:
+        backup, target = self.get_backup_and_target(backup_id)
+        return self.get_backup_location(backup, target)
 
     def recycle_backup(self, backup_id: int):
-        with self.lock:
+        with self.backup_lock(backup_id), self.changing_backup(backup_id):
+            self.relocate_backup(backup_id)
             backup, target = self.get_backup_and_target(backup_id)
 
             self.logger.info("Recycle backup {%s}", backup_id)
             self.recycle_bin_mkdir()
+            self.invalidate_download_cache(backup_id)
 
             # Doing this manually since the backup might be marked as recycled or not. This module shouldn't care.
-            backup_location = get_fs_location(target.location, target.name_template, backup_id, backup.created_at.isoformat(), backup.manual)
-            recycle_location = get_fs_location(self.recycle_bin_path, target.name_template, backup_id, backup.created_at.isoformat(), backup.manual)
-
-            if target.target_type == models.BackupType.SINGLE:
-                backup_location = find_single_backup_file(backup_location)
-                recycle_location += "".join(Path(backup_location).suffixes)
+            path = self.get_backup_relative_path(backup, target)
+            backup_location = utility.join_path(target.location, path)
+            recycle_location = utility.join_path(self.recycle_bin_path, path)
 
             self.logger.info("Move %s -> %s", backup_location, recycle_location)
 
@@ -234,17 +987,16 @@ class FileManager:
             self.logger.info("Finished recycling")
 
     def unrecycle_backup(self, backup_id: str):
-        with self.lock:
+        with self.backup_lock(backup_id), self.changing_backup(backup_id):
+            self.relocate_backup(backup_id)
             backup, target = self.get_backup_and_target(backup_id)
 
             self.logger.info("Unrecycle backup {%s}", backup_id)
+            self.invalidate_download_cache(backup_id)
 
-            backup_location = get_fs_location(self.recycle_bin_path, target.name_template, backup_id, backup.created_at.isoformat(), backup.manual)
-            original_location = get_fs_location(target.location, target.name_template, backup_id, backup.created_at.isoformat(), backup.manual)
-
-            if target.target_type == models.BackupType.SINGLE:
-                backup_location = find_single_backup_file(backup_location)
-                original_location += "".join(Path(backup_location).suffixes)
+            path = self.get_backup_relative_path(backup, target)
+            backup_location = utility.join_path(self.recycle_bin_path, path)
+            original_location = utility.join_path(target.location, path)
 
             self.logger.info("Move %s -> %s", backup_location, original_location)
 
@@ -253,15 +1005,127 @@ class FileManager:
             self.logger.info("Finished unrecycling")
 
     def get_backup_hash(self, backup_id: str):
-        with self.lock:
-            backup, target = self.get_backup_and_target(backup_id)
+        with self.backup_move_locks.get(backup_id):
+            _, target = self.get_backup_and_target(backup_id)
 
-            backup_location = get_backup_fs_location(backup, target, self.recycle_bin_path)
+            backup_location = self.get_backup_path(backup_id)
             if target.target_type == models.BackupType.SINGLE:
-                backup_location = find_single_backup_file(backup_location)
                 return file_hash(backup_location)
+            if os.path.isfile(backup_location):
+                return manifest.aggregate_hash(index_archive(backup_location))
+            if is_pack_directory(backup_location):
+                return manifest.aggregate_hash(pack_manifest(backup_location))
             return directory_hash(backup_location)
 
+    def get_backup_manifest(self, backup_id: str, limiter: throttle.Throttle | None = None) -> list[manifest.ManifestEntry]:
+        """
+        Hashes every file of the backup. Reads the whole backup, same as get_backup_hash.
+        If a limiter is given, it's ticked with the number of bytes read.
+        """
+        with self.backup_move_locks.get(backup_id):
+            _, target = self.get_backup_and_target(backup_id)
+
+            backup_location = self.get_backup_path(backup_id)
+            if target.target_type == models.BackupType.SINGLE:
+                return file_manifest(backup_location, limiter)
+            if os.path.isfile(backup_location):
+                return index_archive(backup_location, limiter)
+            if is_pack_directory(backup_location):
+                return pack_manifest(backup_location, limiter)
+            return directory_manifest(backup_location, limiter)
+
+    def check_backup_chunks(self, backup_id: str, chunks: list[tuple[manifest.ManifestEntry, int]], limiter: throttle.Throttle | None = None) -> dict[str, list[int] | None]:
+        """
+        Reads only the given chunks of files of the backup and compares them to their recorded digests.
+        Returns the indexes of the chunks that don't match for each file, None in place of them if the file can't be read.
+        """
+        mismatches = {}
+        by_path: dict[str, list[tuple[manifest.ManifestEntry, int]]] = {}
+        for entry, index in chunks:
+            by_path.setdefault(entry.path, []).append((entry, index))
+
+        with self.backup_move_locks.get(backup_id):
+            _, target = self.get_backup_and_target(backup_id)
+            for path, file_chunks in by_path.items():
+                try:
+                    if target.target_type == models.BackupType.SINGLE:
+                        file = open(self.get_backup_path(backup_id), "rb")
+                    else:
+                        file = self.open_backup_file(backup_id, path)
+                except (FileManagerError, OSError):
+                    mismatches[path] = None
+                    continue
+
+                with file:
+                    for entry, index in sorted(file_chunks, key=lambda chunk: chunk[1]):
+                        file.seek(index * manifest.CHUNK_SIZE)
+                        data = file.read(manifest.CHUNK_SIZE)
+                        if limiter is not None:
+                            limiter.tick(len(data))
+                        if hashlib.sha256(data).digest() != entry.chunk_digest(index):
+                            mismatches.setdefault(path, []).append(index)
+        return mismatches
+
+    def get_manifest_hash(self, backup_id: str, entries: list[manifest.ManifestEntry]) -> str:
+        """
+        Computes what get_backup_hash would return from the backup's manifest.
+        """
+        _, target = self.get_backup_and_target(backup_id)
+        if target.target_type == models.BackupType.SINGLE:
+            return entries[0].digest
+        return manifest.aggregate_hash(entries)
+
+    def get_manifest_size(self, backup_id: str, entries: list[manifest.ManifestEntry]) -> int:
+        """
+        Computes what get_backup_size would return from the backup's manifest.
+        """
+        archive_path = self.get_stored_archive(backup_id)
+        if archive_path is not None:
+            return os.path.getsize(archive_path)
+        packed_path = self.get_packed_directory(backup_id)
+        if packed_path is not None:
+            # Packed files take less space than they add up to.
+            return get_directory_size(Path(packed_path))
+        return sum(entry.size for entry in entries)
+
+    def get_stored_archive(self, backup_id: str) -> str | None:
+        """
+        Returns path of the archive the backup is stored as, or None if it isn't stored as one.
+        """
+        backup, target = self.get_backup_and_target(backup_id)
+        if target.target_type != models.BackupType.MULTI:
+            return None
+        fs_location = self.get_backup_location(backup, target)
+        return fs_location if os.path.isfile(fs_location) else None
+
+    def get_packed_directory(self, backup_id: str) -> str | None:
+        """
+        Returns path of the backup's directory if it has a pack file, None otherwise.
+        """
+        backup, target = self.get_backup_and_target(backup_id)
+        if target.target_type != models.BackupType.MULTI:
+            return None
+        fs_location = self.get_backup_location(backup, target)
+        return fs_location if is_pack_directory(fs_location) else None
+
+    def is_indexed(self, backup_id: str) -> bool:
+        """
+        Whether files of the backup are found through its index rather than by looking at the filesystem.
+        """
+        return self.get_stored_archive(backup_id) is not None or self.get_packed_directory(backup_id) is not None
+
+    def get_backup_index(self, backup_id: str) -> list[manifest.ManifestEntry]:
+        """
+        Manifest of a backup stored as an archive or with packed files, with their offsets.
+        Built from what's on disk if it wasn't recorded.
+        """
+        entries = self.db.get_backup_manifest(backup_id)
+        if entries is None:
+            archive_path = self.get_stored_archive(backup_id)
+            entries = index_archive(archive_path) if archive_path is not None else pack_manifest(self.get_packed_directory(backup_id))
+            self.db.set_backup_manifest(backup_id, entries)
+        return entries
+
     def create_backup_archive(self, backup_id: str, output_file: str):
         """
         Only works with multi-file targets
@@ -273,16 +1137,230 @@ class FileManager:
 
         self.logger.info("Create archive of backup {%s} as '%s'", backup.id, output_file)
 
-        fs_location = get_backup_fs_location(backup, target, self.recycle_bin_path)
+        fs_location = self.get_backup_location(backup, target)
         with tarfile.open(output_file, "w:xz") as tar_file:
             basename = os.path.basename(fs_location)
-            tar_file.add(fs_location, arcname=basename)
+            if is_pack_directory(fs_location):
+                # The pack file itself means nothing outside of here, so files are added from the index instead.
+                self.add_index_to_tar(tar_file, backup.id, basename)
+            else:
+                tar_file.add(fs_location, arcname=basename)
 
         self.logger.info("Finished creating archive")
 
+    def add_index_to_tar(self, tar_file: tarfile.TarFile, backup_id: str, basename: str):
+        for backup_file in walk_index(self.get_backup_index(backup_id), ""):
+            info = tarfile.TarInfo(f"{basename}/{backup_file.path}")
+            info.mtime = int(backup_file.mtime)
+            if backup_file.is_dir:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar_file.addfile(info)
+                continue
+            info.size = backup_file.size
+            info.mode = 0o644
+            with self.open_backup_file(backup_id, backup_file.path) as file:
+                tar_file.addfile(info, file)
+
+    #
+    # Browsing files inside multi-file backups
+    #
+
+    def get_backup_file_fs_path(self, backup_id: str, path: str) -> tuple[str, str]:
+        """
+        Returns on-disk path of a file inside the backup and the normalized path.
+        """
+        backup, target = self.get_backup_and_target(backup_id)
+        if target.target_type != models.BackupType.MULTI:
+            raise FileManagerError("Cannot browse files of a single-file backup")
+
+        path = normalize_backup_file_path(path)
+        root = self.get_backup_location(backup, target)
+        fs_path = utility.join_path(root, path) if path else root
+
+        # Symlinks inside the backup are left out of it, as they could lead anywhere. Any path going through one
+        # resolves to somewhere else than where it would without it.
+        real_root = os.path.realpath(root)
+        real_path = os.path.realpath(fs_path)
+        if real_path != (utility.join_path(real_root, path) if path else real_root) or not os.path.exists(fs_path):
+            raise BackupFileNotFoundError(f"'{path}' does not exist in backup {backup_id}")
+        return fs_path, path
+
+    def get_backup_index_file(self, backup_id: str, path: str) -> tuple[list[manifest.ManifestEntry], BackupFile]:
+        """
+        Same as get_backup_file for indexed backups, also returns the index it looked in.
+        """
+        path = normalize_backup_file_path(path)
+        entries = self.get_backup_index(backup_id)
+        backup_file = stat_index(entries, path)
+        if backup_file is None:
+            raise BackupFileNotFoundError(f"'{path}' does not exist in backup {backup_id}")
+        return entries, backup_file
+
+    def get_backup_file(self, backup_id: str, path: str) -> BackupFile:
+        if self.is_indexed(backup_id):
+            return self.get_backup_index_file(backup_id, path)[1]
+        fs_path, path = self.get_backup_file_fs_path(backup_id, path)
+        backup_file = stat_backup_file(fs_path, path)
+        if backup_file is None:
+            raise BackupFileNotFoundError(f"'{path}' does not exist in backup {backup_id}")
+        return backup_file
+
+    def list_backup_files(self, backup_id: str, path: str) -> list[BackupFile]:
+        """
+        Lists contents of a directory inside the backup. Directories come first.
+        """
+        if self.is_indexed(backup_id):
+            entries, backup_file = self.get_backup_index_file(backup_id, path)
+            if not backup_file.is_dir:
+                raise FileManagerError(f"'{backup_file.path}' is not a directory")
+            return list_index(entries, backup_file.path)
+
+        fs_path, path = self.get_backup_file_fs_path(backup_id, path)
+        if not os.path.isdir(fs_path):
+            raise FileManagerError(f"'{path}' is not a directory")
+
+        files = []
+        for entry in os.scandir(fs_path):
+            backup_file = stat_backup_file(entry.path, f"{path}/{entry.name}" if path else entry.name)
+            if backup_file is not None:
+                files.append(backup_file)
+        files.sort(key=lambda f: (not f.is_dir, f.path))
+        return files
+
+    def walk_backup_files(self, backup_id: str, path: str) -> Iterator[BackupFile]:
+        """
+        Yields the file or directory at path and everything under it. Directories come before their contents.
+        """
+        if self.is_indexed(backup_id):
+            entries, backup_file = self.get_backup_index_file(backup_id, path)
+            yield backup_file
+            if backup_file.is_dir:
+                yield from walk_index(entries, backup_file.path)
+            return
+
+        fs_path, path = self.get_backup_file_fs_path(backup_id, path)
+        top_file = stat_backup_file(fs_path, path)
+        if top_file is None:
+            raise BackupFileNotFoundError(f"'{path}' does not exist in backup {backup_id}")
+        yield top_file
+
+        # os.walk puts symlinks to directories in with directories, but doesn't go into them.
+        for dirpath, dirnames, filenames in os.walk(fs_path):
+            dirnames.sort()
+            rel_dir = os.path.relpath(dirpath, fs_path).replace(os.sep, "/")
+            dir_path = "/".join(part for part in (path, "" if rel_dir == "." else rel_dir) if part)
+            for name in dirnames + sorted(filenames):
+                backup_file = stat_backup_file(utility.join_path(dirpath, name), f"{dir_path}/{name}" if dir_path else name)
+                if backup_file is not None:
+                    yield backup_file
+
+    def open_backup_file(self, backup_id: str, path: str) -> BinaryIO:
+        archive_path = self.get_stored_archive(backup_id)
+        if archive_path is not None:
+            entries, backup_file = self.get_backup_index_file(backup_id, path)
+            if backup_file.is_dir:
+                raise FileManagerError(f"'{backup_file.path}' is a directory")
+            entry = next(entry for entry in entries if entry.path == backup_file.path)
+            if entry.offset is None:
+                return open_zip_member(archive_path, entry.path)
+            return io.BufferedReader(ArchiveMemberFile(archive_path, entry.offset, entry.size))
+
+        packed_path = self.get_packed_directory(backup_id)
+        if packed_path is not None:
+            entries, backup_file = self.get_backup_index_file(backup_id, path)
+            if backup_file.is_dir:
+                raise FileManagerError(f"'{backup_file.path}' is a directory")
+            entry = next(entry for entry in entries if entry.path == backup_file.path)
+            if entry.offset is not None:
+                return open_pack_member(utility.join_path(packed_path, PACK_FILE_NAME), entry.offset)
+            # Files that weren't packed are where they'd be without the pack.
+
+        fs_path, path = self.get_backup_file_fs_path(backup_id, path)
+        if os.path.isdir(fs_path):
+            raise FileManagerError(f"'{path}' is a directory")
+        return open(fs_path, "rb")
+
+    def copy_backup_file(self, backup_id: str, path: str, dest: str, digest: str) -> bool:
+        """
+        Copies a file out of a backup. Returns whether it still has the given digest, nothing is left at dest if it doesn't.
+        """
+        h = hashlib.sha256()
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with self.open_backup_file(backup_id, path) as source, open(dest, "wb") as file:
+            while chunk := source.read(COPY_CHUNK_SIZE):
+                h.update(chunk)
+                file.write(chunk)
+        if h.hexdigest() != digest:
+            os.remove(dest)
+            return False
+        return True
+
+    #
+    # Deferred deletion
+    #
+    # Deleting a backup only renames it into the trash directory of its base location, which is quick regardless
+    # of its size. The files are then removed from disk in the background by the trash reaper job.
+    #
+
+    def move_to_trash(self, path: str, base_location: str, size: int):
+        trash_dir = utility.join_path(base_location, TRASH_DIR_NAME)
+        trash_path = utility.join_path(trash_dir, str(uuid.uuid4()))
+
+        # Recorded before moving, so a crash in between leaves a row pointing to nothing instead of untracked files.
+        trash_id = self.db.add_trash(trash_path, size)
+        try:
+            with self.trash_lock:
+                os.makedirs(trash_dir, exist_ok=True)
+                os.rename(path, trash_path)
+        except OSError:
+            self.db.delete_trash(trash_id)
+            raise
+
+        self.logger.info("Move %s -> %s", path, trash_path)
+
+    def remove_trash(self, entry: database.TrashEntry, limiter: throttle.Throttle):
+        """
+        Removes files of a trash entry from disk, one file at a time at the rate allowed by limiter.
+        """
+        if os.path.isdir(entry.path) and not os.path.islink(entry.path):
+            for dirpath, dirnames, filenames in os.walk(entry.path, topdown=False):
+                for filename in filenames:
+                    os.unlink(utility.join_path(dirpath, filename))
+                    limiter.tick()
+                for dirname in dirnames:
+                    dir_path = utility.join_path(dirpath, dirname)
+                    if os.path.islink(dir_path):
+                        os.unlink(dir_path)
+                    else:
+                        os.rmdir(dir_path)
+            os.rmdir(entry.path)
+        elif os.path.lexists(entry.path):
+            os.unlink(entry.path)
+            limiter.tick()
+
+        self.db.delete_trash(entry.id)
+
+        with self.trash_lock:
+            trash_dir = os.path.dirname(entry.path)
+            if os.path.isdir(trash_dir) and not any(os.scandir(trash_dir)):
+                os.rmdir(trash_dir)
+
+    def empty_trash(self, base_location: str, limiter: throttle.Throttle):
+        """
+        Removes everything in the trash of the base location right away instead of leaving it to the reaper.
+        """
+        trash_dir = utility.join_path(base_location, TRASH_DIR_NAME)
+        for entry in self.db.list_trash():
+            if os.path.dirname(entry.path) == trash_dir:
+                self.remove_trash(entry, limiter)
+
+    def invalidate_download_cache(self, backup_id: str):
+        if self.download_cache is not None:
+            self.download_cache.invalidate(backup_id)
+
     def recycle_bin_mkdir(self):
-        with self.lock:
-            os.makedirs(self.recycle_bin_path, exist_ok=True)
+        os.makedirs(self.recycle_bin_path, exist_ok=True)
 
     #
     # Statistics
@@ -293,12 +1371,12 @@ class FileManager:
     #
 
     def get_backup_size(self, backup_id: str) -> int:
-        backup, target = self.get_backup_and_target(backup_id)
+        _, target = self.get_backup_and_target(backup_id)
 
-        fs_location = get_backup_fs_location(backup, target, self.recycle_bin_path)
+        fs_location = self.get_backup_path(backup_id)
 
-        if target.target_type == models.BackupType.SINGLE:
-            fs_location = find_single_backup_file(fs_location)
+        # Backups stored as an archive only need the one stat as well.
+        if target.target_type == models.BackupType.SINGLE or os.path.isfile(fs_location):
             return Path(fs_location).stat().st_size
 
         if not os.path.exists(fs_location):
@@ -306,6 +1384,19 @@ class FileManager:
 
         return get_directory_size(Path(fs_location))
 
+    def get_backup_fingerprint(self, backup_id: str) -> str:
+        """
+        Summary of where the backup is and what its top level looks like, which only takes a couple of stats.
+        It changes when the backup is moved or replaced, but not necessarily when a file deeper in a directory does.
+        """
+        fs_location = self.get_backup_path(backup_id)
+        try:
+            stat = os.stat(fs_location)
+            num_entries = len(os.listdir(fs_location)) if os.path.isdir(fs_location) else 0
+        except OSError as exc:
+            raise FileManagerError(f"Backup {backup_id} does not exist on-disk") from exc
+        return hashlib.sha256(f"{fs_location}\0{stat.st_ino}\0{stat.st_size}\0{stat.st_mtime_ns}\0{num_entries}".encode("utf-8", "surrogateescape")).hexdigest()
+
     def get_target_size(self, target_id: str) -> int:
         target = self.get_target(target_id)
 
@@ -333,6 +1424,13 @@ class FileManager:
         
         return backup, target
     
+    def backup_lock(self, backup_id: str) -> threading.RLock:
+        """
+        Returns the lock of the target the backup belongs to.
+        """
+        _, target = self.get_backup_and_target(backup_id)
+        return self.locks.target(target.id)
+
     def get_target(self, target_id: str) -> models.BackupTarget:
         target = self.db.get_target(target_id)
         if target is None:
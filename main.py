@@ -2,9 +2,11 @@
 
 import database
 import file_manager
+import download_cache
 import serverapi
 import serverconfig
 import stats
+import storage_watcher
 import scheduled_jobs
 import delayed_jobs
 import seq_upload
@@ -32,10 +34,12 @@ log.init()
 
 config = serverconfig.get_server_config()
 db = database.Database(config.get("db"), config.get("page_size"))
-file_manager = file_manager.FileManager(db, config.get("recycle_bin_path"))
+download_cache = download_cache.DownloadCache(config.get("download_cache_path"), config.get("download_cache_size"))
+file_manager = file_manager.FileManager(db, config.get("recycle_bin_path"), download_cache, config.get("pack_threshold"))
 server_api = serverapi.ServerAPI(db, file_manager)
 stats = stats.Stats(db, file_manager)
 seq_upload_manager = seq_upload.SequentialUploadManager()
+storage_watcher = storage_watcher.StorageWatcher(db, file_manager, config.get("storage_watcher_settle")) if config.get("storage_watcher") else None
 
 db.validate_schema_version()
 
@@ -43,21 +47,31 @@ db.validate_schema_version()
 # Initializing scheduled jobs
 #
 
-scheduler = scheduled_jobs.JobScheduler()
-scheduler.add_job(scheduled_jobs.RecycleJob(config.get("recycle_job_interval"), db, server_api))
-scheduler.add_job(scheduled_jobs.BackupFilesizeJob(config.get("backup_filesize_job_interval"), db, file_manager))
+scheduler = scheduled_jobs.JobScheduler(config.get("scheduler_workers"), config.get("scheduler_jitter_percent") / 100, db, config.get("scheduler_stagger"))
+recycle_job = scheduled_jobs.RecycleJob(config.get("recycle_job_interval"), db, server_api, config.get("recycle_debounce"))
+server_api.add_upload_listener(recycle_job.queue_target)
+scheduler.add_job(recycle_job)
+scheduler.add_job(scheduled_jobs.BackupFilesizeJob(config.get("backup_filesize_job_interval"), db, file_manager, storage_watcher))
 scheduler.add_job(scheduled_jobs.DeduplicateJob(config.get("deduplicate_job_interval"), db, file_manager, server_api))
 scheduler.add_job(scheduled_jobs.StaleSequentialUploadJob(config.get("stale_seq_upload_job_interval"), seq_upload_manager))
 scheduler.add_job(scheduled_jobs.TemporaryPurgeJob(config.get("tmp_purge_job_interval"), config.get("temp_save_path")))
-scheduler.add_job(scheduled_jobs.IntegrityCheckJob(config.get("integrity_check_job_interval"), db, file_manager))
+scheduler.add_job(scheduled_jobs.IntegrityCheckJob(config.get("integrity_check_job_interval"), db, file_manager, config.get("integrity_check_rate"), config.get("integrity_check_period"), config.get("integrity_check_workers"), config.get("integrity_check_samples"), config.get("integrity_check_full_period"), storage_watcher))
+scheduler.add_job(scheduled_jobs.TrashReaperJob(config.get("trash_reaper_job_interval"), db, file_manager, config.get("trash_reaper_rate")))
 scheduler.start()
 
+if storage_watcher is not None:
+    storage_watcher.start()
+
 #
 # Initializing delayed jobs
 #
 
 manager = delayed_jobs.JobManager()
 
+# Pick up relocations interrupted by a restart.
+for target_id in db.list_relocating_targets():
+    manager.run_job(delayed_jobs.RelocateJob(target_id, file_manager, config.get("relocate_workers")))
+
 #
 # Retreive password hash if auth is enabled
 #
@@ -0,0 +1,172 @@
+"""
+Per-file manifests of backups.
+"""
+
+import hashlib
+import re
+from dataclasses import dataclass
+
+# Files are hashed in chunks of this size as well, so parts of them can be checked on their own.
+CHUNK_SIZE = 1024 * 1024
+CHUNK_DIGEST_SIZE = hashlib.sha256().digest_size
+
+@dataclass
+class ManifestEntry:
+    """
+    Path is relative to the root of the backup and uses forward slashes.
+    Digest is the SHA-256 of the file's contents.
+    Offset is where the file's data starts in the archive for backups stored as one,
+    or where its record starts in the pack file for packed files.
+    Chunks are the raw SHA-256 digests of every CHUNK_SIZE bytes of the file, one after another.
+    None if they weren't recorded.
+    """
+    path: str
+    size: int
+    mtime: float
+    digest: str
+    offset: int | None = None
+    chunks: bytes | None = None
+
+    def chunk_digest(self, index: int) -> bytes:
+        return self.chunks[index * CHUNK_DIGEST_SIZE:(index + 1) * CHUNK_DIGEST_SIZE]
+
+    def num_chunks(self) -> int:
+        return len(self.chunks) // CHUNK_DIGEST_SIZE
+
+class Hasher:
+    """
+    Hashes contents fed to it both as a whole and in chunks, for a manifest entry.
+    """
+    def __init__(self):
+        self.whole = hashlib.sha256()
+        self.chunk = hashlib.sha256()
+        self.chunk_filled = 0
+        self.chunks = bytearray()
+
+    def update(self, data: bytes):
+        self.whole.update(data)
+        view = memoryview(data)
+        while view:
+            taken = min(len(view), CHUNK_SIZE - self.chunk_filled)
+            self.chunk.update(view[:taken])
+            self.chunk_filled += taken
+            view = view[taken:]
+            if self.chunk_filled == CHUNK_SIZE:
+                self.chunks += self.chunk.digest()
+                self.chunk = hashlib.sha256()
+                self.chunk_filled = 0
+
+    def hexdigest(self) -> str:
+        return self.whole.hexdigest()
+
+    def chunk_digests(self) -> bytes:
+        if self.chunk_filled:
+            return bytes(self.chunks + self.chunk.digest())
+        return bytes(self.chunks)
+
+def hash_bytes(data: bytes) -> Hasher:
+    hasher = Hasher()
+    hasher.update(data)
+    return hasher
+
+def is_digest(value) -> bool:
+    return isinstance(value, str) and re.fullmatch("[0-9a-f]{64}", value) is not None
+
+def sort_key(entry: ManifestEntry) -> tuple[str, str]:
+    # Same order as walking the directory with sorted(os.walk()) and sorting file names.
+    directory, _, name = entry.path.rpartition("/")
+    return directory, name
+
+def aggregate_hash(entries: list[ManifestEntry]) -> str:
+    """
+    Hash of a whole multi-file backup. Gives the same result as file_manager.directory_hash without reading any files.
+    """
+    h = hashlib.sha256()
+    for entry in sorted(entries, key=sort_key):
+        h.update(entry.path.encode())
+        h.update(entry.digest.encode())
+    return h.hexdigest()
+
+#
+# Merkle tree
+#
+# Every file is a node made from its digest, and every directory a node made from its children.
+# Comparing two trees from the root down only has to look into the directories whose nodes differ.
+# Chunk digests then narrow it down to the chunks that differ inside the files that did.
+#
+
+def file_node(entry: ManifestEntry) -> bytes:
+    # Only the whole-file digest, since manifests recorded before chunk digests existed don't have them.
+    h = hashlib.sha256(b"file\0")
+    h.update(bytes.fromhex(entry.digest))
+    return h.digest()
+
+def build_tree(entries: list[ManifestEntry]) -> dict[str, tuple[bytes, dict[str, str]]]:
+    """
+    Returns the node of every file and directory, keyed by path. The root is an empty string.
+    Along with each node come the paths of its children, keyed by their name. Files have none.
+    """
+    children: dict[str, dict[str, str]] = {"": {}}
+    files = {}
+    for entry in entries:
+        files[entry.path] = entry
+        parent = ""
+        for name in entry.path.split("/"):
+            path = f"{parent}/{name}" if parent else name
+            children.setdefault(parent, {})[name] = path
+            parent = path
+
+    tree = {}
+    def node(path: str) -> bytes:
+        if path in files:
+            tree[path] = (file_node(files[path]), {})
+        else:
+            h = hashlib.sha256(b"dir\0")
+            for name, child_path in sorted(children.get(path, {}).items()):
+                h.update(name.encode("utf-8", "surrogateescape") + b"\0")
+                h.update(node(child_path))
+            tree[path] = (h.digest(), children.get(path, {}))
+        return tree[path][0]
+    node("")
+    return tree
+
+def find_mismatches(recorded: list[ManifestEntry], on_disk: list[ManifestEntry]) -> dict[str, list[int] | None]:
+    """
+    Walks both trees down from the root to find what differs. Returns the paths of recorded files that changed
+    or are gone, with the indexes of the chunks that changed. None in place of chunks if the file is gone,
+    or if they can't be told apart.
+    """
+    recorded_tree = build_tree(recorded)
+    on_disk_tree = build_tree(on_disk)
+    recorded_files = {entry.path: entry for entry in recorded}
+    on_disk_files = {entry.path: entry for entry in on_disk}
+
+    mismatches = {}
+    def walk(path: str):
+        if path in on_disk_tree and on_disk_tree[path][0] == recorded_tree[path][0]:
+            return
+        if path in recorded_files:
+            mismatches[path] = changed_chunks(recorded_files[path], on_disk_files.get(path))
+            return
+        for child_path in recorded_tree[path][1].values():
+            walk(child_path)
+    walk("")
+    return mismatches
+
+def changed_chunks(recorded: ManifestEntry, on_disk: ManifestEntry | None) -> list[int] | None:
+    if on_disk is None or recorded.chunks is None or on_disk.chunks is None:
+        return None
+    count = max(recorded.num_chunks(), on_disk.num_chunks())
+    return [index for index in range(count) if recorded.chunk_digest(index) != on_disk.chunk_digest(index)]
+
+def diff(old: list[ManifestEntry], new: list[ManifestEntry]) -> dict[str, list[str]]:
+    """
+    Returns paths of files that were added, removed or modified going from old to new.
+    """
+    old_digests = {entry.path: entry.digest for entry in old}
+    new_digests = {entry.path: entry.digest for entry in new}
+    return {
+        "added": sorted(path for path in new_digests if path not in old_digests),
+        "removed": sorted(path for path in old_digests if path not in new_digests),
+        "modified": sorted(path for path, digest in new_digests.items() if path in old_digests and old_digests[path] != digest)
+    }
@@ -30,7 +30,7 @@ def main():
     if migration == "":
         schema_version = get_schema_version(db)
         if schema_version:
-            migrations = glob.glob("migrations/???_*.sql")
+            migrations = sorted(glob.glob("migrations/???_*.sql"))
             for migration in migrations:
                 basename = os.path.basename(migration)
                 if int(basename.split("_")[0]) > schema_version:
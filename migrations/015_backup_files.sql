@@ -0,0 +1,18 @@
+-- Migration 015
+-- Adds per-file manifests of backups.
+
+ALTER TABLE backups ADD COLUMN IF NOT EXISTS has_manifest BOOLEAN NOT NULL DEFAULT FALSE AFTER hash_mismatch;
+
+CREATE TABLE IF NOT EXISTS backup_files (
+    backup_id CHAR(36) NOT NULL,
+    path VARCHAR(4096) NOT NULL, -- Relative to the root of the backup
+    size BIGINT UNSIGNED NOT NULL,
+    mtime DOUBLE NOT NULL,
+    digest CHAR(64) NOT NULL, -- SHA-256 of file contents
+    hash_mismatch BOOLEAN NOT NULL DEFAULT FALSE, -- Set by the integrity check
+    INDEX(backup_id),
+    INDEX(digest),
+    FOREIGN KEY(backup_id) REFERENCES backups(id) ON DELETE CASCADE
+);
+
+INSERT INTO schema_versions (version, description) VALUES (15, 'Add backup file manifests')
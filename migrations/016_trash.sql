@@ -0,0 +1,11 @@
+-- Migration 016
+-- Adds the queue of deleted files waiting to be removed from disk.
+
+CREATE TABLE IF NOT EXISTS trash (
+    id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+    path VARCHAR(4096) NOT NULL, -- Where the files were moved to
+    size BIGINT UNSIGNED NOT NULL,
+    created_at DATETIME NOT NULL
+);
+
+INSERT INTO schema_versions (version, description) VALUES (16, 'Add trash queue')
@@ -0,0 +1,13 @@
+-- Migration 017
+-- Adds the queue of backups waiting to be moved after their target's location or name template changed.
+
+CREATE TABLE IF NOT EXISTS backup_relocations (
+    backup_id CHAR(36) NOT NULL PRIMARY KEY,
+    target_id CHAR(36) NOT NULL,
+    old_path VARCHAR(4096) NOT NULL, -- Where the backup is now
+    new_path VARCHAR(4096) NOT NULL, -- Where it's going
+    INDEX(target_id),
+    FOREIGN KEY(backup_id) REFERENCES backups(id) ON DELETE CASCADE
+);
+
+INSERT INTO schema_versions (version, description) VALUES (17, 'Add backup relocations')
@@ -0,0 +1,7 @@
+-- Migration 018
+-- Stores where each backup is on disk, so it doesn't have to be looked for.
+
+-- Relative to the target location or recycle bin. Filled in on first access for existing backups.
+ALTER TABLE backups ADD COLUMN IF NOT EXISTS path VARCHAR(4096) DEFAULT NULL AFTER has_manifest;
+
+INSERT INTO schema_versions (version, description) VALUES (18, 'Add backup paths')
@@ -0,0 +1,13 @@
+-- Migration 019
+-- Adds storage formats for multi-file targets.
+
+CREATE TABLE IF NOT EXISTS target_storage (
+    target_id CHAR(36) NOT NULL PRIMARY KEY,
+    storage_format VARCHAR(16) NOT NULL DEFAULT 'files',
+    FOREIGN KEY(target_id) REFERENCES targets(id) ON DELETE CASCADE
+);
+
+-- Where the file's data starts inside the stored archive. NULL for backups stored as plain files.
+ALTER TABLE backup_files ADD COLUMN IF NOT EXISTS data_offset BIGINT UNSIGNED DEFAULT NULL AFTER digest;
+
+INSERT INTO schema_versions (version, description) VALUES (19, 'Add storage formats')
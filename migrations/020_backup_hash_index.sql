@@ -0,0 +1,6 @@
+-- Migration 020
+-- Indexes backups by hash within their target, for finding duplicates.
+
+CREATE INDEX IF NOT EXISTS backups_target_hash ON backups (target_id, hash);
+
+INSERT INTO schema_versions (version, description) VALUES (20, 'Index backup hashes')
@@ -0,0 +1,7 @@
+-- Migration 021
+-- Records when each backup was last checked for integrity, so checks can be spread out and resumed.
+
+ALTER TABLE backups ADD COLUMN IF NOT EXISTS last_verified_at DATETIME DEFAULT NULL AFTER hash_mismatch;
+CREATE INDEX IF NOT EXISTS backups_last_verified ON backups (last_verified_at);
+
+INSERT INTO schema_versions (version, description) VALUES (21, 'Add backup verification times')
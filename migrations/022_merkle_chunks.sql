@@ -0,0 +1,11 @@
+-- Migration 022
+-- Adds chunk digests of backup files, for checking parts of backups and narrowing down what changed.
+
+-- Raw SHA-256 digests of every 1MiB of the file, one after another.
+ALTER TABLE backup_files ADD COLUMN IF NOT EXISTS chunk_digests LONGBLOB DEFAULT NULL AFTER data_offset;
+-- Comma-separated indexes of the chunks that changed, set by the integrity check along with hash_mismatch.
+ALTER TABLE backup_files ADD COLUMN IF NOT EXISTS mismatched_chunks TEXT DEFAULT NULL AFTER hash_mismatch;
+-- Spot checks only read some chunks, this is when the whole backup was last read.
+ALTER TABLE backups ADD COLUMN IF NOT EXISTS last_full_verified_at DATETIME DEFAULT NULL AFTER last_verified_at;
+
+INSERT INTO schema_versions (version, description) VALUES (22, 'Add backup file chunk digests')
@@ -0,0 +1,6 @@
+-- Migration 023
+-- Records what a backup looked like on disk when its size was last computed, so unchanged backups aren't walked again.
+
+ALTER TABLE backups ADD COLUMN IF NOT EXISTS size_fingerprint CHAR(64) DEFAULT NULL AFTER filesize;
+
+INSERT INTO schema_versions (version, description) VALUES (23, 'Add backup size fingerprints')
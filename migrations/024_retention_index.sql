@@ -0,0 +1,6 @@
+-- Migration 024
+-- Lets the recycle job rank the active backups of every target by age in one query.
+
+CREATE INDEX IF NOT EXISTS backups_retention ON backups (is_recycled, target_id, created_at);
+
+INSERT INTO schema_versions (version, description) VALUES (24, 'Add backup retention index')
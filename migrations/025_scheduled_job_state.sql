@@ -0,0 +1,11 @@
+-- Migration 025
+-- Keeps track of when scheduled jobs ran, so they stay on schedule across restarts.
+
+CREATE TABLE IF NOT EXISTS scheduled_job_state (
+    name VARCHAR(255) PRIMARY KEY, -- Name of the job, like integrity_check_job
+    last_run DATETIME DEFAULT NULL,
+    next_run DATETIME NOT NULL,
+    last_duration DOUBLE DEFAULT NULL -- In seconds
+);
+
+INSERT INTO schema_versions (version, description) VALUES (25, 'Add scheduled job state')
@@ -7,6 +7,8 @@ They're all in one files since they're small and don't do anything meaningful.
 
 import database
 import file_manager
+import manifest
+import throttle
 import uuid
 import logging
 import threading
@@ -17,12 +19,34 @@ class MockDatabase(database.Database):
     def __init__(self):
         self.targets: list[models.BackupTarget] = []
         self.backups: list[models.Backup] = []
+        self.manifests: dict[str, list[manifest.ManifestEntry]] = {}
+        self.file_mismatches: dict[str, list[str]] = {}
+        self.trash: list[database.TrashEntry] = []
+        self.relocations: dict[str, database.BackupRelocation] = {}
+        self.paths: dict[str, str] = {}
+        self.storage_formats: dict[str, str] = {}
+        self.last_verified: dict[str, datetime] = {}
+        self.last_full_verified: dict[str, datetime] = {}
+        self.size_fingerprints: dict[str, str | None] = {}
+        self.chunk_mismatches: dict[str, dict[str, list[int]]] = {}
+        self.job_run_states: dict[str, database.JobRunState] = {}
         self.lock = threading.RLock() # since validate_target uses it
         self.logger = logging.getLogger("mockdb")
     
     def reset(self):
         self.targets = []
         self.backups = []
+        self.manifests = {}
+        self.file_mismatches = {}
+        self.trash = []
+        self.relocations = {}
+        self.paths = {}
+        self.storage_formats = {}
+        self.last_verified = {}
+        self.last_full_verified = {}
+        self.size_fingerprints = {}
+        self.chunk_mismatches = {}
+        self.job_run_states = {}
         self.logger.info("Reset")
 
     def add_target(self, name: str, target_type: models.BackupType, recycle_criteria: models.BackupRecycleCriteria, recycle_value: int | None, recycle_action: models.BackupRecycleAction | None, location: str, name_template: str, deduplicate: bool, alias: str | None, min_backups: int | None, tags: list[str] | None) -> str:
@@ -102,6 +126,87 @@ class MockDatabase(database.Database):
 
     def set_backup_filesize(self, backup_id: str, filesize: int):
         self.get_backup(backup_id).filesize = filesize
+
+    def set_backup_filesizes(self, sizes: list[tuple[str, int, str | None]]):
+        for backup_id, filesize, fingerprint in sizes:
+            self.get_backup(backup_id).filesize = filesize
+            self.size_fingerprints[backup_id] = fingerprint
+
+    def list_backup_size_fingerprints(self, target_id: str) -> dict[str, str | None]:
+        return {backup.id: self.size_fingerprints.get(backup.id) for backup in self.list_backups_target(target_id)}
+
+    def set_backup_hash(self, backup_id: str, hash: str):
+        self.get_backup(backup_id).hash = hash
+
+    def set_backup_hash_mismatch(self, backup_id: str, mismatch: bool):
+        self.get_backup(backup_id).hash_mismatch = mismatch
+
+    def set_backup_last_verified(self, backup_id: str, verified_at: datetime):
+        self.last_verified[backup_id] = verified_at
+
+    def get_backup_last_verified(self, backup_id: str) -> None | datetime:
+        return self.last_verified.get(backup_id)
+
+    def set_backup_last_full_verified(self, backup_id: str, verified_at: datetime):
+        self.last_full_verified[backup_id] = verified_at
+
+    def get_backup_last_full_verified(self, backup_id: str) -> None | datetime:
+        return self.last_full_verified.get(backup_id)
+
+    def list_backups_by_verification(self) -> list[tuple[models.Backup, None | datetime]]:
+        backups = sorted(self.backups, key=lambda backup: (backup.id in self.last_verified, self.last_verified.get(backup.id, datetime.min), backup.id))
+        return [(backup, self.last_verified.get(backup.id)) for backup in backups]
+
+    def list_duplicate_backups(self, target_id: str) -> list[str]:
+        active = [backup for backup in self.backups if backup.target_id == target_id and backup.hash and not backup.hash_mismatch and not backup.is_recycled]
+        duplicates = [backup for backup in active if any(other.hash == backup.hash and (other.created_at, other.id) < (backup.created_at, backup.id) for other in active)]
+        return [backup.id for backup in sorted(duplicates, key=lambda backup: backup.created_at, reverse=True)]
+
+    def find_backup_by_hash(self, target_id: str, hash: str) -> str | None:
+        matches = [backup for backup in self.backups if backup.target_id == target_id and backup.hash == hash and not backup.hash_mismatch and not backup.is_recycled]
+        return None if not matches else min(matches, key=lambda backup: (backup.created_at, backup.id)).id
+
+    def get_target_storage_format(self, id: str) -> str:
+        target = self.get_target(id)
+        return self.storage_formats.get(target.id, database.STORAGE_FORMATS[0]) if target is not None else database.STORAGE_FORMATS[0]
+
+    def set_target_storage_format(self, id: str, storage_format: str):
+        target = self.get_target(id)
+        database.validate_storage_format(storage_format, target.target_type)
+        self.storage_formats[target.id] = storage_format
+
+    def set_backup_path(self, backup_id: str, path: str):
+        self.paths[backup_id] = path
+
+    def get_backup_path(self, backup_id: str) -> None | str:
+        return self.paths.get(backup_id)
+
+    def set_backup_manifest(self, backup_id: str, entries: list[manifest.ManifestEntry]):
+        self.manifests[backup_id] = entries
+
+    def get_backup_manifest(self, backup_id: str) -> None | list[manifest.ManifestEntry]:
+        return self.manifests.get(backup_id)
+
+    def set_backup_file_mismatches(self, backup_id: str, paths: list[str], chunks: dict[str, list[int] | None] | None = None):
+        self.file_mismatches[backup_id] = paths
+        self.chunk_mismatches[backup_id] = {path: indexes for path, indexes in (chunks or {}).items() if path in paths and indexes is not None}
+
+    def get_backup_chunk_mismatches(self, backup_id: str) -> dict[str, list[int]]:
+        return self.chunk_mismatches.get(backup_id, {})
+
+    def find_files_by_digest(self, target_id: str, digests: list[str]) -> dict[str, tuple[str, str]]:
+        found = {}
+        for backup_id, entries in self.manifests.items():
+            backup = self.get_backup(backup_id)
+            if backup is None or backup.target_id != target_id:
+                continue
+            for entry in entries:
+                if entry.digest in digests and entry.path not in self.file_mismatches.get(backup_id, []):
+                    found.setdefault(entry.digest, (backup_id, entry.path))
+        return found
+
+    def get_backup_file_mismatches(self, backup_id: str) -> list[str]:
+        return self.file_mismatches.get(backup_id, [])
     
     def get_backup(self, id: str) -> None | models.Backup:
         for backup in self.backups:
@@ -116,6 +221,28 @@ class MockDatabase(database.Database):
     def recycle_backup(self, id: str, recycled: bool):
         self.get_backup(id).is_recycled = recycled
         self.logger.info("Recycle backup {%s} -> %s", id, recycled)
+
+    def delete_backups(self, ids: list[str]):
+        for id in ids:
+            self.delete_backup(id)
+
+    def recycle_backups(self, ids: list[str], recycled: bool):
+        for id in ids:
+            self.recycle_backup(id, recycled)
+
+    def list_expired_backups(self, now: datetime, target_id: str | None = None) -> list[tuple[str, str, models.BackupRecycleAction]]:
+        expired = []
+        for target in sorted(self.targets, key=lambda target: target.id):
+            if target_id is not None and target.id != target_id:
+                continue
+            backups = sorted((backup for backup in self.backups if backup.target_id == target.id and not backup.is_recycled), key=lambda backup: (backup.created_at, backup.id), reverse=True)
+            for newer, backup in enumerate(backups, 1):
+                if target.recycle_criteria == models.BackupRecycleCriteria.COUNT and newer > target.recycle_value:
+                    expired.append(backup)
+                elif target.recycle_criteria == models.BackupRecycleCriteria.AGE and newer > target.min_backups and (now - backup.created_at).days > target.recycle_value:
+                    expired.append(backup)
+        expired.sort(key=lambda backup: (backup.target_id, backup.created_at, backup.id))
+        return [(backup.id, backup.target_id, self.get_target(backup.target_id).recycle_action) for backup in expired]
     
     def list_backups(self) -> list[models.Backup]:
         return self.backups
@@ -147,12 +274,61 @@ class MockDatabase(database.Database):
     def count_recycled_backups(self) -> int:
         return len(self.list_recycled_backups())
     
+    def add_backup_relocations(self, target_id: str, relocations: list[tuple[str, str, str]]):
+        for backup_id, old_path, new_path in relocations:
+            if backup_id in self.relocations:
+                self.relocations[backup_id].new_path = new_path
+            else:
+                self.relocations[backup_id] = database.BackupRelocation(backup_id, target_id, old_path, new_path)
+
+    def get_backup_relocation(self, backup_id: str) -> None | database.BackupRelocation:
+        return self.relocations.get(backup_id)
+
+    def list_backup_relocations(self, target_id: str) -> list[database.BackupRelocation]:
+        return [relocation for relocation in self.relocations.values() if relocation.target_id == target_id]
+
+    def list_relocating_targets(self) -> list[str]:
+        return list({relocation.target_id for relocation in self.relocations.values()})
+
+    def complete_backup_relocation(self, backup_id: str, moved_to: str, path: str) -> bool:
+        relocation = self.relocations.get(backup_id)
+        if relocation is None:
+            return False
+        relocation.old_path = moved_to
+        if relocation.old_path == relocation.new_path:
+            del self.relocations[backup_id]
+            self.paths[backup_id] = path
+            return True
+        return False
+
+    def add_trash(self, path: str, size: int) -> int:
+        trash_id = max((entry.id for entry in self.trash), default=0) + 1
+        self.trash.append(database.TrashEntry(trash_id, path, size, datetime.now()))
+        return trash_id
+
+    def list_trash(self, limit: int | None = None) -> list[database.TrashEntry]:
+        return self.trash[:limit]
+
+    def delete_trash(self, id: int):
+        self.trash = [entry for entry in self.trash if entry.id != id]
+
+    def get_trash_size(self) -> int:
+        return sum(entry.size for entry in self.trash)
+
+    def list_job_run_states(self) -> dict[str, database.JobRunState]:
+        return dict(self.job_run_states)
+
+    def set_job_run_state(self, state: database.JobRunState):
+        self.job_run_states[state.name] = state
+
     def __del__(self):
         pass # Override because this does not initialize a real db connection.
 
 class MockFileManager(file_manager.FileManager):
     def __init__(self, db: MockDatabase):
         self.db = db
+        self.recycle_bin_path = "./Recycle-bin"
+        self.download_cache = None
         self.logger = logging.getLogger("mockfm")
     
     def add_backup(self, backup_id: str, filename: str):
@@ -165,6 +341,7 @@ class MockFileManager(file_manager.FileManager):
             return file_manager.FileManagerError(f"Backup {backup_id} points to nonexistent target")
         
         self.logger.info("Upload %s to backup {%s}", filename, backup_id)
+        return self.get_backup_manifest(backup_id)
     
     def delete_backup(self, backup_id: str):
         backup = self.db.get_backup(backup_id)
@@ -184,9 +361,18 @@ class MockFileManager(file_manager.FileManager):
         
         self.logger.info("Delete all backups for target {%s}", target_id)
     
-    def update_backup_locations(self, target: models.BackupTarget, new_name_template: str, new_location: str, old_name_template: str, old_location: str):
+    def schedule_backup_relocations(self, target: models.BackupTarget, new_name_template: str, new_location: str, old_name_template: str, old_location: str) -> int:
         self.logger.info("Move target {%s} backups. Location '%s' -> '%s'; name template '%s' -> '%s'", target.id, old_location, new_location, old_name_template, new_name_template)
         self.db.validate_target(target.name, new_name_template, new_location, target.id, target.alias)
+        relocations = [(backup.id, old_location, new_location) for backup in self.db.list_backups_target(target.id)]
+        self.db.add_backup_relocations(target.id, relocations)
+        return len(relocations)
+
+    def relocate_backup(self, backup_id: str):
+        relocation = self.db.get_backup_relocation(backup_id)
+        if relocation is not None:
+            self.logger.info("Relocate backup {%s}", backup_id)
+            self.db.complete_backup_relocation(backup_id, relocation.new_path, self.db.get_backup_path(backup_id))
     
     def recycle_backup(self, backup_id: int):
         backup = self.db.get_backup(backup_id)
@@ -220,7 +406,24 @@ class MockFileManager(file_manager.FileManager):
             raise file_manager.FileManagerError(f"Backup {backup_id} points to nonexistent target")
 
         return 123456
+
+    def get_backup_fingerprint(self, backup_id: str) -> str:
+        backup = self.db.get_backup(backup_id)
+        if backup is None:
+            raise file_manager.FileManagerError(f"Backup {backup_id} does not exist")
+
+        return f"{backup_id}:{backup.is_recycled}"
     
+    def get_backup_manifest(self, backup_id: str, limiter: throttle.Throttle | None = None) -> list[manifest.ManifestEntry]:
+        backup = self.db.get_backup(backup_id)
+        if backup is None:
+            raise file_manager.FileManagerError(f"Backup {backup_id} does not exist")
+
+        return [manifest.ManifestEntry("test.txt", 123456, 0, "0" * 64)]
+
+    def get_manifest_size(self, backup_id: str, entries: list[manifest.ManifestEntry]) -> int:
+        return sum(entry.size for entry in entries)
+
     def get_target_size(self, target_id: str) -> int:
         target = self.db.get_target(target_id)
         if target is None:
@@ -1,7 +1,8 @@
-from .scheduler import JobScheduler, ScheduledJob
+from .scheduler import JobScheduler, ScheduledJob, ScheduledJobState, DISK_HEAVY
 from .recycle_job import RecycleJob
 from .backup_filesize_job import BackupFilesizeJob
 from .deduplicate_job import DeduplicateJob
 from .stale_seq_upload_job import StaleSequentialUploadJob
 from .tmp_purge_job import TemporaryPurgeJob
 from .integrity_check_job import IntegrityCheckJob
+from .trash_reaper_job import TrashReaperJob
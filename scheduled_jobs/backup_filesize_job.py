@@ -1,22 +1,45 @@
 import scheduled_jobs
 import database
 import file_manager
+import storage_watcher
 from backupchan_server import utility
 
 class BackupFilesizeJob(scheduled_jobs.ScheduledJob):
-    def __init__(self, interval: int, db: database.Database, fm: file_manager.FileManager):
-        super().__init__(interval, __name__.split(".")[-1], "Update backup filesizes")
+    def __init__(self, interval: int, db: database.Database, fm: file_manager.FileManager, watcher: storage_watcher.StorageWatcher | None = None):
+        super().__init__(interval, __name__.split(".")[-1], "Update backup filesizes", scheduled_jobs.DISK_HEAVY, fixed_rate=False)
 
         self.db = db
         self.fm = fm
+        self.watcher = watcher
+        self.changed_paths = None if watcher is None else watcher.subscribe()
 
     def run(self):
+        changed = None if self.changed_paths is None else self.changed_paths.take()
+        if changed is not None:
+            changed = self.watcher.find_backups(changed)
+            self.logger.info("%d backups changed on disk", len(changed))
+
         targets = self.db.list_targets_all()
         for target in targets:
+            backups = self.db.list_backups_target(target.id)
+            if changed is not None:
+                # The watcher saw everything that happened, so the rest are known to be the same.
+                backups = [backup for backup in backups if backup.id in changed]
+                if not backups:
+                    continue
+
             self.logger.info("Check target {%s} (%s)", target.id, target.name)
-            for backup in self.db.list_backups_target(target.id):
+            fingerprints = self.db.list_backup_size_fingerprints(target.id)
+            sizes = []
+            unchanged = 0
+            for backup in backups:
                 old_filesize = backup.filesize
                 try:
+                    # Backups don't change after upload, so only ones that were moved or touched are walked again.
+                    fingerprint = self.fm.get_backup_fingerprint(backup.id)
+                    if changed is None and fingerprint == fingerprints.get(backup.id):
+                        unchanged += 1
+                        continue
                     new_filesize = self.fm.get_backup_size(backup.id)
                 except file_manager.FileManagerError as exc:
                     self.logger.error("Unable to retrieve filesize for backup {%s}", backup.id, exc_info=exc)
@@ -24,5 +47,8 @@ class BackupFilesizeJob(scheduled_jobs.ScheduledJob):
                 status_string = "no change"
                 if old_filesize != new_filesize:
                     status_string = f"{old_filesize} ({utility.humanread_file_size(old_filesize)}) -> {new_filesize} ({utility.humanread_file_size(new_filesize)})"
-                    self.db.set_backup_filesize(backup.id, new_filesize)
+                # Stored even if the size is the same, so the new fingerprint is remembered.
+                sizes.append((backup.id, new_filesize, fingerprint))
                 self.logger.info(" -> %s ( %s )", backup.id, status_string)
+            self.db.set_backup_filesizes(sizes)
+            self.logger.info(" -> %d unchanged", unchanged)
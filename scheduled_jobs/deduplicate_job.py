@@ -2,26 +2,16 @@ import scheduled_jobs
 import serverapi
 import database
 import file_manager
+from collections import Counter
+from backupchan_server import models
 
 class DeduplicateJob(scheduled_jobs.ScheduledJob):
     def __init__(self, interval: int, db: database.Database, fm: file_manager.FileManager, server_api: serverapi.ServerAPI):
-        super().__init__(interval, __name__.split(".")[-1], "Deduplicate backups")
+        super().__init__(interval, __name__.split(".")[-1], "Deduplicate backups", scheduled_jobs.DISK_HEAVY, fixed_rate=False)
 
         self.db = db
         self.fm = fm
         self.server_api = server_api
-        
-        self.backup_hash_cache = {}
-
-    def clear_cache(self):
-        self.backup_hash_cache = {}
-
-    def get_cached_backup_hash(self, id: str) -> str:
-        if id not in self.backup_hash_cache:
-            backup_hash = self.fm.get_backup_hash(id)
-            self.backup_hash_cache[id] = backup_hash
-            return backup_hash
-        return self.backup_hash_cache[id]
 
     def run(self):
         for target in self.db.list_targets_all():
@@ -30,39 +20,46 @@ class DeduplicateJob(scheduled_jobs.ScheduledJob):
 
             self.logger.info("Check target {%s} (%s)", target.id, target.name)
 
-            # Newest->Oldest
-            backups_all = self.db.list_backups_target(target.id)
-            backups = sorted(backups_all, key=lambda a: a.created_at, reverse=True)
-            for backup in backups:
-                self.logger.info(" -> check {%s}", backup.id)
+            self.hash_candidates(target)
 
-                # Oldest->Newest, exclude current
-                backups_iterate = sorted(backups_all, key=lambda a: a.created_at)
-                backups_iterate.remove(backup)
+            # Of every set of backups with the same hash, the oldest one is kept.
+            for backup_id in self.db.list_duplicate_backups(target.id):
+                self.logger.info("Duplicate. Remove backup {%s}", backup_id)
+                self.server_api.delete_backup(backup_id, True)
 
+    def hash_candidates(self, target: models.BackupTarget):
+        """
+        Hashes backups that don't have a stored hash yet, if they could be a duplicate at all.
+        A backup can only be a duplicate of one with the same size, so the others aren't read.
+        """
+        backups = self.db.list_backups_target(target.id)
+        unhashed = [backup for backup in backups if not backup.hash]
+        if not unhashed:
+            return
+
+        for backup in unhashed:
+            # Size of new backups is only filled in by the filesize job.
+            if backup.filesize == 0:
                 try:
-                    current_hash = self.fm.get_backup_hash(backup.id)
+                    backup.filesize = self.fm.get_backup_size(backup.id)
                 except file_manager.FileManagerError as exc:
-                    self.logger.error("Failed to get backup hash", exc_info=exc)
+                    self.logger.error("Unable to retrieve filesize for backup {%s}", backup.id, exc_info=exc)
                     continue
+                self.db.set_backup_filesize(backup.id, backup.filesize)
 
-                is_dupe = False
-                for backup_check in backups_iterate:
-                    self.logger.info("   -> against {%s}", backup_check.id)
-
-                    try:
-                        backup_hash = self.get_cached_backup_hash(backup_check.id)
-                    except file_manager.FileManagerError as exc:
-                        self.logger.error("Failed to get backup hash", exc_info=exc)
-                        continue
-                    if backup_hash == current_hash:
-                        self.logger.info("Duplicate. Remove backup {%s}", backup.id)
-                        self.server_api.delete_backup(backup.id, True)
-                        is_dupe = True
+        sizes = Counter(backup.filesize for backup in backups)
+        for backup in unhashed:
+            if sizes[backup.filesize] < 2:
+                continue
 
-                    if is_dupe:
-                        break
-                if is_dupe:
-                    continue
+            self.logger.info(" -> hash {%s}", backup.id)
+            try:
+                entries = self.fm.get_backup_manifest(backup.id)
+            except file_manager.FileManagerError as exc:
+                self.logger.error("Failed to get backup hash", exc_info=exc)
+                continue
 
-        self.clear_cache()
+            # Stored the same way the integrity check does, so it doesn't have to read the backup again either.
+            self.db.set_backup_hash(backup.id, self.fm.get_manifest_hash(backup.id, entries))
+            self.db.set_backup_hash_mismatch(backup.id, False)
+            self.db.set_backup_manifest(backup.id, entries)
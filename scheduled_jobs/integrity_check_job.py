@@ -1,30 +1,182 @@
 import scheduled_jobs
 import database
 import file_manager
+import manifest
+import throttle
+import storage_watcher
+import math
+import random
+import threading
+import contextlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from backupchan_server import models
 
 class IntegrityCheckJob(scheduled_jobs.ScheduledJob):
-    def __init__(self, interval: int, db: database.Database, fm: file_manager.FileManager):
-        super().__init__(interval, __name__.split(".")[-1], "Check backup integrity")
+    def __init__(self, interval: int, db: database.Database, fm: file_manager.FileManager, rate: int, period: int, workers: int, samples: int, full_period: int,
+                 watcher: storage_watcher.StorageWatcher | None = None):
+        """
+        Rate is in bytes per second for each device, zero or less means unlimited.
+        Every backup is checked at least once per period (in seconds), each run checks its share of them.
+        Workers is how many backups on the same device are checked at once. Devices are checked in parallel.
+        Checks only read this many random chunks of a backup, unless it wasn't read as a whole within the full period
+        (in seconds) or a chunk doesn't match. Zero or less samples means always reading the whole backup.
+        With a watcher, backups changed on disk by anything other than the server are checked as soon as that's seen.
+        """
+        super().__init__(interval, __name__.split(".")[-1], "Check backup integrity", scheduled_jobs.DISK_HEAVY, fixed_rate=False)
 
         self.db = db
         self.fm = fm
+        self.rate = rate
+        self.period = period
+        self.workers = workers
+        self.samples = samples
+        self.full_period = full_period
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.watcher = watcher
+        self.changed_paths = None if watcher is None else watcher.subscribe(self.check_changed)
+        self.changed_limiter = throttle.Throttle(rate)
 
     def run(self):
-        targets = self.db.list_targets_all()
-        for target in targets:
-            self.logger.info("Check target {%s} (%s)", target.id, target.name)
-            for backup in self.db.list_backups_target(target.id):
-                if backup.hash:
-                    self.logger.info(" -> Checking backup {%s}", backup.id)
-                    on_disk_hash = self.fm.get_backup_hash(backup.id)
-                    if on_disk_hash != backup.hash:
-                        self.logger.warn(f"  -> Mismatch (expected=%s, got=%s)", backup.hash, on_disk_hash)
-                        if not backup.hash_mismatch:
-                            self.db.set_backup_hash_mismatch(backup.id, True)
-                    elif backup.hash_mismatch:
-                        self.logger.info("  -> No longer mismatch")
-                        self.db.set_backup_hash_mismatch(backup.id, False)
-                else:
-                    self.logger.info(" -> Creating new hash for backup {%s}", backup.id)
-                    self.db.set_backup_hash(backup.id, self.fm.get_backup_hash(backup.id))
+        backups = self.select_backups()
+
+        # Backups on different disks don't compete for reads, so each disk gets its own workers and rate.
+        by_device = defaultdict(list)
+        for backup in backups:
+            by_device[self.fm.get_backup_device(backup.id)].append(backup)
+
+        self.logger.info("Check %d backups on %d devices", len(backups), len(by_device))
+
+        self.checked = 0
+        with contextlib.ExitStack() as stack:
+            for device_backups in by_device.values():
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=max(self.workers, 1)))
+                limiter = throttle.Throttle(self.rate)
+                for backup in device_backups:
+                    executor.submit(self.verify_backup, backup, limiter)
+
+        self.logger.info("Checked %d backups", self.checked)
+
+    def select_backups(self) -> list[models.Backup]:
+        """
+        Returns the backups to check in this run.
+        """
+        # Least recently checked come first. Since every check is recorded as soon as it's done,
+        # this also picks up where the previous run left off if it was interrupted.
+        queue = self.db.list_backups_by_verification()
+        quota = len(queue) if self.period <= 0 else math.ceil(len(queue) * self.interval / self.period)
+        overdue_before = datetime.now() - timedelta(seconds=self.period)
+
+        selected = []
+        for backup, last_verified in queue:
+            # Past the quota, only backups that weren't checked within the period are left to do.
+            if len(selected) >= quota and last_verified is not None and last_verified >= overdue_before:
+                break
+            selected.append(backup)
+        return selected
+
+    def check_changed(self):
+        """
+        Checks backups that changed on disk. Only the ones that already had a hash are looked at, others are new and
+        being written or waiting for their first check anyway.
+        """
+        changed = self.changed_paths.take()
+        if not changed:
+            return
+
+        for backup_id, seen_at in self.watcher.find_backups(changed).items():
+            if self.fm.changed_by_server(backup_id, seen_at):
+                continue
+            backup = self.db.get_backup(backup_id)
+            if backup is None or not backup.hash:
+                continue
+            self.logger.warn("Backup {%s} changed on disk", backup.id)
+            # Spot checks could miss the change, so it's read as a whole.
+            self.verify_backup(backup, self.changed_limiter, True)
+
+    def verify_backup(self, backup: models.Backup, limiter: throttle.Throttle, full: bool = False):
+        try:
+            if full or self.needs_full_check(backup) or not self.spot_check_backup(backup, limiter):
+                self.check_backup(backup, limiter)
+                self.db.set_backup_last_full_verified(backup.id, datetime.now())
+        except Exception as exc:
+            if isinstance(exc, file_manager.FileManagerError):
+                self.logger.error("Unable to check backup {%s}", backup.id, exc_info=exc)
+            else:
+                self.logger.error("Unable to read backup {%s}", backup.id, exc_info=exc)
+            # A backup that can't be read doesn't match what was uploaded either. The flag is cleared by the first
+            # check that gets through it again.
+            if not backup.hash_mismatch:
+                self.db.set_backup_hash_mismatch(backup.id, True)
+        # Recorded even if it failed, so a broken backup doesn't hold up the rest of the queue.
+        self.db.set_backup_last_verified(backup.id, datetime.now())
+        with self.lock:
+            self.checked += 1
+
+    def needs_full_check(self, backup: models.Backup) -> bool:
+        if self.samples <= 0 or not backup.hash or backup.hash_mismatch:
+            return True
+        last_full_verified = self.db.get_backup_last_full_verified(backup.id)
+        return last_full_verified is None or last_full_verified < datetime.now() - timedelta(seconds=self.full_period)
+
+    def spot_check_backup(self, backup: models.Backup, limiter: throttle.Throttle | None = None) -> bool:
+        """
+        Compares random chunks of the backup to their recorded digests. Returns False if any of them don't match,
+        or if the backup doesn't have chunk digests recorded to compare to.
+        """
+        recorded_manifest = self.db.get_backup_manifest(backup.id)
+        if recorded_manifest is None or any(entry.chunks is None for entry in recorded_manifest):
+            return False
+
+        # Picking files by their number of chunks makes every chunk of the backup equally likely to be read.
+        weights = [entry.num_chunks() for entry in recorded_manifest]
+        if sum(weights) == 0:
+            return False
+        picked = random.choices(recorded_manifest, weights=weights, k=self.samples)
+        chunks = {(entry.path, index): (entry, index) for entry in picked for index in [random.randrange(entry.num_chunks())]}
+
+        self.logger.info(" -> Spot checking %d chunks of backup {%s}", len(chunks), backup.id)
+        mismatches = self.fm.check_backup_chunks(backup.id, list(chunks.values()), limiter)
+        if mismatches:
+            self.logger.warn("  -> Mismatch in %s, checking the whole backup", list(mismatches))
+            return False
+        return True
+
+    def check_backup(self, backup: models.Backup, limiter: throttle.Throttle | None = None):
+        recorded_manifest = self.db.get_backup_manifest(backup.id)
+        on_disk_manifest = self.fm.get_backup_manifest(backup.id, limiter)
+        on_disk_hash = self.fm.get_manifest_hash(backup.id, on_disk_manifest)
+
+        if backup.hash:
+            self.logger.info(" -> Checking backup {%s}", backup.id)
+            if on_disk_hash != backup.hash:
+                self.logger.warn(f"  -> Mismatch (expected=%s, got=%s)", backup.hash, on_disk_hash)
+                self.fm.invalidate_download_cache(backup.id)
+                if recorded_manifest is not None:
+                    changes = manifest.diff(recorded_manifest, on_disk_manifest)
+                    self.logger.warn("  -> Modified: %s; removed: %s; unexpected: %s", changes["modified"], changes["removed"], changes["added"])
+                    mismatches = manifest.find_mismatches(recorded_manifest, on_disk_manifest)
+                    for path, chunks in mismatches.items():
+                        if chunks:
+                            self.logger.warn("  -> Chunks of %s: %s", path, chunks)
+                    self.db.set_backup_file_mismatches(backup.id, sorted(mismatches), mismatches)
+                if not backup.hash_mismatch:
+                    self.db.set_backup_hash_mismatch(backup.id, True)
+            else:
+                if backup.hash_mismatch:
+                    self.logger.info("  -> No longer mismatch")
                     self.db.set_backup_hash_mismatch(backup.id, False)
+                    if recorded_manifest is not None:
+                        self.db.set_backup_file_mismatches(backup.id, [])
+                if recorded_manifest is None or any(entry.chunks is None for entry in recorded_manifest):
+                    # Backups from before manifests or chunk digests existed get them once they're known to be intact.
+                    self.logger.info("  -> Recording manifest")
+                    self.db.set_backup_manifest(backup.id, on_disk_manifest)
+        else:
+            self.logger.info(" -> Creating new hash for backup {%s}", backup.id)
+            self.fm.invalidate_download_cache(backup.id)
+            self.db.set_backup_hash(backup.id, on_disk_hash)
+            self.db.set_backup_hash_mismatch(backup.id, False)
+            self.db.set_backup_manifest(backup.id, on_disk_manifest)
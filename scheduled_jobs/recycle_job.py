@@ -4,77 +4,78 @@ import database
 import logging
 import datetime
 import threading
+import time
 from backupchan_server import models
 
 class RecycleJob(scheduled_jobs.ScheduledJob):
-    def __init__(self, interval: int, db: database.Database, server_api: serverapi.ServerAPI):
+    def __init__(self, interval: int, db: database.Database, server_api: serverapi.ServerAPI, debounce: float = 0):
+        """
+        Targets queued with queue_target are checked once nothing was queued for debounce seconds.
+        Running the job checks every target.
+        """
         super().__init__(interval, __name__.split(".")[-1], "Check backups for recycling")
 
         self.db = db
         self.server_api = server_api
+        self.debounce = debounce
         self.lock = threading.Lock()
+        self.queued: set[str] = set()
+        self.queued_at = 0.0
+        self.queue_condition = threading.Condition()
+        self.worker = None
 
     def run(self):
         with self.lock:
-            targets = self.db.list_targets_all()
-            for target in targets:
-                self.logger.info("Check target {%s} (%s)", target.id, target.name)
+            # Which backups are past their target's criteria is worked out for every target at once.
+            self.recycle_expired(self.db.list_expired_backups(datetime.datetime.now()))
 
-                if target.recycle_criteria == models.BackupRecycleCriteria.NONE:
-                    self.logger.info("Target has no recycle criteria.")
-                    continue
-                else:
-                    self.check_target(target)
-                    self.logger.info("Finished checking target")
+    def queue_target(self, target_id: str):
+        """
+        Checks the target soon, from a thread of its own. Meant to be called when a backup is added to it.
+        """
+        with self.queue_condition:
+            self.queued.add(target_id)
+            self.queued_at = time.monotonic()
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.process_queue, daemon=True)
+                self.worker.start()
+            self.queue_condition.notify()
 
-    def check_target(self, target: models.BackupTarget):
-        if target.recycle_criteria == models.BackupRecycleCriteria.NONE:
-            self.logger.warn("Tried to check target with no recycle criteria: id {%s}", target.id)
-            return
+    def process_queue(self):
+        while True:
+            with self.queue_condition:
+                while not self.queued:
+                    self.queue_condition.wait()
+                # A burst of uploads to the same target is handled in one go.
+                while (remaining := self.queued_at + self.debounce - time.monotonic()) > 0:
+                    self.queue_condition.wait(remaining)
+                target_ids, self.queued = self.queued, set()
 
-        backups = self.db.list_backups_target_is_recycled(target.id, False)
-        backups.sort(key=lambda a: a.created_at)
+            for target_id in target_ids:
+                try:
+                    with self.lock:
+                        self.recycle_expired(self.db.list_expired_backups(datetime.datetime.now(), target_id))
+                except Exception as exc:
+                    self.logger.error("Exception raised when checking target {%s}", target_id, exc_info=exc)
 
-        if target.recycle_criteria == models.BackupRecycleCriteria.COUNT:
-            max_backups = target.recycle_value
-            num_backups = len(backups)
+    def recycle_expired(self, expired_backups: list[tuple[str, str, models.BackupRecycleAction]]):
+        expired: dict[str, list[str]] = {}
+        recycle_actions: dict[str, models.BackupRecycleAction] = {}
+        for backup_id, target_id, recycle_action in expired_backups:
+            expired.setdefault(target_id, []).append(backup_id)
+            recycle_actions[target_id] = recycle_action
 
-            if num_backups > max_backups:
-                self.logger.info("Criteria = count; Number of backups (%d) exceeds limit (%d), recycling oldest", num_backups, max_backups)
-                new_num_backups = num_backups
-                delete_backup_ids = []
-                for backup in backups:
-                    delete_backup_ids.append(backup.id)
-                    new_num_backups -= 1
-                    if new_num_backups <= max_backups:
-                        break
-                for backup_id in delete_backup_ids:
-                    self.execute_recycle_action(target.recycle_action, backup_id, target.id)
-            else:
-                self.logger.info("Criteria = count; Number of backups (%d) is within limit (%d), skipping", num_backups, max_backups)
-        elif target.recycle_criteria == models.BackupRecycleCriteria.AGE:
-            max_age = target.recycle_value
-            now = datetime.datetime.now()
+        self.logger.info("%d targets have backups to recycle", len(expired))
 
-            self.logger.info("Criteria = age; Recycling backups older than %d days", max_age)
+        for target_id, backup_ids in expired.items():
+            self.logger.info("Target {%s}: %d backups past recycle criteria", target_id, len(backup_ids))
+            self.execute_recycle_action(recycle_actions[target_id], backup_ids, target_id)
 
-            for backup in backups:
-                num_backups = len(self.db.list_backups_target_is_recycled(target.id, False))
-                if num_backups <= target.min_backups:
-                    self.logger.info("Minimal number of backups (%d) reached. Stopping.", target.min_backups)
-                    break
-                age = (now - backup.created_at).days
-                if age > max_age:
-                    self.logger.info("Backup {%s} is %d days old", backup.id, age)
-                    self.execute_recycle_action(target.recycle_action, backup.id, target.id)
-        else:
-            self.logger.error("Target {%s} has a broken recycle criteria value", target.id)
-
-    def execute_recycle_action(self, recycle_action: models.BackupRecycleAction, backup_id: str, target_id: str):
-        self.logger.info("Execute recycle action (%s) on backup {%s}", recycle_action, backup_id)
+    def execute_recycle_action(self, recycle_action: models.BackupRecycleAction, backup_ids: list[str], target_id: str):
+        self.logger.info("Execute recycle action (%s) on backups %s", recycle_action, backup_ids)
         if recycle_action == models.BackupRecycleAction.DELETE:
-            self.server_api.delete_backup(backup_id, True)
+            self.server_api.delete_backups(target_id, backup_ids, True)
         elif recycle_action == models.BackupRecycleAction.RECYCLE:
-            self.server_api.recycle_backup(backup_id)
+            self.server_api.recycle_backups(target_id, backup_ids)
         else:
             self.logger.error("Target {%s} has a broken recycle action value", target_id)
@@ -1,19 +1,45 @@
+import database
 import time
 import logging
 import threading
 import datetime
+import heapq
+import itertools
+import random
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+
+# Jobs that read or walk whole backups. Only one of them runs at a time, so they don't fight over the disks.
+DISK_HEAVY = "disk-heavy"
+
+class ScheduledJobState(Enum):
+    IDLE = 0
+    QUEUED = 1
+    RUNNING = 2
 
 class ScheduledJob:
-    def __init__(self, interval: int, name: str, display_name: str):
+    def __init__(self, interval: int, name: str, display_name: str, group: str | None = None, fixed_rate: bool = True):
+        """
+        Jobs in the same group never run at the same time. A job never runs at the same time as itself either way.
+        Fixed-rate jobs run every interval seconds regardless of how long they take, skipping runs missed while
+        they were still running. Other jobs run interval seconds after the previous run finished.
+        """
         self.interval = interval
         self.name = name
         self.display_name = display_name
+        self.group = group
+        self.fixed_rate = fixed_rate
         self.next_run = time.time() + interval
+        # Where the fixed-rate schedule is at, next_run is this plus jitter.
+        self.scheduled_run = self.next_run
         self.logger = logging.getLogger(name)
         self.force_flag = False
+        self.state = ScheduledJobState.IDLE
+        self.last_run = None
+        self.last_duration = None
 
         self.logger.info(f"Created scheduled job {name} ({display_name}) (interval: {interval} sec)")
- 
+
     def run(self):
         raise NotImplementedError()
 
@@ -22,41 +48,161 @@ class ScheduledJob:
         self.logger.info("Force re-run")
 
 class JobScheduler:
-    def __init__(self):
+    def __init__(self, workers: int = 4, jitter: float = 0, db: database.Database | None = None, stagger: int = 0):
+        """
+        Workers is how many jobs can run at once. Every run is put off by up to jitter times the job's interval,
+        so jobs with the same interval drift apart instead of always running together.
+        With a database, jobs keep to their schedule across restarts. Jobs of the same group start out at least
+        stagger seconds apart.
+        """
         self.logger = logging.getLogger(__name__)
+        self.db = db
+        self.stagger = stagger
+        self.saved_states = {} if db is None else db.list_job_run_states()
         self.jobs: list[ScheduledJob] = []
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="scheduled_job")
+        self.jitter = jitter
+        # Entries of time, sequence number and job. Entries whose time isn't the job's next run anymore are
+        # left in and skipped, unless the job was forced to run.
+        self.queue: list[tuple[float, int, ScheduledJob]] = []
+        self.sequence = itertools.count()
+        self.busy_groups: set[str] = set()
+        self.waiting: list[ScheduledJob] = []
+        self.dispatched: set[str] = set()
+        self.condition = threading.Condition()
 
     def start(self):
         self.logger.info("Start job scheduler")
         threading.Thread(target=self.run, daemon=True).start()
 
     def run(self):
-        while True:
-            self.tick()
-            time.sleep(1)
+        with self.condition:
+            while True:
+                # Sleeps until the next job is due, or until woken up by a job being forced or finishing.
+                self.condition.wait(self.tick())
+
+    def tick(self) -> float | None:
+        """
+        Starts the jobs that are due. Returns how many seconds until the next one is, None if no job is scheduled.
+        """
+        with self.condition:
+            now = time.time()
+            while self.queue and self.queue[0][0] <= now:
+                run_at, _, job = heapq.heappop(self.queue)
+                if run_at != job.next_run and not job.force_flag:
+                    continue
+                # A job never overlaps with itself, whether it's running or waiting for a worker.
+                # One that's still running is put back in the queue once it's done.
+                if job.name in self.dispatched:
+                    continue
+                if job.group is not None and job.group in self.busy_groups:
+                    # Shown as queued until the group is free.
+                    job.state = ScheduledJobState.QUEUED
+                    if job not in self.waiting:
+                        self.waiting.append(job)
+                    continue
+                self.dispatch(job)
+            return None if not self.queue else max(self.queue[0][0] - now, 0)
+
+    def dispatch(self, job: ScheduledJob):
+        if job.group is not None:
+            self.busy_groups.add(job.group)
+        job.state = ScheduledJobState.QUEUED
+        job.force_flag = False
+        self.dispatched.add(job.name)
+        self.executor.submit(self.run_job, job)
 
-    def tick(self):
+    def run_job(self, job: ScheduledJob):
+        self.logger.info("Run job %s", job.name)
+        job.state = ScheduledJobState.RUNNING
+        job.last_run = time.time()
+        start_time = time.perf_counter()
+        try:
+            job.run()
+        except Exception as exc:
+            self.logger.error("Exception raised when running job %s", job.name, exc_info=exc)
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            self.logger.info("Finished running job %s (took %.4f seconds)", job.name, elapsed_time)
+            with self.condition:
+                job.last_duration = elapsed_time
+                job.state = ScheduledJobState.IDLE
+                self.dispatched.discard(job.name)
+                self.schedule_next(job)
+                state = database.JobRunState(job.name, datetime.datetime.fromtimestamp(job.last_run), datetime.datetime.fromtimestamp(job.next_run), job.last_duration)
+                if job.force_flag:
+                    # Forced while it was running.
+                    self.push(job, time.time())
+                if job.group is not None:
+                    self.busy_groups.discard(job.group)
+                    # Whatever was waiting for the group is due right away.
+                    for waiting_job in [waiting_job for waiting_job in self.waiting if waiting_job.group == job.group]:
+                        self.waiting.remove(waiting_job)
+                        waiting_job.force_flag = True
+                        self.push(waiting_job, time.time())
+                self.condition.notify()
+            self.save_state(state)
+
+    def save_state(self, state: database.JobRunState):
+        if self.db is None:
+            return
+        try:
+            self.db.set_job_run_state(state)
+        except Exception as exc:
+            self.logger.error("Unable to save state of job %s", state.name, exc_info=exc)
+
+    def schedule_next(self, job: ScheduledJob):
         now = time.time()
-        for job in self.jobs:
-            if now >= job.next_run or job.force_flag:
-                self.logger.info("Run job %s", job.name)
-                job.force_flag = False
-                start_time = time.perf_counter()
-                try:
-                    job.run()
-                except Exception as exc:
-                    self.logger.error("Exception raised when running job %s", job.name, exc_info=exc)
-                end_time = time.perf_counter()
-                elapsed_time = end_time - start_time
-                self.logger.info("Finished running job (took %.4f seconds)", elapsed_time)
-                job.next_run = now + job.interval
+        if job.fixed_rate and job.interval > 0:
+            # Stays on the same schedule no matter how long the job took, runs missed in the meantime are skipped.
+            while job.scheduled_run <= now:
+                job.scheduled_run += job.interval
+        else:
+            job.scheduled_run = now + job.interval
+        job.next_run = job.scheduled_run + random.uniform(0, self.jitter * job.interval)
+        self.push(job, job.next_run)
+
+    def push(self, job: ScheduledJob, run_at: float):
+        heapq.heappush(self.queue, (run_at, next(self.sequence), job))
 
     def add_job(self, job: ScheduledJob):
-        self.jobs.append(job)
+        with self.condition:
+            self.jobs.append(job)
+            saved_state = self.saved_states.get(job.name)
+            if saved_state is not None:
+                now = time.time()
+                job.last_run = None if saved_state.last_run is None else saved_state.last_run.timestamp()
+                job.last_duration = saved_state.last_duration
+                # Runs missed while the server was down are due right away. Capped in case the interval was shortened since.
+                job.next_run = min(max(saved_state.next_run.timestamp(), now), now + job.interval)
+            else:
+                job.next_run = job.scheduled_run + random.uniform(0, self.jitter * job.interval)
+            if job.group is not None:
+                job.next_run = self.stagger_run(job)
+            job.scheduled_run = job.next_run
+            self.push(job, job.next_run)
+            self.condition.notify()
+            state = database.JobRunState(job.name, None if job.last_run is None else datetime.datetime.fromtimestamp(job.last_run), datetime.datetime.fromtimestamp(job.next_run), job.last_duration)
+        # Saved right away rather than once it runs, otherwise a job that hasn't run yet would be pushed back
+        # a whole interval by every restart and never get to run if restarts come more often than that.
+        self.save_state(state)
+
+    def stagger_run(self, job: ScheduledJob) -> float:
+        """
+        Returns the next run of the job, put off until it's at least stagger seconds away from the others in its group.
+        """
+        run_at = job.next_run
+        for other_run in sorted(other.next_run for other in self.jobs if other is not job and other.group == job.group):
+            if abs(other_run - run_at) < self.stagger:
+                run_at = other_run + self.stagger
+        return run_at
 
     def force_run_job(self, name: str):
         for job in self.jobs:
             if job.name == name:
-                job.force_run()
+                with self.condition:
+                    job.force_run()
+                    self.push(job, time.time())
+                    self.condition.notify()
                 return
         self.logger.warn(f"Requested to force-run job {name}, but no such job found.")
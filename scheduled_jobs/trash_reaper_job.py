@@ -0,0 +1,22 @@
+import scheduled_jobs
+import database
+import file_manager
+import throttle
+from backupchan_server import utility
+
+class TrashReaperJob(scheduled_jobs.ScheduledJob):
+    def __init__(self, interval: int, db: database.Database, fm: file_manager.FileManager, rate: int):
+        super().__init__(interval, __name__.split(".")[-1], "Remove deleted backups from disk")
+
+        self.db = db
+        self.fm = fm
+        self.rate = rate
+
+    def run(self):
+        limiter = throttle.Throttle(self.rate)
+        for entry in self.db.list_trash():
+            self.logger.info("Remove %s (%s)", entry.path, utility.humanread_file_size(entry.size))
+            try:
+                self.fm.remove_trash(entry, limiter)
+            except OSError as exc:
+                self.logger.error("Unable to remove %s", entry.path, exc_info=exc)
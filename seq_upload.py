@@ -9,9 +9,13 @@ TIMEOUT = 3600 # Inactivity timeout (1hr)
 
 @dataclass
 class SequentialFile:
+    """
+    Digest is the SHA-256 of the file's contents, if the client sent it. Files the server already has are filled in with it.
+    """
     path: str
     name: str
     uploaded: bool
+    digest: str | None = None
 
     def compare_full_path(self, other: "SequentialFile") -> bool:
         return self.path == other.path and self.name == other.name
@@ -21,7 +25,7 @@ class SequentialFile:
 
     @staticmethod
     def from_dict(d: dict) -> "SequentialFile":
-        return SequentialFile(d["path"], d["name"], d.get("uploaded", False))
+        return SequentialFile(d["path"], d["name"], d.get("uploaded", False), d.get("digest"))
 
     @staticmethod
     def list_from_dicts(l: list[dict]) -> list["SequentialFile"]:
@@ -55,6 +59,9 @@ class SequentialUpload:
         self.file_list = file_list
         self.manual = manual
         self.last_activity = time.time()
+        # Files the server already has, by full path, along with the backup and path in it they're copied from
+        # once the upload is finished. They count as uploaded until then.
+        self.known_files: dict[str, tuple[str, str]] = {}
 
     def set_uploaded_state(self, uploaded_file: SequentialFile, value: bool) -> bool:
         for file in self.file_list:
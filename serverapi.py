@@ -1,11 +1,24 @@
 import database
 import file_manager
+import target_locks
+import contextlib
+import logging
 import datetime
-import threading
 import os
 import uuid
+from dataclasses import dataclass
+from typing import Callable
 from werkzeug.datastructures import FileStorage
 
+@dataclass
+class UploadResult:
+    """
+    If the target deduplicates and the upload was identical to an existing backup, the upload isn't kept.
+    Backup ID is then that of the existing backup, which is also in duplicate_of.
+    """
+    backup_id: str
+    duplicate_of: str | None = None
+
 class ServerAPI:
     """
     Class for doing actions which require both the database and file manager involved.
@@ -14,64 +27,142 @@ class ServerAPI:
     def __init__(self, db: database.Database, fm: file_manager.FileManager):
         self.db = db
         self.fm = fm
-        self.lock = threading.RLock()
+        self.locks = target_locks.TargetLocks()
+        self.upload_listeners: list[Callable[[str], None]] = []
+        self.logger = logging.getLogger(__name__)
 
-    def edit_target(self, target_id: str, new_name: str, new_recycle_criteria: str, new_recycle_value: int, new_recycle_action: str, new_location: str, new_name_template: str, deduplicate: bool, alias: str | None, min_backups: int | None, tags: list[str] | None):
-        with self.lock:
+    def add_upload_listener(self, listener: Callable[[str], None]):
+        """
+        The listener is called with the target ID every time a backup is added to a target.
+        """
+        self.upload_listeners.append(listener)
+
+    def edit_target(self, target_id: str, new_name: str, new_recycle_criteria: str, new_recycle_value: int, new_recycle_action: str, new_location: str, new_name_template: str, deduplicate: bool, alias: str | None, min_backups: int | None, tags: list[str] | None) -> bool:
+        """
+        Returns True if backups have to be moved. That's left to delayed_jobs.RelocateJob, which the caller should start.
+        Raises database.TargetNotFoundError if the target doesn't exist (anymore).
+        """
+        with self.target_lock(target_id):
             target = self.db.get_target(target_id)
+            if target is None:
+                raise database.TargetNotFoundError(f"Target with id or alias {target_id} does not exist")
             old_location = target.location
             old_name_template = target.name_template
             self.db.edit_target(target_id, new_name, new_recycle_criteria, new_recycle_value, new_recycle_action, new_location, new_name_template, deduplicate, alias, min_backups, tags)
             if old_name_template != new_name_template or old_location != new_location:
-                self.fm.update_backup_locations(target, new_name_template, new_location, old_name_template, old_location)
+                return self.fm.schedule_backup_relocations(target, new_name_template, new_location, old_name_template, old_location) > 0
+            return False
 
     def delete_target(self, target_id: str, delete_files: bool):
-        with self.lock:
+        with self.target_lock(target_id):
             if delete_files:
                 self.fm.delete_target_backups(target_id)
             self.db.delete_target(target_id)
 
     def delete_target_backups(self, target_id: str, delete_files: bool):
-        with self.lock:
+        with self.target_lock(target_id):
             for backup in self.db.list_backups_target(target_id):
                 self.delete_backup(backup.id, delete_files)
 
     def delete_target_recycled_backups(self, target_id: str, delete_files: bool):
-        with self.lock:
+        with self.target_lock(target_id):
             for backup in self.db.list_backups_target_is_recycled(target_id, True):
                 self.delete_backup(backup.id, delete_files)
 
-    def upload_backup(self, target_id: str, manual: bool, filenames: list[str]) -> str:
+    def upload_backup(self, target_id: str, manual: bool, filenames: list[str]) -> UploadResult:
         backup_id = self.db.add_backup(target_id, manual)
 
         try:
-            self.fm.add_backup(backup_id, filenames)
+            # Files are hashed as they're added, and the size and hash of the backup come from that.
+            entries = self.fm.add_backup(backup_id, filenames)
         except Exception as exc:
             self.db.delete_backup(backup_id)
             raise
 
-        self.db.set_backup_filesize(backup_id, self.fm.get_backup_size(backup_id))
-        self.db.set_backup_hash(backup_id, self.fm.get_backup_hash(backup_id))
-        return backup_id
+        backup_hash = self.fm.get_manifest_hash(backup_id, entries)
+        # Set before checking for a duplicate, so a duplicate goes to the trash with its actual size.
+        self.db.set_backup_filesize(backup_id, self.fm.get_manifest_size(backup_id, entries))
+
+        # Held so that two identical uploads finishing at once can't both miss each other.
+        with self.target_lock(target_id):
+            target = self.db.get_target(target_id)
+            duplicate_id = self.db.find_backup_by_hash(target.id, backup_hash) if target.deduplicate else None
+            if duplicate_id is not None:
+                self.delete_backup(backup_id, True)
+                return UploadResult(duplicate_id, duplicate_id)
+
+            self.db.set_backup_manifest(backup_id, entries)
+            self.db.set_backup_hash(backup_id, backup_hash)
+
+        for listener in self.upload_listeners:
+            try:
+                listener(target.id)
+            except Exception as exc:
+                # The backup is already added, so this shouldn't fail the upload.
+                self.logger.error("Exception raised by upload listener", exc_info=exc)
+        return UploadResult(backup_id)
 
     def delete_backup(self, backup_id: str, delete_files: bool):
-        with self.lock:
+        with self.backup_lock(backup_id):
             if delete_files:
                 self.fm.delete_backup(backup_id)
             self.db.delete_backup(backup_id)
 
     def recycle_backup(self, backup_id: str):
-        with self.lock:
+        with self.backup_lock(backup_id):
             self.fm.recycle_backup(backup_id)
             self.db.recycle_backup(backup_id, True)
 
     def unrecycle_backup(self, backup_id: str):
-        with self.lock:
+        with self.backup_lock(backup_id):
             self.fm.unrecycle_backup(backup_id)
             self.db.recycle_backup(backup_id, False)
 
+    def delete_backups(self, target_id: str, backup_ids: list[str], delete_files: bool):
+        """
+        Deletes backups of the target. Files are handled one backup at a time, the database is updated in one go.
+        """
+        deleted = []
+        with self.target_lock(target_id):
+            try:
+                for backup_id in backup_ids:
+                    if delete_files:
+                        self.fm.delete_backup(backup_id)
+                    deleted.append(backup_id)
+            finally:
+                # Whatever was done before something failed is still recorded.
+                self.db.delete_backups(deleted)
+
+    def recycle_backups(self, target_id: str, backup_ids: list[str]):
+        """
+        Recycles backups of the target. Files are moved one backup at a time, the database is updated in one go.
+        """
+        recycled = []
+        with self.target_lock(target_id):
+            try:
+                for backup_id in backup_ids:
+                    self.fm.recycle_backup(backup_id)
+                    recycled.append(backup_id)
+            finally:
+                self.db.recycle_backups(recycled, True)
+
     def recycle_bin_clear(self, delete_files: bool):
-        with self.lock:
-            recycled_backups = self.db.list_recycled_backups()
+        recycled_backups = self.db.list_recycled_backups()
+        with self.locks.targets([backup.target_id for backup in recycled_backups]):
             for backup in recycled_backups:
                 self.delete_backup(backup.id, delete_files)
+
+    def target_lock(self, target_id: str) -> contextlib.AbstractContextManager:
+        """
+        Returns the lock of the target. Accepts alias as well.
+        """
+        target = self.db.get_target(target_id)
+        # Nothing to protect if it doesn't exist, let the operation itself deal with it.
+        return contextlib.nullcontext() if target is None else self.locks.target(target.id)
+
+    def backup_lock(self, backup_id: str) -> contextlib.AbstractContextManager:
+        """
+        Returns the lock of the target the backup belongs to.
+        """
+        backup = self.db.get_backup(backup_id)
+        return contextlib.nullcontext() if backup is None else self.locks.target(backup.target_id)
@@ -12,15 +12,34 @@ def get_server_config(defaults_only=False):
     server_config.add_option("temp_save_path", str, "/tmp/backupchan")
     server_config.add_option("db", dict, {})
     server_config.add_option("recycle_bin_path", str, "./Recycle-bin")
-    server_config.add_option("recycle_job_interval", int, 3600)
+    server_config.add_option("recycle_job_interval", int, 6 * 3600)
+    server_config.add_option("recycle_debounce", int, 5)
+    server_config.add_option("scheduler_workers", int, 4)
+    server_config.add_option("scheduler_jitter_percent", int, 5)
+    server_config.add_option("scheduler_stagger", int, 900)
     server_config.add_option("backup_filesize_job_interval", int, 7200)
     server_config.add_option("deduplicate_job_interval", int, 18000)
     server_config.add_option("stale_seq_upload_job_interval", int, 3600)
     server_config.add_option("tmp_purge_job_interval", int, 43200)
-    server_config.add_option("integrity_check_job_interval", int, 57600)
+    server_config.add_option("integrity_check_job_interval", int, 3600)
+    server_config.add_option("integrity_check_period", int, 7 * 24 * 3600)
+    server_config.add_option("integrity_check_rate", int, 50 * 1024 ** 2)
+    server_config.add_option("integrity_check_workers", int, 1)
+    server_config.add_option("integrity_check_samples", int, 64)
+    server_config.add_option("integrity_check_full_period", int, 30 * 24 * 3600)
+    server_config.add_option("trash_reaper_job_interval", int, 60)
+    server_config.add_option("trash_reaper_rate", int, 500)
+    server_config.add_option("relocate_workers", int, 4)
+    server_config.add_option("pack_threshold", int, 64 * 1024)
     server_config.add_option("webui_auth", bool, False)
     server_config.add_option("page_size", int, 10)
     server_config.add_option("webui_localhost_disable_auth", bool, False)
+    server_config.add_option("download_cache_path", str, "./Download-cache")
+    server_config.add_option("download_cache_size", int, 10 * 1024 ** 3)
+    server_config.add_option("download_offload", str, "")
+    server_config.add_option("download_offload_locations", dict, {})
+    server_config.add_option("storage_watcher", bool, False)
+    server_config.add_option("storage_watcher_settle", int, 10)
     if not defaults_only:
         server_config.parse()
     return server_config
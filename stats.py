@@ -20,4 +20,10 @@ class Stats:
             total += self.db.get_backup(backup.id).filesize
         return int(total)
 
+    def total_pending_delete_size(self) -> int:
+        """
+        Size of deleted backups that are yet to be removed from disk.
+        """
+        return self.db.get_trash_size()
+
     # not worth putting total backups and targets count since they can be easily accessed from the database
@@ -0,0 +1,305 @@
+"""
+Watches the locations backups are stored in for changes, so jobs only have to look at the backups that changed
+instead of going through all of them. Uses inotify, so it only works on Linux.
+"""
+
+import database
+import file_manager
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from collections import defaultdict
+from typing import Callable
+from backupchan_server import utility
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+# How often (in seconds) targets are looked up again, to start watching new locations.
+ROOT_REFRESH_INTERVAL = 60
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.libc_add_watch = libc.inotify_add_watch
+        self.libc_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path: str) -> int:
+        wd = self.libc_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read_events(self) -> list[tuple[int, int, str]]:
+        """
+        Returns watch descriptor, mask and name of every event that's ready.
+        """
+        data = os.read(self.fd, READ_SIZE)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+            events.append((wd, mask, name))
+        return events
+
+class ChangedPaths:
+    """
+    Paths that changed since they were last taken, along with when they were last seen changing (from time.monotonic).
+    Every path is an entry right inside a watched location, which is where backups are.
+    """
+    def __init__(self, watching: threading.Event):
+        self.watching = watching
+        self.paths: dict[str, float] = {}
+        self.known = False
+        self.lock = threading.Lock()
+
+    def add(self, path: str, seen_at: float):
+        with self.lock:
+            self.paths[path] = seen_at
+
+    def forget(self):
+        """
+        Called when changes might have been missed.
+        """
+        with self.lock:
+            self.paths = {}
+            self.known = False
+
+    def take(self) -> dict[str, float] | None:
+        """
+        Returns None if what changed isn't known, because the watcher wasn't watching everything or missed changes.
+        Everything has to be looked at then.
+        """
+        with self.lock:
+            paths = self.paths if self.known else None
+            self.paths = {}
+            self.known = self.watching.is_set()
+            return paths
+
+class StorageWatcher:
+    def __init__(self, db: database.Database, fm: file_manager.FileManager, settle: float):
+        """
+        Listeners are called once nothing changed for settle seconds.
+        """
+        self.db = db
+        self.fm = fm
+        self.settle = settle
+        self.inotify = None
+        self.roots: set[str] = set()
+        self.watches: dict[int, str] = {}
+        # Entry right inside a watched location -> IDs of the backups in it, see map_backups.
+        self.backup_paths: dict[str, list[str]] = {}
+        # Paths that changed but weren't in any backup when the map was last made.
+        self.unmapped: set[str] = set()
+        self.map_lock = threading.Lock()
+        self.subscribers: list[ChangedPaths] = []
+        self.listeners: list[Callable[[], None]] = []
+        # Set while every location is watched. Cleared while one can't be, and for good if the watch limit is hit.
+        self.watching = threading.Event()
+        self.out_of_watches = False
+        self.changed = threading.Event()
+        self.last_change = 0.0
+        self.logger = logging.getLogger(__name__)
+
+    def subscribe(self, listener: Callable[[], None] | None = None) -> ChangedPaths:
+        """
+        Returns the paths that change from now on. The listener is called when some changed, from the watcher's own thread.
+        """
+        changed_paths = ChangedPaths(self.watching)
+        self.subscribers.append(changed_paths)
+        if listener is not None:
+            self.listeners.append(listener)
+        return changed_paths
+
+    def start(self):
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError) as exc:
+            self.logger.warn("Unable to watch storage, jobs will look at every backup", exc_info=exc)
+            return
+        self.logger.info("Start storage watcher")
+        threading.Thread(target=self.run, daemon=True).start()
+        threading.Thread(target=self.notify_listeners, daemon=True).start()
+
+    def run(self):
+        next_refresh = 0
+        while True:
+            if time.monotonic() >= next_refresh:
+                self.refresh_roots()
+                next_refresh = time.monotonic() + ROOT_REFRESH_INTERVAL
+            ready, _, _ = select.select([self.inotify.fd], [], [], ROOT_REFRESH_INTERVAL)
+            if ready:
+                self.handle_events(self.inotify.read_events())
+
+    def refresh_roots(self):
+        roots = {os.path.abspath(target.location) for target in self.db.list_targets_all()}
+        roots.add(os.path.abspath(self.fm.recycle_bin_path))
+        missing = False
+        for root in sorted(roots - self.roots):
+            if not os.path.isdir(root):
+                # Tried again on the next refresh. Until then changes there go unseen, so what changed isn't known.
+                missing = True
+                continue
+            self.logger.info("Watch %s", root)
+            # Replaced rather than changed, since other threads go through it.
+            self.roots = self.roots | {root}
+            self.watch_tree(root)
+        self.map_backups()
+        if missing or self.out_of_watches:
+            if self.watching.is_set():
+                self.watching.clear()
+                self.lose_changes()
+        else:
+            self.watching.set()
+
+    def watch_tree(self, path: str):
+        for dirpath, dirnames, _ in os.walk(path):
+            # Trash is on its way out, so changes there don't matter.
+            if file_manager.TRASH_DIR_NAME in dirnames:
+                dirnames.remove(file_manager.TRASH_DIR_NAME)
+            try:
+                self.watches[self.inotify.add_watch(dirpath)] = dirpath
+            except OSError as exc:
+                if exc.errno == errno.ENOSPC:
+                    if not self.out_of_watches:
+                        self.logger.error("Out of inotify watches, raise fs.inotify.max_user_watches. Jobs will look at every backup")
+                        self.out_of_watches = True
+                        self.lose_changes()
+                    return
+                # Not being there anymore just means it was deleted before it could be watched.
+                if exc.errno != errno.ENOENT:
+                    self.logger.error("Unable to watch %s", dirpath, exc_info=exc)
+
+    def lose_changes(self):
+        if self.out_of_watches:
+            self.watching.clear()
+        for changed_paths in self.subscribers:
+            changed_paths.forget()
+
+    def handle_events(self, events: list[tuple[int, int, str]]):
+        now = time.monotonic()
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.logger.warn("Missed some changes, jobs will look at every backup once")
+                self.lose_changes()
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                if directory in self.roots:
+                    # Watched again on the next refresh if it comes back, anything in between is missed.
+                    self.roots = self.roots - {directory}
+                    self.watching.clear()
+                    self.lose_changes()
+                continue
+
+            path = utility.join_path(directory, name) if name else directory
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and name != file_manager.TRASH_DIR_NAME:
+                self.watch_tree(path)
+
+            top_path = self.get_top_path(path)
+            if top_path is None:
+                continue
+            for changed_paths in self.subscribers:
+                changed_paths.add(top_path, now)
+            self.last_change = now
+            self.changed.set()
+
+    def notify_listeners(self):
+        while True:
+            self.changed.wait()
+            # Wait for things to settle, so a backup being written to is only looked at once it's done.
+            while (remaining := self.last_change + self.settle - time.monotonic()) > 0:
+                time.sleep(remaining)
+            self.changed.clear()
+            for listener in self.listeners:
+                try:
+                    listener()
+                except Exception as exc:
+                    self.logger.error("Exception raised by storage change listener", exc_info=exc)
+
+    def get_top_path(self, path: str) -> str | None:
+        """
+        Returns the entry right inside a watched location that the path is in, None if it's not in one.
+        """
+        best_root = None
+        for root in self.roots:
+            if path.startswith(root + "/") and (best_root is None or len(root) > len(best_root)):
+                best_root = root
+        if best_root is None:
+            return None
+        return utility.join_path(best_root, path[len(best_root) + 1:].split("/")[0])
+
+    def map_backups(self):
+        """
+        Maps every backup to the entry right inside a watched location it's in. Goes through all of them, so it's
+        only done along with refreshing the watched locations, or when a changed path isn't in the map yet.
+        """
+        backup_paths = defaultdict(list)
+        for target in self.db.list_targets_all():
+            for backup in self.db.list_backups_target(target.id):
+                try:
+                    location = os.path.abspath(self.fm.get_backup_location(backup, target))
+                except file_manager.FileManagerError:
+                    continue
+                top_path = self.get_top_path(location)
+                if top_path is not None:
+                    backup_paths[top_path].append(backup.id)
+        with self.map_lock:
+            self.backup_paths = dict(backup_paths)
+            self.unmapped = set()
+
+    def find_backups(self, paths: dict[str, float]) -> dict[str, float]:
+        """
+        Returns the backups the changed paths belong to, along with when they were last seen changing.
+        """
+        found = {}
+        if not paths:
+            return found
+
+        with self.map_lock:
+            unknown = [path for path in paths if path not in self.backup_paths and path not in self.unmapped]
+        if unknown:
+            # Backups added or moved since the map was made. Paths still not in it aren't backups, so they don't
+            # get it made again until the next refresh.
+            self.map_backups()
+            with self.map_lock:
+                self.unmapped |= {path for path in unknown if path not in self.backup_paths}
+
+        with self.map_lock:
+            for path, seen_at in paths.items():
+                for backup_id in self.backup_paths.get(path, []):
+                    found[backup_id] = seen_at
+        return found
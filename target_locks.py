@@ -0,0 +1,32 @@
+"""
+Locks held per target, so that slow operations on one target don't block the others.
+"""
+
+import threading
+import contextlib
+
+class TargetLocks:
+    def __init__(self):
+        self.locks: dict[str, threading.RLock] = {}
+        self.lock = threading.Lock()
+
+    def get(self, target_id: str) -> threading.RLock:
+        """
+        Returns the lock of the target, creating it if it doesn't exist yet. Takes target ID, not alias.
+        """
+        with self.lock:
+            return self.locks.setdefault(target_id, threading.RLock())
+
+    def target(self, target_id: str) -> threading.RLock:
+        return self.get(target_id)
+
+    @contextlib.contextmanager
+    def targets(self, target_ids: list[str]):
+        """
+        Holds the locks of several targets at once. They're always taken in the same order, so two operations
+        spanning overlapping sets of targets can't deadlock each other.
+        """
+        with contextlib.ExitStack() as stack:
+            for target_id in sorted(set(target_ids)):
+                stack.enter_context(self.get(target_id))
+            yield
@@ -0,0 +1,29 @@
+"""
+Rate limiting for background jobs that would otherwise saturate the disk.
+"""
+
+import time
+import threading
+
+class Throttle:
+    def __init__(self, rate: float):
+        """
+        Rate is in units per second. Zero or less means unlimited.
+        Can be shared between threads, the rate then applies to all of them together.
+        """
+        self.rate = rate
+        self.start = time.monotonic()
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def tick(self, amount: float = 1):
+        """
+        Accounts for amount units of work, sleeping if they came in faster than the rate allows.
+        """
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.done += amount
+            ahead = self.done / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
@@ -17,21 +17,35 @@ def new_target(db: database.Database) -> str | None:
         return "Specify a recycle value"
 
     try:
-        db.add_target(request.form["name"], request.form["backup_type"], request.form["recycle_criteria"], request.form.get("recycle_value", 0), request.form.get("recycle_action", "none"), request.form["location"], request.form["name_template"], int("deduplicate" in request.form), request.form.get("alias", None) or None, request.form.get("min_backups", 0), request.form.get("tags", "").split())
+        if request.form["backup_type"] == "multi":
+            database.validate_storage_format(request.form.get("storage_format", "files"), request.form["backup_type"])
+        target_id = db.add_target(request.form["name"], request.form["backup_type"], request.form["recycle_criteria"], request.form.get("recycle_value", 0), request.form.get("recycle_action", "none"), request.form["location"], request.form["name_template"], int("deduplicate" in request.form), request.form.get("alias", None) or None, request.form.get("min_backups", 0), request.form.get("tags", "").split())
+        if request.form["backup_type"] == "multi":
+            db.set_target_storage_format(target_id, request.form.get("storage_format", "files"))
     except Exception as exc:
         return str(exc)
     return None
 
-def edit_target(target_id: str, server_api: serverapi.ServerAPI) -> str | None:
+def edit_target(target_id: str, db: database.Database, config: configtony.Config, job_manager: delayed_jobs.JobManager, server_api: serverapi.ServerAPI) -> str | None:
     log("edit target")
 
     if not "recycle_value" in request.form and request.form["recycle_criteria"] != "none":
         return "Specify a recycle value"
 
+    target = db.get_target(target_id)
+    if target is None:
+        return "Target does not exist"
     try:
-        server_api.edit_target(target_id, request.form["name"], request.form["recycle_criteria"], request.form.get("recycle_value", 0), request.form.get("recycle_action", "none"), request.form["location"], request.form["name_template"], int("deduplicate" in request.form), request.form.get("alias", None) or None, request.form.get("min_backups", 0), request.form.get("tags", "").split())
+        if target.target_type == "multi":
+            database.validate_storage_format(request.form.get("storage_format", "files"), target.target_type)
+        needs_relocation = server_api.edit_target(target_id, request.form["name"], request.form["recycle_criteria"], request.form.get("recycle_value", 0), request.form.get("recycle_action", "none"), request.form["location"], request.form["name_template"], int("deduplicate" in request.form), request.form.get("alias", None) or None, request.form.get("min_backups", 0), request.form.get("tags", "").split())
+        if target.target_type == "multi":
+            db.set_target_storage_format(target_id, request.form.get("storage_format", "files"))
     except Exception as exc:
         return str(exc)
+
+    if needs_relocation:
+        job_manager.run_job(delayed_jobs.RelocateJob(target.id, server_api.fm, config.get("relocate_workers"), target.location))
     return None
 
 def delete_target(target_id: str, server_api: serverapi.ServerAPI):
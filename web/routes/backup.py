@@ -21,7 +21,7 @@ def add_routes(context: WebContext):
         if target is None:
             abort(404) # shouldn't happen but ok
 
-        return send_file(download.get_download_path(backup, target, context.fm.recycle_bin_path, context.config.get("temp_save_path"), context.fm), as_attachment=True)
+        return download.send_backup(backup, target, context.fm, context.config)
 
     @context.blueprint.route("/backup/<id>/delete", methods=["GET", "POST"])
     @context.auth.requires_auth
@@ -42,12 +42,14 @@ def add_routes(context: WebContext):
     def view_stats():
         total_target_size = context.stats.total_target_size()
         total_recycle_bin_size = context.stats.total_recycle_bin_size()
+        total_pending_delete_size = context.stats.total_pending_delete_size()
         total_targets = context.db.count_targets()
         total_backups = context.db.count_backups()
         total_recycled_backups = context.db.count_recycled_backups()
         return render_template("view_stats.html",
                                total_target_size=total_target_size,
                                total_recycle_bin_size=total_recycle_bin_size,
+                               total_pending_delete_size=total_pending_delete_size,
                                total_targets=total_targets,
                                total_backups=total_backups,
                                total_recycled_backups=total_recycled_backups,
@@ -83,12 +83,12 @@ def add_routes(context: WebContext):
         if target is None:
             abort(404)
         if request.method == "POST":
-            error_message = post_handlers.edit_target(id, context.server_api)
+            error_message = post_handlers.edit_target(id, context.db, context.config, context.job_manager, context.server_api)
             if error_message is None:
                 return redirect(url_for("webui.view_target", id=id))
             else:
-                return render_template("edit_target.html", target=target, error_message=error_message)
-        return render_template("edit_target.html", target=target)
+                return render_template("edit_target.html", target=target, storage_format=context.db.get_target_storage_format(id), error_message=error_message)
+        return render_template("edit_target.html", target=target, storage_format=context.db.get_target_storage_format(id))
 
     @context.blueprint.route("/target/<id>/delete", methods=["GET", "POST"])
     @context.auth.requires_auth